@@ -0,0 +1,12 @@
+# coding: utf-8
+"""
+Benchmarks of json_diff
+
+workloads generates pairs of documents of the shapes json_diff is used
+on, run measures time and memory of the phases of comparing them and
+compares the numbers with a stored baseline. Run it from the top of the
+source tree:
+
+    python -m bench.run --save bench-baseline.json
+    python -m bench.run --baseline bench-baseline.json
+"""
@@ -0,0 +1,298 @@
+# coding: utf-8
+"""
+Benchmark runner
+
+For every workload, fraction of changes and size it measures the phases
+of json_diff run:
+
+    parse    -- decoding both documents (Comparator constructor)
+    compare  -- Comparator.compare_dicts without options
+    filter   -- Comparator.compare_dicts with the workload's -x/-i
+    format   -- writing the diff as JSON and as HTML
+
+Time is the best of --repeat runs. Memory is the growth of the peak
+resident size during the phase; each phase runs in a forked process
+so that the peaks of the other phases do not hide it (where fork or
+the resource module are missing, it is not measured).
+
+Results can be saved as a baseline and later runs compared with it;
+the run fails (exit status 1) when some phase got slower by more than
+--tolerance or its memory grew by more than --memory-tolerance (where
+both runs measured it).
+"""
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import os
+import sys
+import time
+import traceback
+import random
+from StringIO import StringIO
+from optparse import OptionParser
+
+import json_diff
+from bench.workloads import WORKLOADS
+
+PHASES = ["parse", "compare", "filter", "format"]
+SIZES = [1000, 10000, 100000]
+CHANGES = [0.01, 0.5]
+
+# Differences of times smaller than this (in seconds) are noise, not
+# regressions.
+MIN_REGRESSION = 0.005
+# Same for peak memory (in kB), which grows by whole pages and chunks of
+# the allocator.
+MIN_MEMORY_REGRESSION = 1024
+
+
+class _Options(object):
+    """Command line options of json_diff for the filter phase."""
+
+    def __init__(self, exclude, include):
+        self.exclude = exclude
+        self.include = include
+        self.ignore_append = False
+
+
+class Case(object):
+    """
+    Documents of one workload of given size and fraction of changes,
+    prepared for all the phases.
+    """
+
+    def __init__(self, workload, size, changes, seed=0):
+        self.workload = workload
+        self.size = size
+        self.changes = changes
+        generator, exclude, include = WORKLOADS[workload]
+        self.old, self.new = generator(size, changes, random.Random(seed))
+        self.old_text = json.dumps(self.old)
+        self.new_text = json.dumps(self.new)
+        self.opts = _Options(exclude, include)
+        self.diff = json_diff.Comparator().compare_dicts(self.old, self.new)
+
+    def name(self, phase):
+        """Key of phase of this case in results and baselines."""
+        return u"%s/%s/%d/%s" % (self.workload, self.changes, self.size,
+                                 phase)
+
+    def run(self, phase):
+        """Run phase once."""
+        if phase == "parse":
+            json_diff.Comparator(StringIO(self.old_text),
+                                 StringIO(self.new_text))
+        elif phase == "compare":
+            json_diff.Comparator().compare_dicts(self.old, self.new)
+        elif phase == "filter":
+            json_diff.Comparator(opts=self.opts).compare_dicts(self.old,
+                                                               self.new)
+        elif phase == "format":
+            outf = open(os.devnull, "w")
+            try:
+                json_diff.write_json(self.diff, outf)
+                json_diff.HTMLFormatter(self.diff).write(outf)
+            finally:
+                outf.close()
+        else:
+            raise ValueError("Unknown phase %s" % phase)
+
+
+def _peak_kb():
+    """Peak resident size of this process in kB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(case, phase, repeat=3):
+    """Return (seconds, peak_kb) of phase of case; peak_kb is None when
+    it cannot be measured."""
+    if resource is None or not hasattr(os, "fork"):
+        return _measure_here(case, phase, repeat)[0], None
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child measures and reports back
+        os.close(read_fd)
+        try:
+            try:
+                outf = os.fdopen(write_fd, "wb")
+                pickle.dump(_measure_here(case, phase, repeat), outf)
+                outf.close()
+            except Exception:
+                traceback.print_exc()
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    data = []
+    chunk = os.read(read_fd, 4096)
+    while chunk:
+        data.append(chunk)
+        chunk = os.read(read_fd, 4096)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError("Benchmark %s failed" % case.name(phase))
+    return pickle.loads("".join(data))
+
+
+def _measure_here(case, phase, repeat):
+    """measure() in this process."""
+    if resource is not None:
+        start_kb = _peak_kb()
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        case.run(phase)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    if resource is None:
+        return best, None
+    return best, _peak_kb() - start_kb
+
+
+def run_all(workloads, sizes, changes, phases, repeat=3, outf=None):
+    """Measure all combinations, return {name: (seconds, peak_kb)} and
+    print a line for every measurement to outf (if given)."""
+    results = {}
+    for workload in workloads:
+        for change in changes:
+            for size in sizes:
+                case = Case(workload, size, change)
+                for phase in phases:
+                    seconds, peak_kb = measure(case, phase, repeat)
+                    results[case.name(phase)] = (seconds, peak_kb)
+                    if outf is not None:
+                        if peak_kb is None:
+                            peak_kb = "-"
+                        print >>outf, "%-32s %10.4f s %10s kB" % \
+                            (case.name(phase), seconds, peak_kb)
+                        outf.flush()
+    return results
+
+
+def compare_baseline(results, baseline, tolerance, memory_tolerance=None):
+    """Return list of (name, unit, value, baseline value) of the results
+    slower (unit "s") than their baseline by more than tolerance (a
+    fraction), or needing more memory (unit "kB") by more than
+    memory_tolerance (tolerance if None). Memory is compared only when
+    both the result and the baseline have it."""
+    if memory_tolerance is None:
+        memory_tolerance = tolerance
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        seconds, peak_kb = results[name]
+        base_seconds, base_kb = baseline[name]
+        if (seconds > base_seconds * (1 + tolerance) and
+                seconds - base_seconds > MIN_REGRESSION):
+            regressions.append((name, "s", seconds, base_seconds))
+        if peak_kb is None or base_kb is None:
+            continue
+        if (peak_kb > base_kb * (1 + memory_tolerance) and
+                peak_kb - base_kb > MIN_MEMORY_REGRESSION):
+            regressions.append((name, "kB", peak_kb, base_kb))
+    return regressions
+
+
+def _list_option(value, convert):
+    return [convert(item) for item in value.split(",") if item]
+
+
+def main(sys_args):
+    """Run the benchmarks as told by the command line arguments."""
+    parser = OptionParser(usage="usage: python -m bench.run [options]")
+    parser.add_option("-w", "--workloads",
+                      action="store", dest="workloads", metavar="LIST",
+                      default=",".join(sorted(WORKLOADS)),
+                      help="comma separated workloads (default %default)")
+    parser.add_option("-s", "--sizes",
+                      action="store", dest="sizes", metavar="LIST",
+                      default=",".join([str(size) for size in SIZES]),
+                      help="comma separated sizes of documents " +
+                      "(default %default)")
+    parser.add_option("-c", "--changes",
+                      action="store", dest="changes", metavar="LIST",
+                      default=",".join([str(change) for change in CHANGES]),
+                      help="comma separated fractions of changed values " +
+                      "(default %default)")
+    parser.add_option("-p", "--phases",
+                      action="store", dest="phases", metavar="LIST",
+                      default=",".join(PHASES),
+                      help="comma separated phases (default %default)")
+    parser.add_option("-r", "--repeat",
+                      action="store", type="int", dest="repeat",
+                      metavar="N", default=3,
+                      help="take the best time of N runs (default %default)")
+    parser.add_option("--save",
+                      action="store", dest="save", metavar="FILE",
+                      help="store the results as a baseline to FILE")
+    parser.add_option("-b", "--baseline",
+                      action="store", dest="baseline", metavar="FILE",
+                      help="fail if a phase is slower than in baseline " +
+                      "FILE")
+    parser.add_option("-t", "--tolerance",
+                      action="store", type="float", dest="tolerance",
+                      metavar="FRACTION", default=0.25,
+                      help="slowdown allowed against the baseline " +
+                      "(default %default)")
+    parser.add_option("--memory-tolerance",
+                      action="store", type="float", dest="memory_tolerance",
+                      metavar="FRACTION",
+                      help="memory growth allowed against the baseline " +
+                      "(default: --tolerance)")
+    (options, args) = parser.parse_args(sys_args[1:])
+
+    workloads = _list_option(options.workloads, unicode)
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error("Unknown workload %s" % workload)
+    phases = _list_option(options.phases, str)
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error("Unknown phase %s" % phase)
+    try:
+        sizes = _list_option(options.sizes, int)
+        changes = _list_option(options.changes, float)
+    except ValueError, exc:
+        parser.error(str(exc))
+
+    results = run_all(workloads, sizes, changes, phases, options.repeat,
+                      sys.stdout)
+
+    if options.save:
+        outf = open(options.save, "w")
+        try:
+            json.dump(results, outf, indent=4, sort_keys=True)
+        finally:
+            outf.close()
+
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        regressions = compare_baseline(results, baseline, options.tolerance,
+                                       options.memory_tolerance)
+        for name, unit, value, base in regressions:
+            if unit == "s":
+                print "REGRESSION %s: %.4f s, baseline %.4f s" % (name,
+                                                                 value, base)
+            else:
+                print "REGRESSION %s: %d kB, baseline %d kB" % (name, value,
+                                                               base)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
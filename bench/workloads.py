@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+Generators of pairs of documents for benchmarks
+
+Every generator takes the size (roughly the number of values in the
+document), the fraction of values which should change and a
+random.Random instance, and returns (old, new) pair of documents. The
+documents are built from scratch, so the pair shares no objects.
+"""
+import copy
+
+# json module of python 2 and HTMLFormatter recurse for every level of
+# nesting, they would hit the recursion limit with deeper documents
+DEEP_MAX_DEPTH = 250
+
+RESULTS = [u"pass", u"fail", u"skip", u"warn", u"crash"]
+
+
+def _changed(rng, changes):
+    """Should the next value change?"""
+    return rng.random() < changes
+
+
+def wide_dict(size, changes, rng):
+    """One object with size scalar members."""
+    old = {}
+    for idx in xrange(size):
+        old[u"key%d" % idx] = rng.randint(0, 1000)
+    new = {}
+    for key, value in old.iteritems():
+        if not _changed(rng, changes):
+            new[key] = value
+        elif rng.random() < 0.8:
+            new[key] = value + 1
+        else:
+            new[key + u"_renamed"] = value
+    return old, new
+
+
+def deep_nesting(size, changes, rng):
+    """Objects nested DEEP_MAX_DEPTH (or size) levels deep, with the rest
+    of size spread among the levels as scalars."""
+    depth = min(size, DEEP_MAX_DEPTH)
+    width = max(1, size // depth)
+    old = new = None
+    for level in xrange(depth):
+        old_level = {u"child": old}
+        new_level = {u"child": new}
+        for idx in xrange(width):
+            value = rng.randint(0, 1000)
+            old_level[u"v%d" % idx] = value
+            if _changed(rng, changes):
+                value += 1
+            new_level[u"v%d" % idx] = value
+        old = old_level
+        new = new_level
+    return old, new
+
+
+def scalar_array(size, changes, rng):
+    """One long array of numbers, some of them changed, some dropped at
+    the end."""
+    old = [rng.random() for idx in xrange(size)]
+    new = []
+    for value in old:
+        if _changed(rng, changes):
+            value = rng.random()
+        new.append(value)
+    if changes > 0:
+        del new[-int(len(new) * changes / 10 + 1):]
+    return {u"values": old}, {u"values": new}
+
+
+def record_array(size, changes, rng):
+    """Array of small objects (records) with an id field, as returned by
+    database-backed services."""
+    count = max(1, size // 5)
+    old = []
+    for idx in xrange(count):
+        old.append({u"id": idx,
+                    u"name": u"record %d" % idx,
+                    u"value": rng.randint(0, 1000),
+                    u"tags": [u"a", u"b"],
+                    u"active": True})
+    new = copy.deepcopy(old)
+    for record in new:
+        if _changed(rng, changes):
+            record[u"value"] += 1
+            if rng.random() < 0.3:
+                record[u"tags"].append(u"c")
+    return {u"records": old}, {u"records": new}
+
+
+def piglit_results(size, changes, rng):
+    """Test results as written by piglit (see test/old-testing-data.json):
+    many tests keyed by path, each with its result, time and info."""
+    count = max(1, size // 4)
+    old_tests = {}
+    for idx in xrange(count):
+        name = u"spec/group%d/subgroup%d/test%d" % (idx % 17, idx % 101, idx)
+        old_tests[name] = {u"result": rng.choice(RESULTS),
+                           u"time": rng.random(),
+                           u"info": u"Returncode: 0\n\nErrors:\n\n"
+                                    u"Output:\n%d" % idx,
+                           u"returncode": 0}
+    new_tests = copy.deepcopy(old_tests)
+    for test in new_tests.itervalues():
+        # times always differ
+        test[u"time"] = rng.random()
+        if _changed(rng, changes):
+            test[u"result"] = rng.choice(RESULTS)
+    old = {u"name": u"piglit run",
+           u"options": {u"profile": u"all"},
+           u"tests": old_tests}
+    new = {u"name": u"piglit run",
+           u"options": {u"profile": u"all"},
+           u"tests": new_tests}
+    return old, new
+
+
+# name -> (generator, -x and -i options for the filter phase)
+WORKLOADS = {
+    u"wide": (wide_dict, [u"key1"], []),
+    u"deep": (deep_nesting, [u"v0"], []),
+    u"scalars": (scalar_array, [], [u"values"]),
+    u"records": (record_array, [u"tags"], []),
+    u"piglit": (piglit_results, [u"time", u"info"], [u"result"]),
+}
@@ -28,9 +28,58 @@ try:
     import json
 except ImportError:
     import simplejson as json
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import mmap
+except ImportError:
+    mmap = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from cgi import parse_qs
+# optional faster JSON decoders, see DECODERS
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+import os
+import gc
+import copy
+import filecmp
+import marshal
+import tempfile
 import sys
+import re
+import time
+import codecs
 import logging
+import threading
+import urllib
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
 from optparse import OptionParser
+from heapq import heappush, heappop
+try:
+    from heapq import merge
+except ImportError:
+    # Python < 2.6, see _merge_runs
+    merge = None
 
 __author__ = "Matěj Cepl"
 __version__ = "1.3.4"
@@ -41,12 +90,55 @@ logging.basicConfig(format='%(levelname)s:%(funcName)s:%(message)s',
 STYLE_MAP = {
     u"_append": u"append_class",
     u"_remove": u"remove_class",
-    u"_update": u"update_class"
+    u"_update": u"update_class",
+    u"_move": u"move_class"
 }
 INTERNAL_KEYS = set(STYLE_MAP.keys())
 
 LEVEL_INDENT = u"&nbsp;"
 
+# Encoded JSON output is written in pieces of about this size
+JSON_CHUNK_SIZE = 64 * 1024
+
+# Documents with fewer values than this are not worth comparing in
+# parallel (forking workers and pickling results back costs more).
+PARALLEL_MIN_NODES = 200000
+# Work is split into about this many parts per worker process.
+PARALLEL_PARTS_PER_JOB = 8
+
+# Pairs of files handed to a batch worker process at once.
+BATCH_CHUNK_SIZE = 4
+
+# Default size limit of DiffCache in bytes; bump the version whenever
+# the format of results changes.
+DIFF_CACHE_SIZE = 256 * 1024 * 1024
+DIFF_CACHE_VERSION = 1
+# Temporary files of DiffCache older than this (in seconds) are left over
+# by writers which died, evict() removes them.
+DIFF_CACHE_TMP_AGE = 3600
+
+# Defaults of the diff server: total size of the JSON text of baselines
+# kept in memory (in bytes) and number of requests handled at once.
+SERVER_MEMORY = 1024 * 1024 * 1024
+SERVER_REQUESTS = 4
+
+# Records of NDJSON files sorted on disk are sorted in memory in runs of
+# this many, and at most this many sorted runs are merged at once.
+RECORDS_SORT_CHUNK = 100000
+RECORDS_MERGE_RUNS = 64
+
+# Arrays of numbers at least this long are compared by numpy (if it is
+# installed), shorter ones are not worth converting.
+VECTOR_MIN_ITEMS = 1000
+
+# Aligned array comparison gives up (and compares arrays index by index)
+# when more insertions and removals than this are needed.
+ALIGN_MAX_EDITS = 1000
+
+# Key of Comparator._report for the change of the container being
+# compared itself (not of one of its members).
+_NO_KEY = object()
+
 out_str_template = u"""<!DOCTYPE html>
 <html lang='en'>
 <meta charset="utf-8" />
@@ -64,6 +156,9 @@ td {
 .update_class {
   color: navy;
 }
+.move_class {
+  color: purple;
+}
 </style>
 <body>
   <h1>%s</h1>
@@ -80,61 +175,247 @@ def is_scalar(value):
     return not isinstance(value, (list, tuple, dict))
 
 
+def _text(value):
+    """Command line arguments come as UTF-8 encoded str."""
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+
+def write_json(obj, outf, compact=False, encoding="utf-8"):
+    """
+    Write obj as JSON to file outf.
+
+    The output is encoded incrementally and written in chunks of about
+    JSON_CHUNK_SIZE, so no full size copy of it is ever built. Unless
+    compact is True, the output is indented as json.dumps(obj, indent=4)
+    would do it.
+    """
+    if compact:
+        encoder = json.JSONEncoder(ensure_ascii=False,
+                                   separators=(",", ":"))
+    else:
+        encoder = json.JSONEncoder(indent=4, ensure_ascii=False)
+    pieces = []
+    size = 0
+    for piece in encoder.iterencode(obj):
+        if encoding and isinstance(piece, unicode):
+            piece = piece.encode(encoding)
+        pieces.append(piece)
+        size += len(piece)
+        if size >= JSON_CHUNK_SIZE:
+            outf.write("".join(pieces))
+            pieces = []
+            size = 0
+    outf.write("".join(pieces))
+
+
+def write_changes(changes, outf, encoding="utf-8"):
+    """
+    Write changes as generated by Comparator.iter_changes to file outf
+    as JSON lines, [path, change_type, old, new] on each, every line as
+    soon as its change comes. Return the number of changes written.
+    """
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    count = 0
+    for path, change_type, old, new in changes:
+        line = encoder.encode([list(path), change_type, old, new])
+        if encoding and isinstance(line, unicode):
+            line = line.encode(encoding)
+        outf.write(line + "\n")
+        count += 1
+    return count
+
+
+def _has_speedups(module):
+    """Does json (or simplejson) module decode with its C scanner?"""
+    scanner = getattr(module, "scanner", None)
+    return getattr(scanner, "c_make_scanner", None) is not None
+
+
+def _ujson_loads(data):
+    """ujson rounds floats unless asked not to."""
+    return ujson.loads(data, precise_float=True)
+
+# JSON decoders available by name, functions decoding str with a document
+DECODERS = {u"json": json.loads}
+if simplejson is not None:
+    DECODERS[u"simplejson"] = simplejson.loads
+if ujson is not None:
+    DECODERS[u"ujson"] = _ujson_loads
+
+
+def default_decoder():
+    """
+    Name of the fastest decoder from DECODERS whose documents compare
+    equal to the ones of the json module: simplejson with its C speedups,
+    or json. Unlike json, simplejson returns ASCII-only strings as str
+    rather than unicode (which compare equal, but keep their type in the
+    diffs), and it differs from json in some other edge cases too.
+    ujson is not chosen by default, it differs in more of them (large
+    numbers, duplicate keys) and must be asked for.
+    """
+    if simplejson is not None and _has_speedups(simplejson):
+        return u"simplejson"
+    return u"json"
+
+
+def read_input(fileobj):
+    """
+    The rest of fileobj as str. Regular files are mapped into memory and
+    copied out at once instead of being read through the file buffers.
+    """
+    if mmap is not None and isinstance(fileobj, file):
+        try:
+            pos = fileobj.tell()
+            size = os.fstat(fileobj.fileno()).st_size
+        except EnvironmentError:
+            size = 0
+        if size > pos:
+            mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = mapped[pos:]
+            finally:
+                mapped.close()
+            fileobj.seek(0, 2)
+            return data
+    return fileobj.read()
+
+
+def decode_json(fileobj, decoder=None):
+    """Decode JSON document from fileobj, see decode_buffer."""
+    return decode_buffer(read_input(fileobj), decoder)
+
+
+def decode_buffer(data, decoder=None):
+    """
+    Decode JSON document from data (str, unicode or any buffer: bytearray,
+    memoryview, ...) with decoder (a name from DECODERS, default_decoder()
+    if None). str and unicode are decoded as they are, other buffers have
+    to be copied to str once, the decoders cannot read anything else.
+
+    The garbage collector is paused meanwhile: decoding allocates lots of
+    containers, none of which can be garbage, and the collections they
+    would trigger only slow it down.
+    """
+    if decoder is None:
+        decoder = default_decoder()
+    loads = DECODERS[decoder]
+    if not isinstance(data, basestring):
+        if hasattr(data, "tobytes"):
+            # memoryview
+            data = data.tobytes()
+        else:
+            data = str(data)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return loads(data)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
 class HTMLFormatter(object):
     """Special formatter to generate HTML page from diff dict.
+
+    The page is generated row by row, so it can be written out without
+    ever being held in memory as a whole. Instead of the diff, the
+    formatter can get the changes generated by Comparator.iter_changes,
+    then the rows are written as the changes are found.
     """
 
-    def __init__(self, diff_object):
+    def __init__(self, diff_object=None, changes=None):
         self.diff = diff_object
+        self.changes = changes
 
     def _generate_page(self, in_dict, title="json_diff result"):
-        """A shell function to start recursive self._format_dict.
+        """A shell function to start recursive self._iter_dict; generates
+        the page in pieces.
         """
-        out_str = out_str_template % (title, title,
-                                      self._format_dict(in_dict))
-        out_str += u"""</table>
+        head, tail = out_str_template.rsplit(u"%s", 1)
+        yield head % (title, title)
+        if in_dict is None:
+            rows = self._iter_changes(self.changes)
+        else:
+            if u"_truncated" in in_dict:
+                # partial diff, see Comparator.compare_dicts
+                truncated = in_dict[u"_truncated"]
+                yield (u"<tr>\n  <td>truncated (%s): %d changes found, "
+                       u"%d containers skipped</td>\n  </tr>" %
+                       (u", ".join(truncated[u"limits"]),
+                        truncated[u"changes"], truncated[u"skipped"]))
+                in_dict = dict(in_dict)
+                del in_dict[u"_truncated"]
+            rows = self._iter_dict(in_dict)
+        for row in rows:
+            yield row
+        yield tail
+        yield u"""</table>
   </body>
 </html>"""
-        return out_str
 
-    def _format_item(self, item, index, typch, level=0):
-        """Function to unify formatting on the leaf node level."""
-        level_str = (u"<td>" + LEVEL_INDENT + u"</td>") * level
+    def _iter_changes(self, changes):
+        """Generate HTML rows for changes, the same ones _iter_dict
+        generates for them in a diff."""
+        for path, change_type, old, new in changes:
+            if change_type == u"_remove":
+                value = old
+            else:
+                value = new
+            if path:
+                index = path[-1]
+            else:
+                # the whole document changed its type
+                index = u""
+            for row in self._iter_item(value, index, change_type,
+                                       max(len(path) - 1, 0)):
+                yield row
 
+    def _iter_item(self, item, index, typch, level=0):
+        """Function to unify formatting on the leaf node level."""
         if is_scalar(item):
-            out_str = (u"<tr>\n  %s<td class='%s'>%s = %s</td>\n  </tr>\n" %
-                       (level_str, STYLE_MAP[typch], index, unicode(item)))
+            level_str = (u"<td>" + LEVEL_INDENT + u"</td>") * level
+            yield (u"<tr>\n  %s<td class='%s'>%s = %s</td>\n  </tr>" %
+                   (level_str, STYLE_MAP[typch], index, unicode(item)))
         elif isinstance(item, (list, tuple)):
-            out_str = self._format_array(item, typch, level + 1)
+            for row in self._iter_array(item, typch, level + 1):
+                yield row
         else:
-            out_str = self._format_dict(item, typch, level + 1)
-        return out_str.strip()
+            for row in self._iter_dict(item, typch, level + 1):
+                yield row
 
-    def _format_array(self, diff_array, typch, level=0):
-        """Recursively generate HTML for two different arrays."""
-        out_str = []
+    def _iter_array(self, diff_array, typch, level=0):
+        """Recursively generate HTML rows for two different arrays."""
         for index in range(len(diff_array)):
-            out_str.append(self._format_item(diff_array[index], index, typch,
-                           level))
-        return ("".join(out_str)).strip()
+            for row in self._iter_item(diff_array[index], index, typch,
+                                       level):
+                yield row
 
-    def _format_dict(self, diff_dict, typch="unknown_change", level=0):
-        """Recursively generate HTML for two different dicts."""
-        out_str = []
+    def _iter_dict(self, diff_dict, typch="unknown_change", level=0):
+        """Recursively generate HTML rows for two different dicts."""
         # For all STYLE_MAP keys which are present in diff_dict
         for typechange in set(diff_dict.keys()) & INTERNAL_KEYS:
-            out_str.append(self._format_dict(diff_dict[typechange],
-                           typechange, level))
+            for row in self._iter_dict(diff_dict[typechange], typechange,
+                                       level):
+                yield row
 
         # For all other non-internal keys
         for variable in set(diff_dict.keys()) - INTERNAL_KEYS:
-            out_str.append(self._format_item(diff_dict[variable],
-                           variable, typch, level))
+            for row in self._iter_item(diff_dict[variable], variable, typch,
+                                       level):
+                yield row
 
-        return ("".join(out_str)).strip()
+    def write(self, outf, encoding="utf-8", title="json_diff result"):
+        """Write the page to file outf piece by piece, encoded to encoding
+        (None writes unicode)."""
+        for chunk in self._generate_page(self.diff, title):
+            if encoding:
+                chunk = chunk.encode(encoding)
+            outf.write(chunk)
 
     def __unicode__(self):
-        return self._generate_page(self.diff)
+        return u"".join(self._generate_page(self.diff))
 
 
 class BadJSONError(ValueError):
@@ -142,25 +423,461 @@ class BadJSONError(ValueError):
     pass
 
 
+class PatchError(ValueError):
+    """JSON Patch cannot be applied to the document."""
+    pass
+
+
+class DiffStats(object):
+    """
+    Statistics of a comparison: time spent in its phases and counters of
+    the work done by Comparator, which fills them in when it gets the
+    instance (or --stats option). Counters cover only the work done in
+    this process (not in -j worker processes); StreamingComparator does
+    not count members, frames and depth of the streamed containers.
+    """
+    COUNTERS = [
+        (u"containers", u"containers compared"),
+        (u"members", u"their members (of the longer one)"),
+        (u"skipped", u"subtrees skipped (equal, excluded or not included)"),
+        (u"frames", u"result dicts allocated for containers"),
+        (u"result_dicts", u"dicts in the result"),
+        (u"max_depth", u"maximum nesting depth"),
+    ]
+
+    def __init__(self):
+        self.phases = []
+        self._phase_times = {}
+        for name, description in self.COUNTERS:
+            setattr(self, name, 0)
+
+    def add_phase(self, name, seconds):
+        """Add seconds spent in phase name."""
+        if name not in self._phase_times:
+            self.phases.append(name)
+            self._phase_times[name] = 0.0
+        self._phase_times[name] += seconds
+
+    def phase_time(self, name):
+        """Seconds spent in phase name."""
+        return self._phase_times.get(name, 0.0)
+
+    def count_result(self, result):
+        """Count dicts making up the diff result (not the ones inside
+        reported values)."""
+        if not isinstance(result, dict):
+            return
+        stack = [result]
+        while stack:
+            diff = stack.pop()
+            self.result_dicts += 1
+            for change_type, changes in diff.iteritems():
+                if change_type not in INTERNAL_KEYS:
+                    continue
+                self.result_dicts += 1
+                if change_type == u"_update":
+                    for value in changes.itervalues():
+                        if isinstance(value, dict):
+                            stack.append(value)
+
+    def as_dict(self):
+        """All statistics as a dict (phase times under "phases")."""
+        out = {u"phases": dict(self._phase_times)}
+        for name, description in self.COUNTERS:
+            out[name] = getattr(self, name)
+        return out
+
+    def write(self, outf):
+        """Write the statistics to outf as a human readable table."""
+        for name in self.phases:
+            print >>outf, "%-14s %10.4f s" % (name, self._phase_times[name])
+        for name, description in self.COUNTERS:
+            print >>outf, "%-14s %10d   %s" % (name, getattr(self, name),
+                                               description)
+
+
+class DiffTracer(object):
+    """
+    Trace of the decisions Comparator takes while filtering the changes,
+    for debugging of -x, -i and -a patterns. Every decision is a record
+    (path, change_type, decision), where path is a tuple of keys and
+    indices from the top of the document and decision one of
+
+        reported      -- change_type change at path goes to the result
+        not_included  -- it does not, path is not under any -i pattern
+                         (with change_type None: subtree at path is not
+                         compared, nothing in it can be)
+        ignored       -- it does not, appended keys are ignored (-a)
+        excluded      -- subtree at path is not compared (-x)
+        equal         -- subtree at path is known to be equal (the same
+                         object or the same SubtreeHashes hash)
+
+    Records are written to outf as JSON lines, if given, or collected in
+    the records list. Comparator without a tracer (the default) does not
+    pay anything for the tracing.
+    """
+
+    def __init__(self, outf=None):
+        self.outf = outf
+        self.records = []
+
+    def record(self, path, change_type, decision):
+        """Record decision about change_type change at path."""
+        if self.outf is None:
+            self.records.append((path, change_type, decision))
+        else:
+            self.outf.write(json.dumps({u"path": list(path),
+                                        u"change": change_type,
+                                        u"decision": decision}) + "\n")
+
+
+class SubtreeHashes(object):
+    """
+    Merkle-style content hashes of JSON containers (see xdiff/xdiff.pdf).
+
+    Hash of a dict or list is computed from its scalars and from hashes of
+    its nested containers, so two containers with the same hash are equal
+    (types of scalars included); -A aligns array items by them. Hashes are
+    computed lazily and remembered by identity of the container, so they
+    stay valid only as long as the hashed objects are not modified.
+
+    An instance made with base (hashes of a baseline, see
+    Comparator.index_baseline) looks the hashes up in base too, but keeps
+    the ones it computes to itself, so base can be shared read-only.
+    """
+
+    def __init__(self, base=None):
+        # id(container) -> (container, digest); keeping the container
+        # alive guarantees its id is not reused by another object
+        self._digests = {}
+        self._base = base
+
+    def __len__(self):
+        return len(self._digests)
+
+    def known(self, value):
+        """The hash of container value if it is computed already (here or
+        in base), otherwise None; unlike digest, it never walks value."""
+        known = self._known(id(value))
+        if known is None:
+            return None
+        return known[1]
+
+    def _known(self, key):
+        """(container, digest) of the container with id key, or None."""
+        known = self._digests.get(key)
+        if known is None and self._base is not None:
+            return self._base._known(key)
+        return known
+
+    def digest(self, value):
+        """Return the hash of container value, computing hashes of all its
+        not yet seen nested containers on the way."""
+        known = self._known(id(value))
+        if known is not None:
+            return known[1]
+
+        digests = self._digests
+        known = self._known
+        # post-order walk with an explicit stack, nesting is not limited
+        # by the recursion limit
+        stack = [(value, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                if known(id(node)) is not None:
+                    continue
+                stack.append((node, True))
+                if isinstance(node, dict):
+                    children = node.itervalues()
+                else:
+                    children = node
+                for child in children:
+                    if isinstance(child, (dict, list)):
+                        stack.append((child, False))
+                continue
+
+            # repr() of JSON scalars is unambiguous and keeps their types
+            # apart (1, 1.0 and True are all different)
+            if isinstance(node, dict):
+                parts = ["{"]
+                keys = node.keys()
+                keys.sort()
+                for key in keys:
+                    child = node[key]
+                    if isinstance(child, (dict, list)):
+                        parts.append("%r:#%s," % (key, known(id(child))[1]))
+                    else:
+                        parts.append("%r:%r," % (key, child))
+            else:
+                parts = ["["]
+                for child in node:
+                    if isinstance(child, (dict, list)):
+                        parts.append("#%s," % known(id(child))[1])
+                    else:
+                        parts.append("%r," % (child,))
+            digests[id(node)] = (node, sha1("".join(parts)).hexdigest())
+
+        return digests[id(value)][1]
+
+
+def _shortest_edit_matches(old_keys, new_keys, max_edits):
+    """
+    Myers' O(ND) difference algorithm.
+
+    Return list of (old index, new index) pairs of items kept by the
+    shortest edit script turning old_keys into new_keys, or None when the
+    script would need more than max_edits insertions and removals.
+    """
+    old_len = len(old_keys)
+    new_len = len(new_keys)
+    max_d = min(old_len + new_len, max_edits)
+    offset = max_d + 1
+    # furthest reaching x on diagonal k (x - y == k) lives at v[offset + k]
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in xrange(max_d + 1):
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while (x < old_len and y < new_len and
+                   old_keys[x] == new_keys[y]):
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= old_len and y >= new_len:
+                trace.append(v[offset - d:offset + d + 1])
+                return _backtrack_matches(trace, old_len, new_len)
+        # diagonals -d .. d after d edits
+        trace.append(v[offset - d:offset + d + 1])
+    return None
+
+
+def _backtrack_matches(trace, x, y):
+    """Walk trace of _shortest_edit_matches back from (x, y) and collect
+    the diagonal moves (kept items)."""
+    matches = []
+    for d in xrange(len(trace) - 1, 0, -1):
+        prev = trace[d - 1]
+        k = x - y
+        # prev[k + d - 1] is the furthest x on diagonal k after d - 1 edits
+        if k == -d or (k != d and prev[k - 1 + d - 1] < prev[k + 1 + d - 1]):
+            prev_k = k + 1
+            start_x = prev[prev_k + d - 1]
+        else:
+            prev_k = k - 1
+            start_x = prev[prev_k + d - 1] + 1
+        start_y = start_x - k
+        while x > start_x and y > start_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+        x = prev[prev_k + d - 1]
+        y = x - prev_k
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((x, y))
+    matches.reverse()
+    return matches
+
+
+class _PathNode(object):
+    """One step of _PathRules trie."""
+    __slots__ = ("children", "star", "values", "subtree", "below")
+
+    def __init__(self):
+        self.children = {}
+        self.star = None
+        self.values = {}
+        # nodes which stay in the state for the whole subtree
+        self.subtree = ()
+        # kinds of values attached to this node or any node under it
+        self.below = set()
+
+
+class _PathRules(object):
+    """
+    Patterns of paths in the compared documents with values attached to
+    them, compiled into a trie which is walked along with the documents.
+
+    A pattern is a list of keys (or array indices) separated by "/", "*"
+    stands for any single key; "~1" in a key stands for "/" and "~0" for
+    "~", as in JSON Pointer. Patterns starting with "/" are anchored at
+    the top of the document, the other ones match at any depth, and also
+    as a single key name (piglit names its tests like "spec/glsl/foo").
+
+    State of the walk is a tuple of trie nodes reached by the path so far;
+    it is None when there are no patterns at all, so that the comparison
+    without any rules does not pay for them.
+    """
+
+    def __init__(self):
+        self._root = _PathNode()
+        # unanchored patterns start here, at every level of the document
+        self._floating = _PathNode()
+        self._idle = (self._floating,)
+        self.empty = True
+
+    def add(self, pattern, kind, value=True, subtree=False):
+        """Attach value of kind to the paths matching pattern (and to all
+        paths under them, if subtree is True)."""
+        parts = [part.replace(u"~1", u"/").replace(u"~0", u"~")
+                 for part in pattern.strip(u"/").split(u"/")]
+        if pattern.startswith(u"/"):
+            self._add_parts(self._root, parts, kind, value, subtree)
+        else:
+            self._add_parts(self._floating, parts, kind, value, subtree)
+            if len(parts) > 1:
+                self._add_parts(self._floating, [pattern], kind, value,
+                                subtree)
+        self.empty = False
+
+    def _add_parts(self, node, parts, kind, value, subtree):
+        """add the pattern of keys parts starting at node."""
+        node.below.add(kind)
+        for part in parts:
+            if part == u"*":
+                if node.star is None:
+                    node.star = _PathNode()
+                node = node.star
+            else:
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = _PathNode()
+                    if part.isdigit():
+                        # array indices are ints
+                        node.children[int(part)] = child
+                node = child
+            node.below.add(kind)
+        node.values[kind] = value
+        if subtree:
+            loop = _PathNode()
+            loop.star = loop
+            loop.values[kind] = value
+            loop.below.add(kind)
+            node.subtree = node.subtree + (loop,)
+
+    def start(self):
+        """State at the top of the document."""
+        if self.empty:
+            return None
+        return (self._root, self._floating)
+
+    def step(self, state, key):
+        """State after descending from state into key."""
+        nodes = []
+        for node in state:
+            child = node.children.get(key)
+            if child is not None:
+                nodes.append(child)
+            if node.star is not None:
+                nodes.append(node.star)
+            if node.subtree:
+                nodes.extend(node.subtree)
+        if not nodes:
+            return self._idle
+        nodes.append(self._floating)
+        return tuple(nodes)
+
+    def names_indices(self, state):
+        """Do patterns name particular array indices under state (so that
+        step(state, idx) differs among indices)?"""
+        for node in state:
+            for key in node.children:
+                if isinstance(key, int):
+                    return True
+        return False
+
+    def value(self, state, kind, default=None):
+        """Value of kind attached to the path of state."""
+        if state is not None:
+            for node in state:
+                if kind in node.values:
+                    return node.values[kind]
+        return default
+
+    def reachable(self, state, kind):
+        """Can a value of kind be attached to state or any path under it?"""
+        for node in state:
+            if kind in node.below:
+                return True
+        return False
+
+
+class DiffOptions(object):
+    """
+    Options of Comparator for callers without the command line; keyword
+    arguments are set as attributes named like the dest of the command
+    line options (align_arrays, array_key, max_changes, ...).
+    """
+
+    def __init__(self, exclude=None, include=None, ignore_append=False,
+                 **options):
+        self.exclude = exclude or []
+        self.include = include or []
+        self.ignore_append = ignore_append
+        self.__dict__.update(options)
+
+
 class Comparator(object):
     """
     Main workhorse, the object itself
     """
-    def __init__(self, fn1=None, fn2=None, opts=None):
+    parallel_min_nodes = PARALLEL_MIN_NODES
+
+    def __init__(self, fn1=None, fn2=None, opts=None, hashes=None,
+                 stats=None, tracer=None):
+        # DiffStats instance collecting statistics, None (the default)
+        # costs nothing
+        if stats is None and getattr(opts, "stats", False):
+            stats = DiffStats()
+        self.stats = stats
+        # DiffTracer instance recording the filtering decisions, None
+        # (the default) costs nothing either
+        if tracer is None and getattr(opts, "trace", False):
+            tracer = DiffTracer(sys.stderr)
+        self.tracer = tracer
+        # path of the container being compared, kept only when tracing
+        self._trace_path = ()
+        # are_equal stops the walk at the first reported change
+        self._stop_at_change = False
+        # limits of the work done by compare_dicts, None for no limit
+        self.max_changes = getattr(opts, "max_changes", None)
+        self.max_depth = getattr(opts, "max_depth", None)
+        self.timeout = getattr(opts, "timeout", None)
+        # _Budget of the running compare_dicts, None without limits
+        self._budget = None
+        # compare_patch needs changes to null (not reported in diffs) and
+        # arrays compared index by index
+        self._patch_mode = False
+        # iter_changes collects the old values of updates which are not
+        # at the same key of the old container (in keyed and aligned
+        # arrays) here
+        self._old_values = None
+        if stats is not None:
+            start = time.time()
+        # name of the JSON decoder from DECODERS, None for the default
+        self.decoder = getattr(opts, "decoder", None)
         self.obj1 = None
         self.obj2 = None
         if fn1:
             try:
-                self.obj1 = json.load(fn1)
+                self.obj1 = decode_json(fn1, self.decoder)
             except (TypeError, OverflowError, ValueError), exc:
                 raise BadJSONError("Cannot decode object from JSON.\n%s" %
                                    unicode(exc))
         if fn2:
             try:
-                self.obj2 = json.load(fn2)
+                self.obj2 = decode_json(fn2, self.decoder)
             except (TypeError, OverflowError, ValueError), exc:
                 raise BadJSONError("Cannot decode object from JSON\n%s" %
                                    unicode(exc))
+        if stats is not None and (fn1 or fn2):
+            stats.add_phase(u"parse", time.time() - start)
 
         self.excluded_attributes = []
         self.included_attributes = []
@@ -169,75 +886,204 @@ class Comparator(object):
             self.excluded_attributes = opts.exclude or []
             self.included_attributes = opts.include or []
             self.ignore_appended = opts.ignore_append or False
+        self.align_arrays = getattr(opts, "align_arrays", False)
+        self.align_max_edits = getattr(opts, "align_max_edits",
+                                       ALIGN_MAX_EDITS)
+        self.jobs = getattr(opts, "jobs", 1) or 1
+        # numbers differing by no more than this are equal
+        self.abs_tolerance = getattr(opts, "abs_tolerance", None) or 0.0
+        self.rel_tolerance = getattr(opts, "rel_tolerance", None) or 0.0
+        self._tolerant = bool(self.abs_tolerance or self.rel_tolerance)
+        # -x and -i are checked while walking the documents, so excluded
+        # subtrees are not compared at all
+        self.path_rules = _PathRules()
+        for pattern in self.excluded_attributes:
+            self.path_rules.add(_text(pattern), u"exclude")
+        for pattern in self.included_attributes:
+            self.path_rules.add(_text(pattern), u"include", subtree=True)
+        for rule in getattr(opts, "array_key", None) or []:
+            self.add_array_key(rule)
+        # SubtreeHashes of the items of arrays aligned by -A; None makes
+        # the comparator hash them into a private instance. Subtrees whose
+        # hashes are known already are skipped when equal, they are never
+        # hashed just for that (it costs more than comparing them).
+        self.hashes = hashes
 
-    def _is_incex_key(self, key, value):
-        """Is this key excluded or not among included ones? If yes, it should
-        be ignored."""
-        key_out = ((self.included_attributes and
-                   (key not in self.included_attributes)) or
-                   (key in self.excluded_attributes))
-        value_out = True
-        if isinstance(value, dict):
-            for change_key in value:
-                if isinstance(value[change_key], dict):
-                    for key in value[change_key]:
-                        if ((self.included_attributes and
-                             (key in self.included_attributes)) or
-                           (key not in self.excluded_attributes)):
-                                value_out = False
-        return key_out and value_out
-
-    def _filter_results(self, result):
-        """Whole -i or -x functionality. Rather than complicate logic while
-        going through the object’s tree we filter the result of plain
-        comparison.
-
-        Also clear out unused keys in result"""
-        out_result = {}
-        for change_type in result:
-            temp_dict = {}
-            for key in result[change_type]:
-                logging.debug("change_type = %s", change_type)
-                if self.ignore_appended and (change_type == "_append"):
-                    continue
-                logging.debug("result[change_type] = %s, key = %s",
-                              unicode(result[change_type]), key)
-                logging.debug("self._is_incex_key = %s",
-                              self._is_incex_key(key,
-                                                 result[change_type][key]))
-                if not self._is_incex_key(key, result[change_type][key]):
-                    temp_dict[key] = result[change_type][key]
-            if len(temp_dict) > 0:
-                out_result[change_type] = temp_dict
-
-        return out_result
-
-    def _compare_elements(self, old, new):
-        """Unify decision making on the leaf node level."""
-        res = None
-        # We want to go through the tree post-order
-        if isinstance(old, dict):
-            res_dict = self.compare_dicts(old, new)
-            if (len(res_dict) > 0):
-                res = res_dict
-        # Now we are on the same level
-        # different types, new value is new
-        elif (type(old) != type(new)):
-            res = new
-        # recursive arrays
-        # we can be sure now, that both new and old are
-        # of the same type
-        elif (isinstance(old, list)):
-            res_arr = self._compare_arrays(old, new)
-            if (len(res_arr) > 0):
-                res = res_arr
-        # the only thing remaining are scalars
+    def add_array_key(self, rule):
+        """
+        Match items of arrays by a key field.
+
+        Rule is "path=field", the arrays found at path (see _PathRules) are
+        expected to be lists of objects identified by their field.
+        """
+        rule = _text(rule)
+        if u"=" not in rule:
+            raise ValueError("Array key rule %s is not path=field" % rule)
+        path, field = rule.rsplit(u"=", 1)
+        self.path_rules.add(path, u"array_key", field)
+
+    def _child_state(self, state, key):
+        """State of self.path_rules after descending into key."""
+        if state is None:
+            return None
+        return self.path_rules.step(state, key)
+
+    def _same_subtree(self, old, new):
+        """Are containers old and new known to be equal without walking
+        them, being the same object or having the same hashes computed
+        already (for -A or by index_baseline)?"""
+        if old is new:
+            return True
+        hashes = self.hashes
+        if hashes is None:
+            return False
+        digest = hashes.known(old)
+        return digest is not None and digest == hashes.known(new)
+
+    def _excluded(self, state):
+        """Is the node with state excluded by -x?"""
+        return self.path_rules.value(state, u"exclude", False)
+
+    def _reported(self, state, change_type):
+        """Should a change of change_type at the node with state get into
+        the result? Handles -a and -i, excluded nodes (-x) are not compared
+        at all."""
+        if change_type == u"_append" and self.ignore_appended:
+            return False
+        if not self.included_attributes:
+            return True
+        return self.path_rules.value(state, u"include", False)
+
+    def _report(self, state, key, change_type):
+        """_reported for the node with state at key under the node being
+        compared, recording the decision when tracing."""
+        if self.tracer is None:
+            return self._reported(state, change_type)
+        if self._reported(state, change_type):
+            decision = u"reported"
+        elif change_type == u"_append" and self.ignore_appended:
+            decision = u"ignored"
+        else:
+            decision = u"not_included"
+        if key is _NO_KEY:
+            path = self._trace_path
         else:
-            scalar_diff = self._compare_scalars(old, new)
-            if scalar_diff is not None:
-                res = scalar_diff
+            path = self._trace_path + (key,)
+        self.tracer.record(path, change_type, decision)
+        return decision == u"reported"
 
-        return res
+    def _note_excluded(self, key):
+        """Count (and trace) the subtree at key excluded by -x."""
+        if self.stats is not None:
+            self.stats.skipped += 1
+        if self.tracer is not None:
+            self.tracer.record(self._trace_path + (key,), None, u"excluded")
+
+    def _note_skipped(self, reason):
+        """Count (and trace) the subtree being compared as skipped."""
+        if self.stats is not None:
+            self.stats.skipped += 1
+        if self.tracer is not None:
+            self.tracer.record(self._trace_path, None, reason)
+
+    def _keep_value(self, state, key, change_type):
+        """Should the value at key under the node with state be reported
+        whole as change_type?"""
+        state = self._child_state(state, key)
+        if self._excluded(state):
+            if self.tracer is not None:
+                self._note_excluded(key)
+            return False
+        return self._report(state, key, change_type)
+
+    def _compare_child(self, old, new, state, key):
+        """_compare_elements of the values at key under the node with
+        state."""
+        state = self._child_state(state, key)
+        if self._excluded(state):
+            return None
+        return self._compare_elements(old, new, state)
+
+    def _compare_elements(self, old, new, state=None):
+        """Unify decision making on the leaf node level.
+
+        state is the state of self.path_rules at this node. Nested
+        containers are compared with an explicit stack instead of
+        recursion, so the depth of documents is not limited by the
+        recursion limit.
+        """
+        result = {}
+        pairs = self._expand(old, new, state, result)
+        if pairs is None:
+            # different types, new value is new
+            if ((type(old) != type(new) or
+                 self._compare_scalars(old, new) is not None) and
+                    self._report(state, _NO_KEY, u"_update")):
+                return new
+            return None
+        if result and self._stop_at_change:
+            return result
+
+        # Frames of containers being compared are (result, iterator over
+        # pairs of their nested containers, parent frame, key in parent).
+        # Results are put into the results of their parents as soon as
+        # they get the first change, so there is no need to revisit the
+        # frames after their children are done.
+        stack = [(result, iter(pairs), None, None)]
+        budget = self._budget
+        if budget is not None and not budget.spend(result, stack):
+            del stack[:]
+        stats = self.stats
+        if stats is not None:
+            stats.frames += 1
+        tracer = self.tracer
+        if tracer is not None:
+            # paths of the frames on the stack, for the trace records
+            paths = [self._trace_path]
+        # Most of the nested containers have no changes and no nested
+        # containers of their own, so they are expanded into the same
+        # spare result; a new one is made only when it gets used.
+        spare = {}
+        while stack:
+            frame = stack[-1]
+            for key, old_child, new_child, child_state in frame[1]:
+                if budget is not None and not budget.descend(
+                        len(stack), old_child, new_child):
+                    continue
+                child = spare
+                if tracer is not None:
+                    self._trace_path = paths[-1] + (key,)
+                child_pairs = self._expand(old_child, new_child,
+                                           child_state, child)
+                if child or child_pairs:
+                    spare = {}
+                    child_frame = (child, iter(child_pairs), frame, key)
+                    if stats is not None:
+                        stats.frames += 1
+                if child:
+                    _link_frame(child_frame)
+                    if self._stop_at_change:
+                        # the result is incomplete, but not empty
+                        del stack[:]
+                        break
+                if budget is not None and not budget.spend(child, stack):
+                    del stack[:]
+                    break
+                if stats is not None:
+                    stats.max_depth = max(stats.max_depth, len(stack))
+                if child_pairs:
+                    stack.append(child_frame)
+                    if tracer is not None:
+                        paths.append(self._trace_path)
+                    break
+            else:
+                stack.pop()
+        if tracer is not None:
+            self._trace_path = paths[0]
+
+        if len(result) > 0:
+            return result
+        return None
 
     def _compare_scalars(self, old, new, name=None):
         """
@@ -251,55 +1097,694 @@ class Comparator(object):
         if self._compare_scalars(...) is not None:)
         """
         # Explicitly excluded arguments
-        if old != new:
+        if old != new and not (self._tolerant and self._close(old, new)):
             return new
         else:
             return None
 
-    def _compare_arrays(self, old_arr, new_arr):
+    def _close(self, old, new):
+        """Are old and new numbers of the same type within the tolerance
+        (self.abs_tolerance or self.rel_tolerance of the larger one)?"""
+        if (type(old) != type(new) or type(old) not in (int, long, float)):
+            return False
+        return abs(old - new) <= max(self.abs_tolerance,
+                                     self.rel_tolerance *
+                                     max(abs(old), abs(new)))
+
+    def _expand(self, old, new, state, result):
+        """
+        Compare containers old and new one level deep: put the changes
+        which need no further comparison into result and return the list of
+        (key, old_child, new_child, child_state) for pairs of nested
+        containers which have to be compared. Return None if old and new
+        are not two dicts or two lists.
+
+        As everywhere else, None stands for "no change", so a value
+        changed to null is not reported.
+        """
+        if isinstance(old, dict) and isinstance(new, dict):
+            expand = self._expand_dicts
+        elif isinstance(old, list) and type(old) == type(new):
+            expand = self._expand_arrays
+        else:
+            return None
+        stats = self.stats
+        if old is new or (self.hashes is not None and
+                          self._same_subtree(old, new)):
+            self._note_skipped(u"equal")
+            return []
+        if (self.included_attributes and
+                not self.path_rules.reachable(state, u"include")):
+            # nothing in this subtree could get into the result
+            self._note_skipped(u"not_included")
+            return []
+        if stats is not None:
+            stats.containers += 1
+            stats.members += max(len(old), len(new))
+        return expand(old, new, state, result)
+
+    def _expand_child(self, result, pairs, old, new, state, key):
+        """_expand step for the values at key under the node with state
+        (of keyed and aligned arrays, the other loops have it inlined)."""
+        state = self._child_state(state, key)
+        if self._excluded(state):
+            self._note_excluded(key)
+            return
+        if ((isinstance(old, dict) and isinstance(new, dict)) or
+                (isinstance(old, list) and type(old) == type(new))):
+            pairs.append((key, old, new, state))
+        elif ((new is not None or self._patch_mode) and
+              (type(old) != type(new) or old != new) and
+              not (self._tolerant and self._close(old, new)) and
+              self._report(state, key, u"_update")):
+            result.setdefault(u"_update", {})[key] = new
+            if self._old_values is not None:
+                self._old_values[key] = old
+
+    def _element_key(self, value):
+        """Hashable key identifying value by its content (and type)."""
+        if isinstance(value, (dict, list)):
+            if self.hashes is None:
+                self.hashes = SubtreeHashes()
+            return (u"#", self.hashes.digest(value))
+        return (type(value), value)
+
+    def _align_arrays(self, old_arr, new_arr, state, result):
+        """
+        Compare arrays by aligning their items (Myers' diff over the hashes
+        of items) instead of by their indices, _expand style.
+
+        _remove is keyed by the old index and _append by the new one,
+        _move maps old indices of items which changed their position to the
+        new ones and items changed in place are in _update under their new
+        index. Return None if the arrays are too different to be aligned
+        within self.align_max_edits edits.
+        """
+        old_keys = [self._element_key(item) for item in old_arr]
+        new_keys = [self._element_key(item) for item in new_arr]
+
+        # common prefix and suffix do not need to go through Myers
+        start = 0
+        limit = min(len(old_keys), len(new_keys))
+        while start < limit and old_keys[start] == new_keys[start]:
+            start += 1
+        old_end = len(old_keys)
+        new_end = len(new_keys)
+        while (old_end > start and new_end > start and
+               old_keys[old_end - 1] == new_keys[new_end - 1]):
+            old_end -= 1
+            new_end -= 1
+
+        matches = _shortest_edit_matches(old_keys[start:old_end],
+                                         new_keys[start:new_end],
+                                         self.align_max_edits)
+        if matches is None:
+            return None
+
+        # hunks of removed and inserted items between the kept ones
+        hunks = []
+        prev_old = prev_new = start - 1
+        for old_idx, new_idx in ([(i + start, j + start) for i, j in matches] +
+                                 [(old_end, new_end)]):
+            if old_idx > prev_old + 1 or new_idx > prev_new + 1:
+                hunks.append((range(prev_old + 1, old_idx),
+                              range(prev_new + 1, new_idx)))
+            prev_old = old_idx
+            prev_new = new_idx
+
+        # equal items removed at one place and inserted at another
+        inserted = {}
+        for removed_idxs, inserted_idxs in hunks:
+            for new_idx in inserted_idxs:
+                inserted.setdefault(new_keys[new_idx], []).append(new_idx)
+        for positions in inserted.values():
+            positions.reverse()
+        moved = set()
+        moved_from = set()
+        for removed_idxs, inserted_idxs in hunks:
+            for old_idx in removed_idxs:
+                positions = inserted.get(old_keys[old_idx])
+                if positions:
+                    new_idx = positions.pop()
+                    moved.add(new_idx)
+                    moved_from.add(old_idx)
+                    if self._keep_value(state, new_idx, u"_move"):
+                        result.setdefault(u'_move', {})[old_idx] = new_idx
+
+        # the rest of a hunk is changed in place as far as it goes
+        pairs = []
+        for removed_idxs, inserted_idxs in hunks:
+            removed_idxs = [idx for idx in removed_idxs
+                            if idx not in moved_from]
+            inserted_idxs = [idx for idx in inserted_idxs if idx not in moved]
+            paired = min(len(removed_idxs), len(inserted_idxs))
+            for idx in range(paired):
+                new_idx = inserted_idxs[idx]
+                self._expand_child(result, pairs, old_arr[removed_idxs[idx]],
+                                   new_arr[new_idx], state, new_idx)
+            for old_idx in removed_idxs[paired:]:
+                if self._keep_value(state, old_idx, u"_remove"):
+                    result.setdefault(u'_remove', {})[old_idx] = \
+                        old_arr[old_idx]
+            for new_idx in inserted_idxs[paired:]:
+                if self._keep_value(state, new_idx, u"_append"):
+                    result.setdefault(u'_append', {})[new_idx] = \
+                        new_arr[new_idx]
+
+        return pairs
+
+    def _match_keyed_arrays(self, old_arr, new_arr, field, state, result):
+        """
+        Compare arrays of objects identified by their field, _expand style;
+        changes are keyed by the values of field. Return None when some
+        item is not an object with a unique field, such arrays are compared
+        index by index.
         """
-        simpler version of compare_dicts; just an internal method, because
-        it could never be called from outside.
+        indexes = []
+        for arr in (old_arr, new_arr):
+            index = {}
+            for item in arr:
+                if not isinstance(item, dict) or field not in item:
+                    return None
+                key = item[field]
+                if isinstance(key, (dict, list)) or key in index:
+                    return None
+                index[key] = item
+            indexes.append(index)
+        old_index, new_index = indexes
 
-        We have it guaranteed that both new_arr and old_arr are of type list.
+        pairs = []
+        for key in old_index:
+            if key not in new_index:
+                if self._keep_value(state, key, u"_remove"):
+                    result.setdefault(u'_remove', {})[key] = old_index[key]
+                continue
+            self._expand_child(result, pairs, old_index[key], new_index[key],
+                               state, key)
+        for key in new_index:
+            if key not in old_index and self._keep_value(state, key,
+                                                         u"_append"):
+                result.setdefault(u'_append', {})[key] = new_index[key]
+        return pairs
+
+    def _expand_arrays(self, old_arr, new_arr, state, result):
+        """
+        _expand of two lists, simpler version of _expand_dicts.
         """
+        if self._patch_mode:
+            # patches address array items by their positions
+            field = None
+        else:
+            field = self.path_rules.value(state, u"array_key")
+        if field is not None:
+            pairs = self._match_keyed_arrays(old_arr, new_arr, field, state,
+                                             result)
+            if pairs is not None:
+                return pairs
+        if self.align_arrays and not self._patch_mode:
+            pairs = self._align_arrays(old_arr, new_arr, state, result)
+            if pairs is not None:
+                return pairs
+
         inters = min(len(old_arr), len(new_arr))  # this is the smaller length
 
-        result = {
-            u"_append": {},
-            u"_remove": {},
-            u"_update": {}
-        }
+        pairs = []
+        updated = None
+        if (numpy is not None and inters >= VECTOR_MIN_ITEMS and
+                self.tracer is None):
+            updated = self._compare_vectors(old_arr, new_arr, inters, state)
+            if updated is not None:
+                if updated:
+                    result[u'_update'] = updated
+                # only the scalars at the same indices are done
+                inters = 0
         for idx in range(inters):
-            res = self._compare_elements(old_arr[idx], new_arr[idx])
-            if res is not None:
-                result[u'_update'][idx] = res
+            # inlined _expand_child, this loop is hot
+            if state is not None:
+                child_state = self.path_rules.step(state, idx)
+                if self._excluded(child_state):
+                    self._note_excluded(idx)
+                    continue
+            else:
+                child_state = None
+            old = old_arr[idx]
+            new = new_arr[idx]
+            if ((isinstance(old, dict) and isinstance(new, dict)) or
+                    (isinstance(old, list) and type(old) == type(new))):
+                pairs.append((idx, old, new, child_state))
+            elif ((new is not None or self._patch_mode) and
+                  (type(old) != type(new) or old != new) and
+                  not (self._tolerant and self._close(old, new)) and
+                  self._report(child_state, idx, u"_update")):
+                if updated is None:
+                    updated = result[u'_update'] = {}
+                updated[idx] = new
 
         # the rest of the larger array
+        inters = min(len(old_arr), len(new_arr))
         if (inters == len(old_arr)):
             for idx in range(inters, len(new_arr)):
-                result[u'_append'][idx] = new_arr[idx]
+                if self._keep_value(state, idx, u"_append"):
+                    result.setdefault(u'_append', {})[idx] = new_arr[idx]
         else:
             for idx in range(inters, len(old_arr)):
-                result[u'_remove'][idx] = old_arr[idx]
+                if self._keep_value(state, idx, u"_remove"):
+                    result.setdefault(u'_remove', {})[idx] = old_arr[idx]
 
-        # Clear out unused keys in result
-        out_result = {}
-        for key in result:
-            if len(result[key]) > 0:
-                out_result[key] = result[key]
+        return pairs
 
-        return self._filter_results(result)
+    def _compare_vectors(self, old_arr, new_arr, inters, state):
+        """
+        Compare the first inters items of arrays of numbers by numpy;
+        return _update of the changed ones, or None if the arrays are not
+        numbers of one type (int or float) or their items are not treated
+        the same way by the path rules.
+        """
+        if state is None:
+            child_state = None
+        elif self.path_rules.names_indices(state):
+            return None
+        else:
+            child_state = self.path_rules.step(state, None)
+            if self._excluded(child_state):
+                return None
+        old_types = set(map(type, old_arr[:inters]))
+        if (len(old_types) != 1 or
+                old_types != set(map(type, new_arr[:inters]))):
+            return None
+        item_type = old_types.pop()
+        if item_type is int:
+            dtype = numpy.int64
+        elif item_type is float:
+            dtype = numpy.float64
+        else:
+            return None
+        old_vec = numpy.array(old_arr[:inters], dtype)
+        new_vec = numpy.array(new_arr[:inters], dtype)
+        changed = old_vec != new_vec
+        if self._tolerant:
+            # int64 could overflow in the subtraction
+            old_vec = old_vec.astype(numpy.float64)
+            new_vec = new_vec.astype(numpy.float64)
+            # nan and inf are never close, as in _close
+            errors = numpy.seterr(invalid="ignore")
+            try:
+                limit = numpy.maximum(
+                    self.abs_tolerance,
+                    self.rel_tolerance * numpy.maximum(numpy.abs(old_vec),
+                                                       numpy.abs(new_vec)))
+                changed &= ~(numpy.abs(old_vec - new_vec) <= limit)
+            finally:
+                numpy.seterr(**errors)
+        updated = {}
+        indices = numpy.nonzero(changed)[0].tolist()
+        if indices and self._reported(child_state, u"_update"):
+            for idx in indices:
+                updated[idx] = new_arr[idx]
+        return updated
 
     def compare_dicts(self, old_obj=None, new_obj=None):
         """
         The real workhorse
+
+        When the comparison hits one of the limits (opts.max_changes,
+        max_depth or timeout), the result is partial and its _truncated
+        key holds the limits hit, the number of changes found and of the
+        containers left out.
+        """
+        # Nested empty dicts are valid input, only a missing argument
+        # means "compare the loaded documents".
+        if old_obj is None and hasattr(self, "obj1"):
+            old_obj = self.obj1
+        if new_obj is None and hasattr(self, "obj2"):
+            new_obj = self.obj2
+        if self.stats is not None:
+            start = time.time()
+        if (self.max_changes is not None or self.max_depth is not None or
+                self.timeout is not None):
+            self._budget = _Budget(self.max_changes, self.max_depth,
+                                   self.timeout)
+        if (self.jobs > 1 and multiprocessing is not None and
+                hasattr(os, "fork") and self.tracer is None and
+                self._budget is None and
+                isinstance(old_obj, dict) and isinstance(new_obj, dict) and
+                _count_nodes(old_obj, self.parallel_min_nodes) >=
+                self.parallel_min_nodes):
+            result = self._compare_parallel(old_obj, new_obj)
+        else:
+            try:
+                result = self._compare_dicts(old_obj, new_obj,
+                                             self.path_rules.start())
+            finally:
+                budget = self._budget
+                self._budget = None
+            if budget is not None and budget.limits:
+                result[u"_truncated"] = budget.summary()
+        if self.stats is not None:
+            self.stats.add_phase(u"compare", time.time() - start)
+            self.stats.count_result(result)
+        return result
+
+    def are_equal(self, old_obj=None, new_obj=None):
+        """
+        Would compare_dicts return an empty diff? The walk stops at the
+        first change which gets into the result (after the end of the
+        container where it is found), so different documents are not
+        walked whole.
+        """
+        if old_obj is None and hasattr(self, "obj1"):
+            old_obj = self.obj1
+        if new_obj is None and hasattr(self, "obj2"):
+            new_obj = self.obj2
+        if old_obj is new_obj:
+            return True
+        if self.stats is not None:
+            start = time.time()
+        self._stop_at_change = True
+        try:
+            result = self._compare_elements(old_obj, new_obj,
+                                            self.path_rules.start())
+        finally:
+            self._stop_at_change = False
+        if self.stats is not None:
+            self.stats.add_phase(u"compare", time.time() - start)
+        return result is None
+
+    def compare_patch(self, old_obj=None, new_obj=None):
+        """
+        Changes between old_obj and new_obj (the loaded documents by
+        default) as RFC 6902 JSON Patch, a list of operations which
+        apply_patch can replay on old_obj. Unlike compare_dicts, changes
+        to null are included and arrays are always compared index by
+        index (-A and -k are ignored). Filters and limits apply, patches
+        of partial diffs are partial too.
+        """
+        if old_obj is None and hasattr(self, "obj1"):
+            old_obj = self.obj1
+        if new_obj is None and hasattr(self, "obj2"):
+            new_obj = self.obj2
+        self._patch_mode = True
+        try:
+            diff = self.compare_dicts(old_obj, new_obj)
+        finally:
+            self._patch_mode = False
+        return diff_to_patch(diff, old_obj, new_obj)
+
+    def iter_changes(self, old_obj=None, new_obj=None):
+        """
+        Generate the changes between old_obj and new_obj (the loaded
+        documents by default) as they are found, so the consumer can
+        stop the comparison whenever it has enough of them.
+
+        Changes are (path, change_type, old, new) tuples: path is the
+        tuple of keys from the root to the changed value (keyed the same
+        way as in compare_dicts), change_type one of _update, _remove,
+        _append and _move, and old and new are the values before and
+        after the change (None where there is none; old and new index
+        for _move). Filters apply as in compare_dicts, the limits
+        (max_changes, max_depth and timeout) do not. Changes of a
+        container come before the changes nested in it.
         """
-        if not old_obj and hasattr(self, "obj1"):
+        if old_obj is None and hasattr(self, "obj1"):
             old_obj = self.obj1
-        if not new_obj and hasattr(self, "obj2"):
+        if new_obj is None and hasattr(self, "obj2"):
             new_obj = self.obj2
+        return self._iter_changes(old_obj, new_obj, self.path_rules.start(),
+                                  ())
+
+    def iter_record_changes(self, old_records, new_records):
+        """
+        Generate the changes (as iter_changes does) between two streams
+        of records, iterables of (key, JSON text of record) pairs sorted
+        by unique keys (see iter_records and sort_records). The streams
+        are matched by a merge join, so only the current record of each
+        is held; paths of the changes start with the key of their
+        record. Records with the same text are not decoded at all.
+        """
+        state = self.path_rules.start()
+        old_records = _unique_sorted(old_records)
+        new_records = _unique_sorted(new_records)
+        old_item = _next_item(old_records)
+        new_item = _next_item(new_records)
+        while old_item is not None or new_item is not None:
+            if new_item is None or (old_item is not None and
+                                    old_item[0] < new_item[0]):
+                key, text = old_item
+                if self._keep_value(state, key, u"_remove"):
+                    yield ((key,), u"_remove",
+                           decode_buffer(text, self.decoder), None)
+                old_item = _next_item(old_records)
+            elif old_item is None or new_item[0] < old_item[0]:
+                key, text = new_item
+                if self._keep_value(state, key, u"_append"):
+                    yield ((key,), u"_append", None,
+                           decode_buffer(text, self.decoder))
+                new_item = _next_item(new_records)
+            else:
+                key = old_item[0]
+                child_state = self._child_state(state, key)
+                if self._excluded(child_state):
+                    self._note_excluded(key)
+                elif old_item[1] != new_item[1]:
+                    for change in self._iter_changes(
+                            decode_buffer(old_item[1], self.decoder),
+                            decode_buffer(new_item[1], self.decoder),
+                            child_state, (key,)):
+                        yield change
+                old_item = _next_item(old_records)
+                new_item = _next_item(new_records)
+
+    def _iter_changes(self, old_obj, new_obj, state, path):
+        """iter_changes of the values at path, at the node with
+        path_rules state."""
+        pairs, changes = self._expand_changes(path, old_obj, new_obj, state)
+        if pairs is None:
+            # different types, new value is new
+            if path:
+                key = path[-1]
+            else:
+                key = _NO_KEY
+            if ((type(old_obj) != type(new_obj) or
+                 self._compare_scalars(old_obj, new_obj) is not None) and
+                    self._report(state, key, u"_update")):
+                yield path, u"_update", old_obj, new_obj
+            return
+        for change in changes:
+            yield change
+
+        # same walk as in _compare_elements, there are no results to link
+        stack = [(path, iter(pairs))]
+        while stack:
+            path, pairs = stack[-1]
+            for key, old_child, new_child, child_state in pairs:
+                child_path = path + (key,)
+                child_pairs, changes = self._expand_changes(
+                    child_path, old_child, new_child, child_state)
+                for change in changes:
+                    yield change
+                if child_pairs:
+                    stack.append((child_path, iter(child_pairs)))
+                    break
+            else:
+                stack.pop()
+
+    def _expand_changes(self, path, old, new, state):
+        """_expand of containers old and new at path for iter_changes:
+        return the pairs of nested containers and the list of changes."""
+        result = {}
+        trace_path = self._trace_path
+        if self.tracer is not None:
+            self._trace_path = trace_path + path
+        old_values = self._old_values = {}
+        try:
+            pairs = self._expand(old, new, state, result)
+        finally:
+            self._old_values = None
+            self._trace_path = trace_path
+        changes = []
+        for key, value in result.get(u"_update", {}).iteritems():
+            if key in old_values:
+                old_value = old_values[key]
+            else:
+                old_value = old[key]
+            changes.append((path + (key,), u"_update", old_value, value))
+        for key, value in result.get(u"_remove", {}).iteritems():
+            changes.append((path + (key,), u"_remove", value, None))
+        for key, value in result.get(u"_append", {}).iteritems():
+            changes.append((path + (key,), u"_append", None, value))
+        for old_idx, new_idx in result.get(u"_move", {}).iteritems():
+            changes.append((path + (old_idx,), u"_move", old_idx, new_idx))
+        return pairs, changes
+
+    def index_baseline(self):
+        """
+        Compute what comparisons with self.obj1 (the baseline) need to
+        know about it: hashes of its containers, by which -A aligns
+        array items. Return the SubtreeHashes to be shared read-only by
+        the comparisons (see compare_many), or None without -A.
+        """
+        if not self.align_arrays or not isinstance(self.obj1, (dict, list)):
+            return None
+        if self.hashes is None:
+            self.hashes = SubtreeHashes()
+        self.hashes.digest(self.obj1)
+        return self.hashes
+
+    def compare_many(self, candidates):
+        """
+        Compare self.obj1 (the baseline) with every document of iterable
+        candidates, generating compare_dicts results in the same order.
+        The baseline is decoded and indexed (see index_baseline) only
+        once; hashes of each candidate go to an overlay of the index,
+        which is forgotten after its comparison.
+        """
+        index = self.index_baseline()
+        for candidate in candidates:
+            if index is None:
+                yield self.compare_dicts(self.obj1, candidate)
+                continue
+            self.hashes = SubtreeHashes(index)
+            try:
+                diff = self.compare_dicts(self.obj1, candidate)
+            finally:
+                self.hashes = index
+            yield diff
+
+    def _split_part(self, part):
+        """
+        Turn "compare" part of two dicts or two arrays into the parent
+        of smaller parts, or return False if it cannot be split. Values
+        which are cheap to compare are compared right away.
+        """
+        old, new, state = part.old, part.new, part.state
+        if (self._same_subtree(old, new) or
+                (self.included_attributes and
+                 not self.path_rules.reachable(state, u"include"))):
+            return False
+        result = {}
+        children = {}
+        if isinstance(old, dict) and isinstance(new, dict):
+            for name, old_child, new_child, child_state in \
+                    self._expand_dicts(old, new, state, result):
+                children[name] = _ParallelPart(u"compare", old_child,
+                                               new_child, child_state)
+            part.kind = u"dict"
+        elif (isinstance(old, list) and isinstance(new, list) and
+              not self.align_arrays and
+              self.path_rules.value(state, u"array_key") is None):
+            inters = min(len(old), len(new))
+            if inters < 2:
+                return False
+            for idx in range(inters, len(new)):
+                if self._keep_value(state, idx, u"_append"):
+                    result.setdefault(u'_append', {})[idx] = new[idx]
+            for idx in range(inters, len(old)):
+                if self._keep_value(state, idx, u"_remove"):
+                    result.setdefault(u'_remove', {})[idx] = old[idx]
+            step = max(1, inters // (self.jobs * PARALLEL_PARTS_PER_JOB))
+            for start in range(0, inters, step):
+                children[start] = _ParallelPart(u"slice", old, new, state,
+                                                start,
+                                                min(start + step, inters))
+            part.kind = u"list"
+        else:
+            return False
+        part.partial = result
+        part.children = children
+        return True
+
+    def _plan_parallel(self, old_obj, new_obj):
+        """
+        Split comparison of old_obj and new_obj into parts for workers,
+        always splitting the biggest part, until there are enough of
+        them. Return the root part and the list of leaf parts.
+        """
+        root = _ParallelPart(u"compare", old_obj, new_obj,
+                             self.path_rules.start())
+        wanted = self.jobs * PARALLEL_PARTS_PER_JOB
+        heap = [(-root.weight(), 0, root)]
+        count = 1
+        leaves = 1
+        while heap and leaves < wanted:
+            part = heappop(heap)[2]
+            if part.kind != u"compare" or not self._split_part(part):
+                continue
+            leaves += len(part.children) - 1
+            for child in part.children.values():
+                if child.kind == u"compare":
+                    heappush(heap, (-child.weight(), count, child))
+                    count += 1
+
+        leaf_list = []
+        stack = [root]
+        while stack:
+            part = stack.pop()
+            if part.children is None:
+                part.index = len(leaf_list)
+                leaf_list.append(part)
+            else:
+                stack.extend(part.children.values())
+        return root, leaf_list
+
+    def _assemble_parallel(self, part, results):
+        """Merge results of the leaves under part like the serial
+        comparison would; return the diff of part or None."""
+        if part.children is None:
+            res = results[part.index]
+            if part.kind == u"slice":
+                return res
+        else:
+            res = part.partial
+            for key, child in part.children.items():
+                child_res = self._assemble_parallel(child, results)
+                if part.kind == u"list":
+                    if child_res:
+                        res.setdefault(u'_update', {}).update(child_res)
+                elif child_res is not None:
+                    res.setdefault(u'_update', {})[key] = child_res
+        if res is not None and len(res) == 0:
+            return None
+        return res
+
+    def _compare_parallel(self, old_obj, new_obj):
+        """compare_dicts split among self.jobs worker processes."""
+        root, leaves = self._plan_parallel(old_obj, new_obj)
+        results = [None] * len(leaves)
+        # collections in this process would touch the shared pages too
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            # the job goes to the workers through the initializer, so
+            # comparisons running in other threads cannot replace it
+            pool = multiprocessing.Pool(self.jobs, _init_parallel_worker,
+                                        ((self, leaves),))
+            try:
+                chunk = max(1, len(leaves) // (self.jobs *
+                                               PARALLEL_PARTS_PER_JOB))
+                for index, res in pool.imap_unordered(_run_parallel_part,
+                                                      range(len(leaves)),
+                                                      chunk):
+                    results[index] = res
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        res = self._assemble_parallel(root, results)
+        if res is None:
+            return {}
+        return res
+
+    def _compare_dicts(self, old_obj, new_obj, state):
+        """compare_dicts of objects at the node with path_rules state."""
+        result = self._compare_elements(old_obj, new_obj, state)
+        if result is None:
+            return {}
+        return result
 
+    def _expand_dicts(self, old_obj, new_obj, state, result):
+        """_expand of two dicts."""
         old_keys = set()
         new_keys = set()
         if old_obj and len(old_obj) > 0:
@@ -309,29 +1794,1905 @@ class Comparator(object):
 
         keys = old_keys | new_keys
 
-        result = {
-            "_append": {},
-            "_remove": {},
-            "_update": {}
-        }
+        pairs = []
+        updated = None
         for name in keys:
+            # inlined _expand_child, this loop is hot
+            if state is not None:
+                child_state = self.path_rules.step(state, name)
+                if self._excluded(child_state):
+                    self._note_excluded(name)
+                    continue
+            else:
+                child_state = None
             # old_obj is missing
             if name not in old_obj:
-                result[u'_append'][name] = new_obj[name]
+                if self._report(child_state, name, u"_append"):
+                    result.setdefault(u'_append', {})[name] = new_obj[name]
             # new_obj is missing
             elif name not in new_obj:
-                result[u'_remove'][name] = old_obj[name]
+                if self._report(child_state, name, u"_remove"):
+                    result.setdefault(u'_remove', {})[name] = old_obj[name]
             else:
-                res = self._compare_elements(old_obj[name], new_obj[name])
+                old = old_obj[name]
+                new = new_obj[name]
+                if ((isinstance(old, dict) and isinstance(new, dict)) or
+                        (isinstance(old, list) and type(old) == type(new))):
+                    pairs.append((name, old, new, child_state))
+                elif ((new is not None or self._patch_mode) and
+                      (type(old) != type(new) or old != new) and
+                      not (self._tolerant and self._close(old, new)) and
+                      self._report(child_state, name, u"_update")):
+                    if updated is None:
+                        updated = result[u'_update'] = {}
+                    updated[name] = new
+
+        return pairs
+
+
+class _ParallelPart(object):
+    """
+    Part of the comparison planned by Comparator._plan_parallel.
+
+    A part is either a leaf to be compared by a worker ("compare" for
+    a pair of values, "slice" for a range of indices of two arrays), or
+    a pair of dicts or arrays which has been split: its cheap changes are
+    already in partial and the rest is left to its children.
+    """
+    __slots__ = ("kind", "old", "new", "state", "start", "end", "index",
+                 "partial", "children")
+
+    def __init__(self, kind, old, new, state, start=0, end=0):
+        self.kind = kind
+        self.old = old
+        self.new = new
+        self.state = state
+        self.start = start
+        self.end = end
+        self.index = None
+        self.partial = None
+        self.children = None
+
+    def weight(self):
+        """Rough size of the part, len() is all we can afford here."""
+        if self.kind == u"slice":
+            return self.end - self.start
+        return len(self.old) + len(self.new)
+
+
+class _Budget(object):
+    """
+    Limits of the work done by one Comparator.compare_dicts, checked by
+    Comparator._compare_elements after each container it compares (so
+    they can be exceeded by the changes found in the last one).
+    """
+
+    def __init__(self, max_changes=None, max_depth=None, timeout=None):
+        self.max_changes = max_changes
+        self.max_depth = max_depth
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        # changes found so far, containers left out, limits hit
+        self.changes = 0
+        self.skipped = 0
+        self.limits = []
+
+    def _hit(self, limit):
+        if limit not in self.limits:
+            self.limits.append(limit)
+
+    def descend(self, depth, old, new):
+        """Can the containers old and new at depth be compared?"""
+        if self.max_depth is None or depth <= self.max_depth:
+            return True
+        # comparing them for equality would walk the whole subtrees the
+        # limit is there to skip, only the very same ones are not counted
+        if old is not new:
+            self.skipped += 1
+            self._hit(u"max_depth")
+        return False
+
+    def spend(self, result, stack):
+        """
+        Count the changes in result of a container just compared. Return
+        False if the comparison should stop, counting the containers on
+        the stack of Comparator._compare_elements left out.
+        """
+        for change_type in result:
+            self.changes += len(result[change_type])
+        if self.max_changes is not None and self.changes >= self.max_changes:
+            self._hit(u"max_changes")
+        elif self.deadline is not None and time.time() > self.deadline:
+            self._hit(u"timeout")
+        else:
+            return True
+        if stack:
+            for frame in stack:
+                self.skipped += len(list(frame[1]))
+        return False
+
+    def summary(self):
+        """Value of the _truncated key of the result."""
+        return {u"limits": self.limits, u"changes": self.changes,
+                u"skipped": self.skipped}
+
+
+# (comparator, leaf parts) of the parallel comparison of a worker process,
+# set by _init_parallel_worker; forked workers inherit it from the parent
+# process, so the documents are never pickled
+_parallel_job = None
+
+
+def _link_frame(frame):
+    """Put the (just changed) result of frame of Comparator._compare_elements
+    into the result of its parent frame, and the parent into its own parent
+    if it had no changes before, and so on."""
+    result, pairs, parent, key = frame
+    while parent is not None:
+        parent_result = parent[0]
+        was_empty = len(parent_result) == 0
+        parent_result.setdefault(u'_update', {})[key] = result
+        if not was_empty:
+            break
+        result, pairs, parent, key = parent
+
+
+def _init_parallel_worker(job=None):
+    """Keep the garbage collector from walking (and so copying) all
+    the objects a worker shares with its parent, and make job (if
+    given) the _parallel_job of the worker."""
+    global _parallel_job
+    # the parent disables it around the fork already, but be sure
+    gc.disable()
+    if job is not None:
+        _parallel_job = job
+
+
+def _run_parallel_part(index):
+    """Compare one leaf part in a worker process."""
+    comparator, leaves = _parallel_job
+    part = leaves[index]
+    if part.kind == u"compare":
+        return index, comparator._compare_elements(part.old, part.new,
+                                                   part.state)
+    updates = {}
+    for idx in xrange(part.start, part.end):
+        res = comparator._compare_child(part.old[idx], part.new[idx],
+                                        part.state, idx)
+        if res is not None:
+            updates[idx] = res
+    return index, updates
+
+
+def _count_nodes(value, limit):
+    """Number of values in value, counting stops at limit."""
+    count = 0
+    stack = [value]
+    while stack and count < limit:
+        value = stack.pop()
+        count += 1
+        if isinstance(value, dict):
+            stack.extend(value.itervalues())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return count
+
+
+# Parse events produced by iter_json_events()
+START_MAP = "start_map"
+MAP_KEY = "map_key"
+END_MAP = "end_map"
+START_ARRAY = "start_array"
+END_ARRAY = "end_array"
+VALUE = "value"
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = re.compile(r'(-?(?:0|[1-9]\d*))(\.\d+)?([eE][-+]?\d+)?')
+_LITERALS = ((u"true", True), (u"false", False), (u"null", None))
+_scanstring = json.decoder.scanstring
+
+# States of the event parser
+(_EXPECT_VALUE, _EXPECT_VALUE_OR_END, _EXPECT_KEY, _EXPECT_KEY_OR_END,
+ _EXPECT_COLON, _EXPECT_COMMA_OR_END, _EXPECT_NOTHING) = range(7)
+
+
+def _text_chunks(fileobj, size):
+    """Read fileobj in chunks of size, decoding UTF-8 on the fly.
+
+    Multibyte sequences split between two reads are carried over to the
+    next chunk. File objects which already return unicode are passed
+    through untouched.
+    """
+    pending = ""
+    while True:
+        data = fileobj.read(size)
+        if not data:
+            if pending:
+                # raises UnicodeDecodeError for the truncated sequence
+                codecs.utf_8_decode(pending, "strict", True)
+            return
+        if isinstance(data, unicode):
+            yield data
+            continue
+        data = pending + data
+        text, used = codecs.utf_8_decode(data, "strict", False)
+        pending = data[used:]
+        if text:
+            yield text
+
+
+def iter_json_events(fileobj, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Incrementally parse JSON document from fileobj.
+
+    Generates (event, value) pairs, where event is one of START_MAP,
+    MAP_KEY, END_MAP, START_ARRAY, END_ARRAY and VALUE, and value is
+    the key for MAP_KEY, the scalar for VALUE and None otherwise.
+    Only chunk_size characters (plus the token currently being read)
+    are held in memory. Malformed input raises BadJSONError.
+    """
+    chunks = _text_chunks(fileobj, chunk_size)
+    buf = u""
+    pos = 0
+    eof = False
+    # When a token is cut by the end of the buffer we have to read more
+    # and parse it again; wanted grows so that very long tokens are
+    # rescanned only a logarithmic number of times.
+    wanted = 0
+    stack = []
+    state = _EXPECT_VALUE
+
+    while True:
+        pos = _WHITESPACE.match(buf, pos).end()
+        if wanted or pos == len(buf):
+            if eof:
+                if wanted:
+                    raise BadJSONError("Unterminated token at the end " +
+                                       "of JSON input")
+                break
+            buf = buf[pos:]
+            pos = 0
+            wanted = max(wanted, 1)
+            while wanted > 0:
+                try:
+                    chunk = chunks.next()
+                except StopIteration:
+                    eof = True
+                    break
+                buf += chunk
+                wanted -= len(chunk)
+            wanted = 0
+            continue
+
+        char = buf[pos]
+        if state == _EXPECT_NOTHING:
+            raise BadJSONError("Extra data after the JSON object")
+
+        if char == u'"':
+            if state not in (_EXPECT_VALUE, _EXPECT_VALUE_OR_END,
+                             _EXPECT_KEY, _EXPECT_KEY_OR_END):
+                raise BadJSONError("Unexpected string in JSON input")
+            try:
+                text, end = _scanstring(buf, pos + 1)
+            except ValueError:
+                if eof:
+                    raise
+                wanted = len(buf) - pos
+                continue
+            pos = end
+            if state in (_EXPECT_KEY, _EXPECT_KEY_OR_END):
+                yield MAP_KEY, text
+                state = _EXPECT_COLON
+                continue
+            yield VALUE, text
+
+        elif char == u'{' or char == u'[':
+            if state not in (_EXPECT_VALUE, _EXPECT_VALUE_OR_END):
+                raise BadJSONError("Unexpected %s in JSON input" % char)
+            pos += 1
+            stack.append(char)
+            if char == u'{':
+                yield START_MAP, None
+                state = _EXPECT_KEY_OR_END
+            else:
+                yield START_ARRAY, None
+                state = _EXPECT_VALUE_OR_END
+            continue
+
+        elif char == u'}' or char == u']':
+            opening = {u'}': u'{', u']': u'['}[char]
+            if not ((state == _EXPECT_KEY_OR_END and char == u'}') or
+                    (state == _EXPECT_VALUE_OR_END and char == u']') or
+                    (state == _EXPECT_COMMA_OR_END and stack[-1] == opening)):
+                raise BadJSONError("Unexpected %s in JSON input" % char)
+            pos += 1
+            stack.pop()
+            if char == u'}':
+                yield END_MAP, None
+            else:
+                yield END_ARRAY, None
+
+        elif char == u':':
+            if state != _EXPECT_COLON:
+                raise BadJSONError("Unexpected : in JSON input")
+            pos += 1
+            state = _EXPECT_VALUE
+            continue
+
+        elif char == u',':
+            if state != _EXPECT_COMMA_OR_END:
+                raise BadJSONError("Unexpected , in JSON input")
+            pos += 1
+            if stack[-1] == u'{':
+                state = _EXPECT_KEY
+            else:
+                state = _EXPECT_VALUE
+            continue
+
+        elif state in (_EXPECT_VALUE, _EXPECT_VALUE_OR_END):
+            match = _NUMBER.match(buf, pos)
+            if match:
+                # "1." or "1e+" might continue in the next chunk
+                if match.end() + 2 >= len(buf) and not eof:
+                    wanted = 1
+                    continue
+                integer, frac, exp = match.groups()
+                if frac or exp:
+                    value = float(match.group())
+                else:
+                    value = int(integer)
+                pos = match.end()
+                yield VALUE, value
+            else:
+                if len(buf) - pos < 5 and not eof:
+                    wanted = 1
+                    continue
+                for word, value in _LITERALS:
+                    if buf.startswith(word, pos):
+                        pos += len(word)
+                        yield VALUE, value
+                        break
+                else:
+                    raise BadJSONError("Unexpected %s in JSON input" %
+                                       repr(buf[pos:pos + 10]))
+
+        else:
+            raise BadJSONError("Unexpected %s in JSON input" %
+                               repr(buf[pos:pos + 10]))
+
+        # a complete value has been read
+        if stack:
+            state = _EXPECT_COMMA_OR_END
+        else:
+            state = _EXPECT_NOTHING
+
+    if state != _EXPECT_NOTHING:
+        if stack or state != _EXPECT_VALUE:
+            raise BadJSONError("Unexpected end of JSON input")
+        raise BadJSONError("No JSON object could be decoded")
+
+
+def _build_value(events, event, value):
+    """Build a Python object from events, event and value being the first
+    pair of it (already read from the stream)."""
+    if event == VALUE:
+        return value
+    if event == START_MAP:
+        root = {}
+    else:
+        root = []
+    stack = [root]
+    keys = [None]
+    for event, value in events:
+        if event == MAP_KEY:
+            keys[-1] = value
+            continue
+        if event == END_MAP or event == END_ARRAY:
+            stack.pop()
+            keys.pop()
+            if not stack:
+                return root
+            continue
+
+        if event == VALUE:
+            item = value
+        elif event == START_MAP:
+            item = {}
+        else:
+            item = []
+        container = stack[-1]
+        if isinstance(container, dict):
+            container[keys[-1]] = item
+        else:
+            container.append(item)
+        if event != VALUE:
+            stack.append(item)
+            keys.append(None)
+    raise BadJSONError("Unexpected end of JSON input")
+
+
+def _skip_value(events, event):
+    """Throw away events of the value starting with event."""
+    if event == VALUE:
+        return
+    depth = 1
+    for event, _ in events:
+        if event == START_MAP or event == START_ARRAY:
+            depth += 1
+        elif event == END_MAP or event == END_ARRAY:
+            depth -= 1
+            if depth == 0:
+                return
+
+
+class StreamingComparator(Comparator):
+    """
+    Comparator which never loads whole documents into memory.
+
+    Both files are read as streams of parse events and walked in lockstep.
+    Python objects are built only for the values which are reported in the
+    diff and for the keys which come in different order in both documents,
+    so memory grows with the nesting depth and the size of changes, not
+    with the size of the documents.
+    """
+    chunk_size = STREAM_CHUNK_SIZE
+
+    def __init__(self, fn1=None, fn2=None, opts=None, stats=None,
+                 tracer=None):
+        Comparator.__init__(self, None, None, opts, stats=stats,
+                            tracer=tracer)
+        self.fn1 = fn1
+        self.fn2 = fn2
+
+    def are_equal(self, old_obj=None, new_obj=None):
+        """
+        Comparator.are_equal of old_obj and new_obj, if given; the
+        streamed files are compared whole (which does not load them).
+        """
+        if (old_obj is not None or new_obj is not None or
+                self.fn1 is None or self.fn2 is None):
+            return Comparator.are_equal(self, old_obj, new_obj)
+        return not self.compare_dicts()
+
+    def iter_changes(self, old_obj=None, new_obj=None):
+        """
+        Comparator.iter_changes of old_obj and new_obj. The streamed
+        files cannot be compared this way, old values of the changes
+        are not kept.
+        """
+        if (old_obj is not None or new_obj is not None or
+                self.fn1 is None or self.fn2 is None):
+            return Comparator.iter_changes(self, old_obj, new_obj)
+        raise ValueError("Changes of streamed files cannot be iterated.")
+
+    def compare_dicts(self, old_obj=None, new_obj=None):
+        """
+        Compare the streamed files, or old_obj and new_obj, if given,
+        the same way as Comparator does.
+        """
+        if (old_obj is not None or new_obj is not None or
+                self.fn1 is None or self.fn2 is None):
+            return Comparator.compare_dicts(self, old_obj, new_obj)
+
+        old_events = iter_json_events(self.fn1, self.chunk_size)
+        new_events = iter_json_events(self.fn2, self.chunk_size)
+        try:
+            old_event, old_value = old_events.next()
+            new_event, new_value = new_events.next()
+            if old_event == START_MAP and new_event == START_MAP:
+                # parsing is a part of the streamed comparison
+                if self.stats is not None:
+                    start = time.time()
+                result = self._stream_dicts(old_events, new_events,
+                                            self.path_rules.start())
+                if self.stats is not None:
+                    self.stats.add_phase(u"compare", time.time() - start)
+                    self.stats.count_result(result)
+            else:
+                result = Comparator.compare_dicts(
+                    self, _build_value(old_events, old_event, old_value),
+                    _build_value(new_events, new_event, new_value))
+            # check there is nothing after the end of documents
+            for _ in old_events:
+                pass
+            for _ in new_events:
+                pass
+        except BadJSONError:
+            raise
+        except (TypeError, OverflowError, ValueError), exc:
+            raise BadJSONError("Cannot decode object from JSON.\n%s" %
+                               unicode(exc))
+        return result
+
+    def _stream_elements(self, old_events, old_event, old_value,
+                         new_events, new_event, new_value, state):
+        """Streaming counterpart of _compare_elements, both values being
+        announced by their first event."""
+        if (self.included_attributes and
+                not self.path_rules.reachable(state, u"include")):
+            # nothing in this subtree could get into the result
+            self._note_skipped(u"not_included")
+            _skip_value(old_events, old_event)
+            _skip_value(new_events, new_event)
+            return None
+        if old_event == START_MAP and new_event == START_MAP:
+            res = self._stream_dicts(old_events, new_events, state)
+        elif (old_event == START_ARRAY and new_event == START_ARRAY and
+              (self.align_arrays or
+               self.path_rules.value(state, u"array_key") is not None)):
+            # aligning or matching by keys needs both whole arrays
+            return self._compare_elements(
+                _build_value(old_events, old_event, old_value),
+                _build_value(new_events, new_event, new_value), state)
+        elif old_event == START_ARRAY and new_event == START_ARRAY:
+            res = self._stream_arrays(old_events, new_events, state)
+        elif old_event == VALUE and new_event == VALUE:
+            return self._compare_elements(old_value, new_value, state)
+        else:
+            # different types, new value is new
+            _skip_value(old_events, old_event)
+            if self._report(state, _NO_KEY, u"_update"):
+                return _build_value(new_events, new_event, new_value)
+            _skip_value(new_events, new_event)
+            return None
+
+        if len(res) > 0:
+            return res
+        return None
+
+    def _stream_arrays(self, old_events, new_events, state):
+        """Streaming counterpart of _expand_arrays."""
+        if self.stats is not None:
+            self.stats.containers += 1
+        path = self._trace_path
+        result = {}
+        idx = 0
+        while True:
+            old_event, old_value = old_events.next()
+            new_event, new_value = new_events.next()
+            if old_event == END_ARRAY:
+                # the rest of the larger array
+                while new_event != END_ARRAY:
+                    if self._keep_value(state, idx, u"_append"):
+                        result.setdefault(u'_append', {})[idx] = _build_value(
+                            new_events, new_event, new_value)
+                    else:
+                        _skip_value(new_events, new_event)
+                    idx += 1
+                    new_event, new_value = new_events.next()
+                break
+            if new_event == END_ARRAY:
+                while old_event != END_ARRAY:
+                    if self._keep_value(state, idx, u"_remove"):
+                        result.setdefault(u'_remove', {})[idx] = _build_value(
+                            old_events, old_event, old_value)
+                    else:
+                        _skip_value(old_events, old_event)
+                    idx += 1
+                    old_event, old_value = old_events.next()
+                break
+
+            child_state = self._child_state(state, idx)
+            if self._excluded(child_state):
+                self._note_excluded(idx)
+                _skip_value(old_events, old_event)
+                _skip_value(new_events, new_event)
+            else:
+                if self.tracer is not None:
+                    self._trace_path = path + (idx,)
+                res = self._stream_elements(old_events, old_event, old_value,
+                                            new_events, new_event, new_value,
+                                            child_state)
+                if self.tracer is not None:
+                    self._trace_path = path
                 if res is not None:
-                    result[u'_update'][name] = res
+                    result.setdefault(u'_update', {})[idx] = res
+            idx += 1
+
+        return result
+
+    def _stream_dicts(self, old_events, new_events, state):
+        """
+        Streaming counterpart of compare_dicts.
+
+        As long as both objects have the same keys in the same order, the
+        values are compared in lockstep. A key which appears out of order
+        has its value built and kept aside until the same key comes on the
+        other side (or the object ends and the value is reported as
+        removed or appended).
+        """
+        if self.stats is not None:
+            self.stats.containers += 1
+        path = self._trace_path
+        result = {}
+        old_pending = {}
+        new_pending = {}
+        old_open = new_open = True
+        while old_open or new_open:
+            old_key = new_key = None
+            if old_open:
+                event, old_key = old_events.next()
+                old_open = event != END_MAP
+            if new_open:
+                event, new_key = new_events.next()
+                new_open = event != END_MAP
+
+            if old_key is not None and old_key == new_key:
+                old_event, old_value = old_events.next()
+                new_event, new_value = new_events.next()
+                child_state = self._child_state(state, old_key)
+                if self._excluded(child_state):
+                    self._note_excluded(old_key)
+                    _skip_value(old_events, old_event)
+                    _skip_value(new_events, new_event)
+                    continue
+                if self.tracer is not None:
+                    self._trace_path = path + (old_key,)
+                res = self._stream_elements(old_events, old_event,
+                                            old_value, new_events,
+                                            new_event, new_value,
+                                            child_state)
+                if self.tracer is not None:
+                    self._trace_path = path
+                if res is not None:
+                    result.setdefault(u'_update', {})[old_key] = res
+                continue
+
+            if old_key is not None:
+                event, value = old_events.next()
+                child_state = self._child_state(state, old_key)
+                if self._excluded(child_state):
+                    self._note_excluded(old_key)
+                    _skip_value(old_events, event)
+                else:
+                    value = _build_value(old_events, event, value)
+                    if old_key in new_pending:
+                        if self.tracer is not None:
+                            self._trace_path = path + (old_key,)
+                        res = self._compare_elements(
+                            value, new_pending.pop(old_key), child_state)
+                        if self.tracer is not None:
+                            self._trace_path = path
+                        if res is not None:
+                            result.setdefault(u'_update', {})[old_key] = res
+                    else:
+                        old_pending[old_key] = value
+            if new_key is not None:
+                event, value = new_events.next()
+                child_state = self._child_state(state, new_key)
+                if self._excluded(child_state):
+                    self._note_excluded(new_key)
+                    _skip_value(new_events, event)
+                else:
+                    value = _build_value(new_events, event, value)
+                    if new_key in old_pending:
+                        if self.tracer is not None:
+                            self._trace_path = path + (new_key,)
+                        res = self._compare_elements(
+                            old_pending.pop(new_key), value, child_state)
+                        if self.tracer is not None:
+                            self._trace_path = path
+                        if res is not None:
+                            result.setdefault(u'_update', {})[new_key] = res
+                    else:
+                        new_pending[new_key] = value
+
+        # old_obj is missing
+        for name in new_pending:
+            if self._report(self._child_state(state, name), name,
+                            u"_append"):
+                result.setdefault(u'_append', {})[name] = new_pending[name]
+        # new_obj is missing
+        for name in old_pending:
+            if self._report(self._child_state(state, name), name,
+                            u"_remove"):
+                result.setdefault(u'_remove', {})[name] = old_pending[name]
+
+        return result
+
+
+def _pointer_token(key):
+    """key (of dict or index of list) escaped for JSON Pointer."""
+    if isinstance(key, (int, long)):
+        return unicode(key)
+    return _text(key).replace(u"~", u"~0").replace(u"/", u"~1")
+
+
+def diff_to_patch(diff, old, new, path=u""):
+    """
+    Turn diff (result of Comparator.compare_dicts of old and new, with
+    arrays compared index by index) into a list of RFC 6902 JSON Patch
+    operations on old at JSON Pointer path. new tells nested diffs from
+    replaced values, it is not walked.
+    """
+    patch = []
+    # (diff, old, new, path) of the containers to be turned into patch
+    stack = [(diff, old, new, path)]
+    while stack:
+        diff, old, new, path = stack.pop()
+        if not ((isinstance(old, dict) and isinstance(new, dict)) or
+                (isinstance(old, list) and isinstance(new, list))):
+            # only the whole documents can be other than containers,
+            # and their diff is new itself
+            if type(old) != type(new) or old != new:
+                patch.append({u"op": u"replace", u"path": path,
+                              u"value": new})
+            continue
+        if not diff:
+            continue
+        nested = []
+        for key in sorted(diff.get(u"_update", ())):
+            value = diff[u"_update"][key]
+            old_value = old[key]
+            new_value = new[key]
+            if ((isinstance(old_value, dict) and
+                 isinstance(new_value, dict)) or
+                    (isinstance(old_value, list) and
+                     isinstance(new_value, list))):
+                nested.append((value, old_value, new_value,
+                               path + u"/" + _pointer_token(key)))
+            else:
+                patch.append({u"op": u"replace",
+                              u"path": path + u"/" + _pointer_token(key),
+                              u"value": value})
+        # removed items of arrays go from the end not to shift the rest
+        for key in sorted(diff.get(u"_remove", ()),
+                          reverse=isinstance(old, list)):
+            patch.append({u"op": u"remove",
+                          u"path": path + u"/" + _pointer_token(key)})
+        for key in sorted(diff.get(u"_append", ())):
+            patch.append({u"op": u"add",
+                          u"path": path + u"/" + _pointer_token(key),
+                          u"value": diff[u"_append"][key]})
+        # nested containers in the order of their keys, like the rest
+        nested.reverse()
+        stack.extend(nested)
+    return patch
+
+
+def _parse_pointer(pointer):
+    """List of reference tokens of JSON Pointer pointer."""
+    if not isinstance(pointer, basestring):
+        raise PatchError("Path %r is not a string" % (pointer,))
+    if pointer == u"":
+        return []
+    if not pointer.startswith(u"/"):
+        raise PatchError("Path %s does not start with /" % pointer)
+    return [token.replace(u"~1", u"/").replace(u"~0", u"~")
+            for token in pointer[1:].split(u"/")]
+
+
+def _list_index(arr, token, pointer, append=False):
+    """Index of list arr referenced by token of pointer; the end of arr
+    ("-" or len(arr)) is valid only if append is True."""
+    if token == u"-" and append:
+        return len(arr)
+    if (not token.isdigit() or (token.startswith(u"0") and token != u"0")):
+        raise PatchError("Bad array index %s in %s" % (token, pointer))
+    idx = int(token)
+    if idx > len(arr) or (idx == len(arr) and not append):
+        raise PatchError("Array index %s out of range in %s" %
+                         (token, pointer))
+    return idx
+
+
+def _resolve(doc, pointer):
+    """(container, token) of the value at JSON Pointer pointer in doc;
+    container is None for the whole doc."""
+    tokens = _parse_pointer(pointer)
+    if not tokens:
+        return None, None
+    parent = doc
+    for token in tokens[:-1]:
+        if isinstance(parent, dict):
+            if token not in parent:
+                raise PatchError("Path %s does not exist" % pointer)
+            parent = parent[token]
+        elif isinstance(parent, list):
+            parent = parent[_list_index(parent, token, pointer)]
+        else:
+            raise PatchError("Path %s does not exist" % pointer)
+    if not isinstance(parent, (dict, list)):
+        raise PatchError("Path %s does not exist" % pointer)
+    return parent, tokens[-1]
+
+
+def _get(doc, pointer):
+    """Value at JSON Pointer pointer in doc."""
+    parent, token = _resolve(doc, pointer)
+    if parent is None:
+        return doc
+    if isinstance(parent, list):
+        return parent[_list_index(parent, token, pointer)]
+    if token not in parent:
+        raise PatchError("Path %s does not exist" % pointer)
+    return parent[token]
+
+
+def _remove(doc, pointer):
+    """Remove the value at JSON Pointer pointer from doc and return it."""
+    parent, token = _resolve(doc, pointer)
+    if parent is None:
+        raise PatchError("Cannot remove the whole document")
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, token, pointer))
+    if token not in parent:
+        raise PatchError("Path %s does not exist" % pointer)
+    return parent.pop(token)
+
+
+def _add(doc, pointer, value, replace=False):
+    """Add (or replace) value at JSON Pointer pointer in doc, return the
+    document (which is value when pointer points at the whole of it)."""
+    parent, token = _resolve(doc, pointer)
+    if parent is None:
+        return value
+    if isinstance(parent, list):
+        idx = _list_index(parent, token, pointer, append=not replace)
+        if replace:
+            parent[idx] = value
+        else:
+            parent.insert(idx, value)
+    else:
+        if replace and token not in parent:
+            raise PatchError("Path %s does not exist" % pointer)
+        parent[token] = value
+    return doc
+
+
+def apply_patch(doc, patch):
+    """
+    Apply RFC 6902 JSON Patch patch (list of operations) to doc in place
+    and return the patched document (a different object only if the
+    whole document is replaced). Values from the patch are put into doc
+    as they are, not copied (except by the "copy" operation); doc must
+    not be used to generate other patches meanwhile. Raises PatchError
+    when an operation cannot be applied, leaving doc partially patched.
+    """
+    for operation in patch:
+        try:
+            op = operation[u"op"]
+            path = operation[u"path"]
+            if op == u"add":
+                doc = _add(doc, path, operation[u"value"])
+            elif op == u"remove":
+                _remove(doc, path)
+            elif op == u"replace":
+                doc = _add(doc, path, operation[u"value"], replace=True)
+            elif op == u"move":
+                from_path = operation[u"from"]
+                if path.startswith(from_path + u"/"):
+                    raise PatchError("Cannot move %s into itself" %
+                                     from_path)
+                if path != from_path:
+                    doc = _add(doc, path, _remove(doc, from_path))
+            elif op == u"copy":
+                doc = _add(doc, path,
+                           copy.deepcopy(_get(doc, operation[u"from"])))
+            elif op == u"test":
+                value = _get(doc, path)
+                expected = operation[u"value"]
+                if (value != expected or
+                        isinstance(value, bool) !=
+                        isinstance(expected, bool)):
+                    raise PatchError("Test of %s failed" % path)
+            else:
+                raise PatchError("Unknown operation %s" % op)
+        except (KeyError, TypeError), exc:
+            raise PatchError("Bad operation %r: %s" % (operation, exc))
+    return doc
+
+
+def _remove_file(path):
+    """Remove file path, if it still exists."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class DiffCache(object):
+    """
+    On-disk cache of diffs of files, with a size limit.
+
+    Diffs are stored in directory, one marshal file per entry (plain
+    data; a pickle written by another user of a shared directory could
+    run any code when loaded), under a key computed from the contents of
+    both files and the options which affect the result, so a hit does not
+    parse either document. Entries are touched when read and the least
+    recently used ones are removed when the cache grows over max_size
+    bytes. Several processes may share one directory. Note that restored
+    dicts may iterate in a different order.
+    """
+
+    def __init__(self, directory, max_size=DIFF_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, old_name, new_name, opts=None):
+        """Key of the diff of files old_name and new_name with opts."""
+        key = sha1(repr(DIFF_CACHE_VERSION))
+        for name in (old_name, new_name):
+            infile = open(name, "rb")
+            try:
+                content = sha1()
+                chunk = infile.read(STREAM_CHUNK_SIZE)
+                while chunk:
+                    content.update(chunk)
+                    chunk = infile.read(STREAM_CHUNK_SIZE)
+            finally:
+                infile.close()
+            key.update(content.hexdigest())
+        key.update(repr(self._options(opts)))
+        return key.hexdigest()
+
+    def _options(self, opts):
+        """Options which change the result of comparison, normalized."""
+        if opts is None:
+            return None
+        align_arrays = bool(getattr(opts, "align_arrays", False))
+        align_max_edits = None
+        if align_arrays:
+            align_max_edits = getattr(opts, "align_max_edits",
+                                      ALIGN_MAX_EDITS)
+        return (getattr(opts, "decoder", None) or default_decoder(),
+                sorted([_text(attr) for attr in opts.exclude or []]),
+                sorted([_text(attr) for attr in opts.include or []]),
+                bool(opts.ignore_append),
+                align_arrays, align_max_edits,
+                sorted([_text(rule) for rule in
+                        getattr(opts, "array_key", None) or []]),
+                getattr(opts, "max_changes", None),
+                getattr(opts, "max_depth", None),
+                getattr(opts, "abs_tolerance", None) or 0.0,
+                getattr(opts, "rel_tolerance", None) or 0.0)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".marshal")
+
+    def get(self, key):
+        """The cached diff for key, or None if there is none."""
+        path = self._path(key)
+        try:
+            infile = open(path, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                result = marshal.load(infile)
+            except (EOFError, ValueError, TypeError):
+                logging.warning("Broken cache entry %s", path)
+                return None
+        finally:
+            infile.close()
+        try:
+            # mark the entry as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """Store diff result under key, evicting old entries if needed.
+        A result which cannot be stored (nested too deeply for marshal,
+        disk full, ...) is not cached, the failure is only logged."""
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory,
+                                        suffix=".tmp")
+        try:
+            outf = os.fdopen(fd, "wb")
+            try:
+                marshal.dump(result, outf)
+            finally:
+                outf.close()
+            # readers never see half written entries
+            os.rename(tmp_name, self._path(key))
+        except (ValueError, EnvironmentError), exc:
+            _remove_file(tmp_name)
+            logging.warning("Diff not cached: %s", exc)
+            return
+        except:
+            _remove_file(tmp_name)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into
+        self.max_size, and temporary files of writers which died."""
+        entries = []
+        total = 0
+        stale = time.time() - DIFF_CACHE_TMP_AGE
+        for filename in os.listdir(self.directory):
+            is_tmp = filename.endswith(".tmp")
+            if not (is_tmp or filename.endswith(".marshal")):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if is_tmp:
+                # others may be writing the fresh ones right now
+                if stat.st_mtime < stale:
+                    _remove_file(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            # it may be removed by another process in the meantime
+            _remove_file(path)
+            total -= size
+
+    def compare_files(self, old_name, new_name, opts=None,
+                      comparator=None, stats=None):
+        """
+        Diff of files old_name and new_name, from the cache if possible;
+        otherwise they are compared by comparator (class, Comparator by
+        default) with opts and stats and the result is stored.
+        """
+        key = self.key(old_name, new_name, opts)
+        result = self.get(key)
+        if result is not None:
+            return result
+        if comparator is None:
+            comparator = Comparator
+        old_file = open(old_name)
+        new_file = open(new_name)
+        try:
+            result = comparator(old_file, new_file, opts,
+                                stats=stats).compare_dicts()
+        finally:
+            old_file.close()
+            new_file.close()
+        # a diff cut by --timeout depends on the load of the machine
+        if not (isinstance(result, dict) and u"_truncated" in result and
+                u"timeout" in result[u"_truncated"][u"limits"]):
+            self.put(key, result)
+        return result
+
+
+class _Closing(object):
+    """
+    Iterator over iterable which calls cleanup (without arguments) when
+    it is closed, exhausted or fails. Functions which have to clean up
+    after generating their results return one, as Python 2.4 has neither
+    yield inside try/finally nor close() of generators; callers close
+    it in their own try/finally when they stop early.
+    """
+
+    def __init__(self, iterable, cleanup=None):
+        self._iterator = iter(iterable)
+        self._cleanup = cleanup
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._iterator.next()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        """Call cleanup, unless it has been called already."""
+        cleanup = self._cleanup
+        if cleanup is not None:
+            self._cleanup = None
+            cleanup()
+
+
+def _stop_pool(pool):
+    """Cleanup of _Closing results of multiprocessing pool."""
+    pool.terminate()
+    pool.join()
+
+
+def iter_tree_pairs(old_dir, new_dir):
+    """
+    Generate (name, old_path, new_path) for all *.json files in directory
+    trees old_dir and new_dir, sorted by name (path relative to the tree).
+    A file missing in one of the trees has None instead of its path.
+    """
+    def tree_files(top):
+        files = {}
+        # top with exactly one separator at the end
+        prefix = os.path.join(top, "")
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    path = os.path.join(dirpath, filename)
+                    name = path[len(prefix):].replace(os.sep, "/")
+                    files[name] = path
+        return files
+
+    old_files = tree_files(old_dir)
+    new_files = tree_files(new_dir)
+    for name in sorted(set(old_files) | set(new_files)):
+        yield name, old_files.get(name), new_files.get(name)
+
+
+def read_manifest(manf):
+    """
+    Generate (name, old_path, new_path) from manifest file manf, which has
+    one pair of file names separated by whitespace per line. Empty lines
+    and lines starting with # are skipped. Pairs are named by their new
+    file; a file which does not exist has None instead of its path.
+    """
+    for line_no, line in enumerate(manf):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        paths = line.split()
+        if len(paths) != 2:
+            raise ValueError("Line %d of manifest is not a pair of files: %s"
+                             % (line_no + 1, line))
+        old_path, new_path = paths
+        if not os.path.exists(old_path):
+            old_path = None
+        if not os.path.exists(new_path):
+            new_path = None
+        yield paths[1], old_path, new_path
+
+
+def _compare_pair(job):
+    """
+    Compare one pair of files for compare_batch. Returns (name, change_type,
+    value) where change_type is None for equal files, u"_append" or
+    u"_remove" (with the document) for a missing file, u"_update" with the
+    diff, or u"_error" with the error message.
+    """
+    name, old_path, new_path, opts = job
+    try:
+        if old_path is None or new_path is None:
+            path = old_path or new_path
+            infile = open(path)
+            try:
+                try:
+                    doc = decode_json(infile, getattr(opts, "decoder",
+                                                      None))
+                except (TypeError, OverflowError, ValueError), exc:
+                    raise BadJSONError("Cannot decode object from JSON.\n%s" %
+                                       unicode(exc))
+            finally:
+                infile.close()
+            if old_path is None:
+                return name, u"_append", doc
+            return name, u"_remove", doc
+
+        # same size and contents, nothing to parse
+        if filecmp.cmp(old_path, new_path, shallow=False):
+            return name, None, None
+
+        diff_res = compare_files(old_path, new_path, opts)
+    except (EnvironmentError, BadJSONError), exc:
+        return name, u"_error", unicode(exc)
+    if len(diff_res) > 0:
+        return name, u"_update", diff_res
+    return name, None, None
+
+
+# (comparator with the decoded baseline, its file name, its index) of
+# compare_fan_out in a worker process, set by _init_fan_out_worker; forked
+# workers inherit it, so the baseline is decoded and indexed only once
+_fan_out_job = None
+
+
+def _init_fan_out_worker(job):
+    """_init_parallel_worker of compare_fan_out workers, job becomes their
+    _fan_out_job."""
+    global _fan_out_job
+    _init_parallel_worker()
+    _fan_out_job = job
+
+
+def _compare_candidate(name, job=None):
+    """
+    Compare candidate file name with the baseline of compare_fan_out job
+    (_fan_out_job of the worker by default). Returns (name, change_type,
+    value) like _compare_pair does.
+    """
+    if job is None:
+        job = _fan_out_job
+    comparator, baseline_name, index = job
+    try:
+        # same size and contents, nothing to parse
+        if filecmp.cmp(baseline_name, name, shallow=False):
+            return name, None, None
+        infile = open(name)
+        try:
+            try:
+                candidate = decode_json(infile, comparator.decoder)
+            except (TypeError, OverflowError, ValueError), exc:
+                raise BadJSONError("Cannot decode object from JSON.\n%s" %
+                                   unicode(exc))
+        finally:
+            infile.close()
+    except (EnvironmentError, BadJSONError), exc:
+        return name, u"_error", unicode(exc)
+    if index is not None:
+        # the index is shared, hashes of the candidate go aside
+        comparator.hashes = SubtreeHashes(index)
+    diff_res = comparator.compare_dicts(comparator.obj1, candidate)
+    if len(diff_res) > 0:
+        return name, u"_update", diff_res
+    return name, None, None
+
+
+def _with_options(opts, options):
+    """opts (DiffOptions by default) updated with keyword options."""
+    if opts is None:
+        return DiffOptions(**options)
+    if options:
+        opts = copy.copy(opts)
+        opts.__dict__.update(options)
+    return opts
+
+
+def compare_objects(old, new, opts=None, stats=None, **options):
+    """
+    Diff of decoded documents old and new (dicts, lists, ...), compared
+    as requested by opts and keyword options (see DiffOptions), e.g.
+
+        compare_objects(old, new, exclude=["time"], ignore_append=True)
+    """
+    return Comparator(opts=_with_options(opts, options),
+                      stats=stats).compare_dicts(old, new)
+
+
+def compare_buffers(old, new, opts=None, stats=None, **options):
+    """
+    Diff of JSON documents in old and new (str, unicode or buffers, see
+    decode_buffer), compared like by compare_objects.
+    """
+    opts = _with_options(opts, options)
+    decoder = getattr(opts, "decoder", None)
+    if stats is not None:
+        start = time.time()
+    try:
+        old = decode_buffer(old, decoder)
+        new = decode_buffer(new, decoder)
+    except (TypeError, OverflowError, ValueError), exc:
+        raise BadJSONError("Cannot decode object from JSON.\n%s" %
+                           unicode(exc))
+    if stats is not None:
+        stats.add_phase(u"parse", time.time() - start)
+    return Comparator(opts=opts, stats=stats).compare_dicts(old, new)
+
+
+def compare_files(old_name, new_name, opts=None, stats=None):
+    """
+    Diff of files old_name and new_name, compared as requested by opts:
+    streamed with opts.stream, looked up in and stored to the DiffCache
+    in directory opts.cache (limited to opts.cache_size MB) if set
+    (but not with opts.trace, cached results have nothing to trace).
+    Statistics of the comparison go to DiffStats stats, if given.
+    """
+    if getattr(opts, "stream", False):
+        comparator = StreamingComparator
+    else:
+        comparator = Comparator
+    if getattr(opts, "cache", None) and not getattr(opts, "trace", False):
+        cache_size = getattr(opts, "cache_size", None)
+        if cache_size is None:
+            cache = DiffCache(opts.cache)
+        else:
+            cache = DiffCache(opts.cache, cache_size * 1024 * 1024)
+        return cache.compare_files(old_name, new_name, opts, comparator,
+                                   stats)
+    old_file = open(old_name)
+    new_file = open(new_name)
+    try:
+        return comparator(old_file, new_file, opts,
+                          stats=stats).compare_dicts()
+    finally:
+        old_file.close()
+        new_file.close()
+
+
+def files_equal(old_name, new_name, opts=None, stats=None):
+    """
+    Are files old_name and new_name equal as compared by compare_files
+    with opts? Files with the same contents are not parsed at all, other
+    ones are compared only up to the first reported change.
+    """
+    # same size and contents, nothing to parse
+    if filecmp.cmp(old_name, new_name, shallow=False):
+        return True
+    if getattr(opts, "stream", False):
+        comparator = StreamingComparator
+    else:
+        comparator = Comparator
+    old_file = open(old_name)
+    new_file = open(new_name)
+    try:
+        return comparator(old_file, new_file, opts, stats=stats).are_equal()
+    finally:
+        old_file.close()
+        new_file.close()
+
+
+def files_patch(old_name, new_name, opts=None, stats=None):
+    """JSON Patch (see Comparator.compare_patch) turning file old_name
+    into new_name, compared as requested by opts."""
+    old_file = open(old_name)
+    new_file = open(new_name)
+    try:
+        return Comparator(old_file, new_file, opts,
+                          stats=stats).compare_patch()
+    finally:
+        old_file.close()
+        new_file.close()
 
-        return self._filter_results(result)
+
+def iter_file_changes(old_name, new_name, opts=None, stats=None):
+    """Comparator.iter_changes of files old_name and new_name, compared
+    as requested by opts (which cannot ask for streaming)."""
+    old_file = open(old_name)
+    new_file = open(new_name)
+    try:
+        comparator = Comparator(old_file, new_file, opts, stats=stats)
+    finally:
+        old_file.close()
+        new_file.close()
+    return comparator.iter_changes()
+
+
+def changes_to_diff(changes):
+    """Diff (as compare_dicts returns it) of changes generated by
+    Comparator.iter_changes."""
+    diff = {}
+    for path, change_type, old, new in changes:
+        if not path:
+            # the whole document changed its type
+            return new
+        node = diff
+        for key in path[:-1]:
+            node = node.setdefault(u"_update", {}).setdefault(key, {})
+        if change_type == u"_remove":
+            new = old
+        node.setdefault(change_type, {})[path[-1]] = new
+    return diff
+
+
+def iter_records(fileobj, key, decoder=None):
+    """
+    Generate (key value, text) pairs of the records of NDJSON (JSON
+    Lines) file fileobj, one JSON object with scalar field key on each
+    line; empty lines are skipped. Records are decoded only to get their
+    keys, the text is kept: records with the same text need no
+    comparison and the text takes less memory than the decoded record.
+    """
+    if decoder is None:
+        decoder = default_decoder()
+    loads = DECODERS[decoder]
+    number = 0
+    for line in fileobj:
+        number += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = loads(line)
+        except (TypeError, OverflowError, ValueError), exc:
+            raise BadJSONError("Cannot decode record on line %d.\n%s" %
+                               (number, unicode(exc)))
+        if (not isinstance(record, dict) or key not in record or
+                isinstance(record[key], (dict, list))):
+            raise BadJSONError("Record on line %d has no scalar %s field." %
+                               (number, key))
+        yield record[key], line
+
+
+def _write_run(items, directory=None):
+    """Write sorted (key, number, text) items to a new temporary file,
+    return the file (rewound)."""
+    run = tempfile.TemporaryFile(dir=directory)
+    for item in items:
+        marshal.dump(item, run)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    """Generate (key, number, text) items of a file of _write_run."""
+    while True:
+        try:
+            yield marshal.load(run)
+        except EOFError:
+            return
+
+
+def _merge_sorted(*iterables):
+    """Generate items of sorted iterables in sorted order (heapq.merge
+    for Pythons without it)."""
+    heap = []
+    for index, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heappush(heap, (item, index, iterator))
+            break
+    while heap:
+        item, index, iterator = heappop(heap)
+        yield item
+        for item in iterator:
+            heappush(heap, (item, index, iterator))
+            break
+
+
+def _merge_runs(runs):
+    """Generate (key, number, text) items of sorted runs (files of
+    _write_run) in sorted order."""
+    merge_sorted = merge or _merge_sorted
+    return merge_sorted(*[_read_run(run) for run in runs])
+
+
+def _close_runs(runs):
+    """Close (and so remove) files of _write_run in list runs."""
+    for run in runs:
+        run.close()
+
+
+def _add_run(levels, run, directory, max_runs):
+    """
+    Add run to levels[0] of sort_records; levels[n] are the runs merged
+    n times. max_runs runs of one level are merged into one run of the
+    next level, so every item is written once per level and the number
+    of levels grows with the logarithm of the number of runs.
+    """
+    level = 0
+    while True:
+        if level == len(levels):
+            levels.append([])
+        runs = levels[level]
+        runs.append(run)
+        if len(runs) < max_runs:
+            return
+        run = _write_run(_merge_runs(runs), directory)
+        _close_runs(runs)
+        del runs[:]
+        level += 1
+
+
+def sort_records(records, chunk_size=RECORDS_SORT_CHUNK, directory=None,
+                 max_runs=RECORDS_MERGE_RUNS):
+    """
+    Sort (key, text) pairs of records by key (records of the same key
+    keep their order) and return an iterator over them. When there are
+    more than chunk_size records, they are sorted in runs of chunk_size,
+    written to temporary files (in directory, if given) and merged in
+    levels of max_runs runs (see _add_run), so no more than chunk_size
+    of them are held in memory at once. The files are removed when the
+    iterator is exhausted or closed (see _Closing).
+    """
+    levels = []
+    runs = []
+    try:
+        chunk = []
+        # numbers keep the sort stable and texts out of the comparisons
+        number = 0
+        for key, text in records:
+            chunk.append((key, number, text))
+            number += 1
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                _add_run(levels, _write_run(chunk, directory), directory,
+                         max_runs)
+                chunk = []
+        chunk.sort()
+        for level in levels:
+            runs.extend(level)
+        if runs and chunk:
+            runs.append(_write_run(chunk, directory))
+    except:
+        for level in levels:
+            _close_runs(level)
+        _close_runs(runs)
+        raise
+    if runs:
+        chunk = _merge_runs(runs)
+    return _Closing(((key, text) for key, number, text in chunk),
+                    lambda: _close_runs(runs))
+
+
+def _unique_sorted(records):
+    """Pass (key, record) pairs of records on, checking their keys are
+    sorted and unique."""
+    previous = _NO_KEY
+    for key, record in records:
+        if previous is not _NO_KEY and not previous < key:
+            if previous == key:
+                raise BadJSONError("Duplicate record key %r." % (key,))
+            raise BadJSONError("Records are not sorted by key (%r after "
+                               "%r)." % (key, previous))
+        previous = key
+        yield key, record
+
+
+def _next_item(iterator):
+    """Next item of iterator, None at its end."""
+    try:
+        return iterator.next()
+    except StopIteration:
+        return None
+
+
+def iter_record_file_changes(old_name, new_name, key, opts=None,
+                             stats=None):
+    """
+    Comparator.iter_record_changes of NDJSON files old_name and new_name
+    with records matched by their field key, compared as requested by
+    opts. Unless opts.sorted says the files are sorted by key already,
+    they are sorted on disk first (in opts.sort_dir, if set). The files
+    are closed when the returned iterator is exhausted or closed (see
+    _Closing).
+    """
+    comparator = Comparator(None, None, opts, stats=stats)
+    directory = getattr(opts, "sort_dir", None)
+    # files and sorted records to be closed
+    resources = []
+
+    def cleanup():
+        for resource in resources:
+            resource.close()
+
+    try:
+        old_file = open(old_name)
+        resources.append(old_file)
+        new_file = open(new_name)
+        resources.append(new_file)
+        old_records = iter_records(old_file, key, comparator.decoder)
+        new_records = iter_records(new_file, key, comparator.decoder)
+        if not getattr(opts, "sorted", False):
+            old_records = sort_records(old_records, directory=directory)
+            resources.append(old_records)
+            new_records = sort_records(new_records, directory=directory)
+            resources.append(new_records)
+    except:
+        cleanup()
+        raise
+    return _Closing(comparator.iter_record_changes(old_records, new_records),
+                    cleanup)
+
+
+def compare_batch(pairs, opts=None):
+    """
+    Compare pairs of files, (name, old_path, new_path) tuples as generated
+    by iter_tree_pairs or read_manifest, and return an iterator over
+    (name, change_type, value) results (see _compare_pair) in the same
+    order.
+
+    With opts.jobs above 1 the pairs are compared in a pool of that many
+    processes, each pair is compared within one process. The pool is
+    stopped when the iterator is exhausted or closed (see _Closing).
+    """
+    jobs = getattr(opts, "jobs", 1) or 1
+    if opts is not None and jobs > 1:
+        # the pool workers cannot start pools of their own
+        opts = copy.copy(opts)
+        opts.jobs = 1
+    tasks = ((name, old_path, new_path, opts)
+             for name, old_path, new_path in pairs)
+
+    if jobs > 1 and multiprocessing is not None:
+        pool = multiprocessing.Pool(jobs)
+        return _Closing(pool.imap(_compare_pair, tasks, BATCH_CHUNK_SIZE),
+                        lambda: _stop_pool(pool))
+    return _Closing(_compare_pair(task) for task in tasks)
+
+
+def compare_fan_out(baseline_name, candidate_names, opts=None):
+    """
+    Compare file baseline_name with each of candidate_names and return
+    an iterator over (name, change_type, value) results (see
+    _compare_pair) in the same order. The baseline is decoded and indexed
+    only once (see Comparator.index_baseline); with opts.jobs above 1 the
+    candidates are compared in a pool of that many forked processes
+    sharing it, which is stopped when the iterator is exhausted or closed
+    (see _Closing).
+    """
+    jobs = getattr(opts, "jobs", 1) or 1
+    if opts is not None and jobs > 1:
+        # the pool workers cannot start pools of their own
+        opts = copy.copy(opts)
+        opts.jobs = 1
+    infile = open(baseline_name)
+    try:
+        comparator = Comparator(infile, None, opts)
+    finally:
+        infile.close()
+
+    job = (comparator, baseline_name, comparator.index_baseline())
+    if jobs > 1 and multiprocessing is not None and hasattr(os, "fork"):
+        pool = multiprocessing.Pool(jobs, _init_fan_out_worker, (job,))
+        return _Closing(pool.imap(_compare_candidate, candidate_names,
+                                  BATCH_CHUNK_SIZE),
+                        lambda: _stop_pool(pool))
+    return _Closing(_compare_candidate(name, job)
+                    for name in candidate_names)
+
+
+class BaselineStore(object):
+    """
+    Named baseline documents kept in memory by the diff server.
+
+    Size of a baseline is the length of its JSON text (the decoded objects
+    and their index take a few times more). When the total size exceeds
+    max_size, the least recently used baselines which are not being
+    compared are evicted. Baselines are indexed for comparisons with opts
+    (see Comparator.index_baseline) once, when they are stored. All
+    methods are thread safe.
+    """
+
+    def __init__(self, max_size=SERVER_MEMORY, opts=None):
+        self.max_size = max_size
+        self.opts = opts
+        self.size = 0
+        self._lock = threading.Lock()
+        # name -> [document, size, last use, number of users, index]
+        self._baselines = {}
+
+    def put(self, name, doc, size):
+        """Store doc of size as baseline name, replacing the old one."""
+        comparator = Comparator(opts=self.opts)
+        comparator.obj1 = doc
+        index = comparator.index_baseline()
+        self._lock.acquire()
+        try:
+            if name in self._baselines:
+                self.size -= self._baselines.pop(name)[1]
+            self._baselines[name] = [doc, size, time.time(), 0, index]
+            self.size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def acquire(self, name):
+        """Baseline name as an entry ([document, size, last use, number of
+        users, index]) protected from eviction until released, or None if
+        there is none."""
+        self._lock.acquire()
+        try:
+            entry = self._baselines.get(name)
+            if entry is not None:
+                entry[2] = time.time()
+                entry[3] += 1
+            return entry
+        finally:
+            self._lock.release()
+
+    def release(self, entry):
+        """Let entry returned by acquire be evicted again."""
+        self._lock.acquire()
+        try:
+            entry[3] -= 1
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def remove(self, name):
+        """Forget baseline name; return False if there is none."""
+        self._lock.acquire()
+        try:
+            if name not in self._baselines:
+                return False
+            self.size -= self._baselines.pop(name)[1]
+            return True
+        finally:
+            self._lock.release()
+
+    def names(self):
+        """{name: size} of the stored baselines."""
+        self._lock.acquire()
+        try:
+            return dict([(name, entry[1]) for name, entry
+                         in self._baselines.iteritems()])
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        """Evict idle baselines until they fit; the lock is held."""
+        if self.size <= self.max_size:
+            return
+        idle = [(entry[2], name) for name, entry in
+                self._baselines.iteritems() if entry[3] == 0]
+        idle.sort()
+        for last_use, name in idle:
+            if self.size <= self.max_size:
+                break
+            logging.info("Evicting baseline %s", name)
+            self.size -= self._baselines.pop(name)[1]
+
+
+class _DiffRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP interface of the diff server (see make_server):
+
+        GET /baselines               -- {name: size} of stored baselines
+        PUT /baselines/NAME          -- store the JSON body as baseline NAME
+        DELETE /baselines/NAME       -- forget baseline NAME
+        POST /diff/NAME[?format=F]   -- diff of baseline NAME and the JSON
+                                        body, F is json (default), html
+                                        or patch
+    """
+
+    def address_string(self):
+        # clients of Unix sockets have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return u"local"
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+    def _reply(self, code, body=None, content_type="application/json"):
+        """Send response with body (str, or object sent as JSON)."""
+        if body is not None and not isinstance(body, str):
+            outf = StringIO()
+            write_json(body, outf, compact=True)
+            body = outf.getvalue()
+        self.send_response(code)
+        if body is not None:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def _error(self, code, message):
+        self._reply(code, {u"error": message})
+
+    def _name(self, prefix):
+        """Baseline name from the path after prefix, or None."""
+        path = self.path.split("?", 1)[0]
+        if not path.startswith(prefix) or len(path) == len(prefix):
+            return None
+        return urllib.unquote(path[len(prefix):]).decode("utf-8")
+
+    def _read_document(self):
+        """(document, size) of the JSON body; replies with an error and
+        returns None if it cannot be read."""
+        try:
+            length = int(self.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            self._error(411, u"Content-Length is required")
+            return None
+        try:
+            doc = decode_json(StringIO(self.rfile.read(length)),
+                              getattr(self.server.opts, "decoder", None))
+        except (TypeError, OverflowError, ValueError), exc:
+            self._error(400, u"Cannot decode object from JSON: %s" %
+                        unicode(exc))
+            return None
+        return doc, length
+
+    def _limited(self, method):
+        """Run method unless too many requests are being handled."""
+        if not self.server.slots.acquire(False):
+            self._error(503, u"Too many requests")
+            return
+        try:
+            method()
+        finally:
+            self.server.slots.release()
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/baselines":
+            self._error(404, u"Not found")
+            return
+        self._reply(200, self.server.store.names())
+
+    def do_DELETE(self):
+        name = self._name("/baselines/")
+        if name is None or not self.server.store.remove(name):
+            self._error(404, u"No such baseline")
+            return
+        self._reply(204)
+
+    def do_PUT(self):
+        self._limited(self._put_baseline)
+
+    def _put_baseline(self):
+        name = self._name("/baselines/")
+        if name is None:
+            self._error(404, u"Not found")
+            return
+        read = self._read_document()
+        if read is not None:
+            self.server.store.put(name, read[0], read[1])
+            self._reply(201)
+
+    def do_POST(self):
+        self._limited(self._post_diff)
+
+    def _post_diff(self):
+        name = self._name("/diff/")
+        if name is None:
+            self._error(404, u"Not found")
+            return
+        parts = self.path.split("?", 1)
+        query = {}
+        if len(parts) > 1:
+            query = parse_qs(parts[1])
+        out_format = query.get("format", ["json"])[-1]
+        if out_format not in ("json", "html", "patch"):
+            self._error(400, u"Unknown format %s" % out_format)
+            return
+        entry = self.server.store.acquire(name)
+        if entry is None:
+            self._error(404, u"No such baseline")
+            return
+        try:
+            read = self._read_document()
+            if read is None:
+                return
+            # comparators keep state of the running comparison, every
+            # request needs its own; the index of the baseline is shared
+            hashes = None
+            if entry[4] is not None:
+                hashes = SubtreeHashes(entry[4])
+            comparator = Comparator(opts=self.server.opts, hashes=hashes)
+            if out_format == "patch":
+                self._reply(200, comparator.compare_patch(entry[0],
+                                                          read[0]))
+                return
+            diff_res = comparator.compare_dicts(entry[0], read[0])
+        finally:
+            self.server.store.release(entry)
+        if out_format == "html":
+            outf = StringIO()
+            HTMLFormatter(diff_res).write(outf, "utf-8")
+            self._reply(200, outf.getvalue(), "text/html; charset=utf-8")
+        else:
+            self._reply(200, diff_res)
+
+
+class _DiffHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _DiffUnixServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(address, store=None, opts=None,
+                max_requests=SERVER_REQUESTS):
+    """
+    Diff server (not started yet, call its serve_forever method) keeping
+    baselines in store (a BaselineStore) and comparing documents with
+    them as requested over HTTP (see _DiffRequestHandler), max_requests
+    at once. address is a path of a Unix socket or (host, port) to
+    listen at; there is no authentication, so the host should be local.
+    opts are the options of all comparisons (and of the store made when
+    store is None; a given store should have the same ones).
+    """
+    if isinstance(address, basestring):
+        server = _DiffUnixServer(address, _DiffRequestHandler)
+    else:
+        server = _DiffHTTPServer(address, _DiffRequestHandler)
+    if store is None:
+        store = BaselineStore(opts=opts)
+    server.store = store
+    server.opts = opts
+    server.slots = threading.Semaphore(max_requests)
+    return server
 
 
 def main(sys_args):
     """Main function, to process command line arguments etc."""
-    usage = "usage: %prog [options] old.json new.json"
+    usage = ("usage: %prog [options] old.json new.json\n" +
+             "       %prog [options] -b old_dir new_dir\n" +
+             "       %prog [options] -m manifest\n" +
+             "       %prog [options] -f baseline.json candidate.json...\n" +
+             "       %prog [options] --serve [HOST:]PORT|SOCKET")
     parser = OptionParser(usage=usage)
     parser.add_option("-x", "--exclude",
                       action="append", dest="exclude", metavar="ATTR",
@@ -354,31 +3715,407 @@ def main(sys_args):
                       action="store_true", dest="HTMLoutput",
                       metavar="BOOL", default=False,
                       help="program should output to HTML report")
+    parser.add_option("-c", "--compact",
+                      action="store_true", dest="compact",
+                      metavar="BOOL", default=False,
+                      help="output JSON without indentation")
+    parser.add_option("-p", "--patch",
+                      action="store_true", dest="patch",
+                      metavar="BOOL", default=False,
+                      help="output the changes as RFC 6902 JSON Patch")
+    parser.add_option("-l", "--lines",
+                      action="store_true", dest="lines",
+                      metavar="BOOL", default=False,
+                      help="write every change as soon as it is found, " +
+                      "as a JSON line [path, type, old, new] (or HTML " +
+                      "row with -H)")
+    parser.add_option("-r", "--records",
+                      action="store", dest="records", metavar="FIELD",
+                      help="compare NDJSON (JSON Lines) files of records " +
+                      "matched by their FIELD")
+    parser.add_option("--sorted",
+                      action="store_true", dest="sorted",
+                      metavar="BOOL", default=False,
+                      help="with -r, records are sorted by FIELD already")
+    parser.add_option("--sort-dir",
+                      action="store", dest="sort_dir", metavar="DIR",
+                      help="directory for temporary files of sorting " +
+                      "records (default is the system one)")
+    parser.add_option("-j", "--jobs",
+                      action="store", type="int", dest="jobs",
+                      metavar="N", default=1,
+                      help="compare large documents (or batch pairs) in " +
+                      "N processes")
+    parser.add_option("-s", "--stream",
+                      action="store_true", dest="stream",
+                      metavar="BOOL", default=False,
+                      help="compare files as streams, without loading " +
+                      "them whole into memory")
+    parser.add_option("--decoder",
+                      action="store", type="choice", dest="decoder",
+                      choices=sorted(DECODERS), metavar="NAME",
+                      help="JSON decoder to use, one of " +
+                      ", ".join(sorted(DECODERS)) + " (default %s)" %
+                      default_decoder())
+    parser.add_option("-A", "--align-arrays",
+                      action="store_true", dest="align_arrays",
+                      metavar="BOOL", default=False,
+                      help="compare arrays by aligning their items, " +
+                      "reporting inserted, removed and moved items")
+    parser.add_option("--align-max-edits",
+                      action="store", type="int", dest="align_max_edits",
+                      metavar="N", default=ALIGN_MAX_EDITS,
+                      help="compare arrays index by index when aligning " +
+                      "them needs more than N edits (default %default)")
+    parser.add_option("--abs-tolerance",
+                      action="store", type="float", dest="abs_tolerance",
+                      metavar="X",
+                      help="numbers differing by at most X are equal")
+    parser.add_option("--rel-tolerance",
+                      action="store", type="float", dest="rel_tolerance",
+                      metavar="X",
+                      help="numbers differing by at most X times the " +
+                      "larger one are equal")
+    parser.add_option("-k", "--array-key",
+                      action="append", dest="array_key",
+                      metavar="PATH=FIELD", default=[],
+                      help="match items of arrays at PATH by their FIELD " +
+                      "instead of by their position (PATH is like a/b, " +
+                      "or /a/*/b anchored at the top of the document)")
+    parser.add_option("--cache",
+                      action="store", dest="cache", metavar="DIR",
+                      help="reuse diffs of files compared before, cached " +
+                      "in DIR")
+    parser.add_option("--cache-size",
+                      action="store", type="int", dest="cache_size",
+                      metavar="MB", default=DIFF_CACHE_SIZE // (1024 * 1024),
+                      help="limit size of the --cache directory " +
+                      "(default %default MB)")
+    parser.add_option("--stats",
+                      action="store_true", dest="stats",
+                      metavar="BOOL", default=False,
+                      help="print timings of phases and counters of the " +
+                      "comparison to stderr")
+    parser.add_option("--max-changes",
+                      action="store", type="int", dest="max_changes",
+                      metavar="N",
+                      help="stop comparing after N changes were found")
+    parser.add_option("--max-depth",
+                      action="store", type="int", dest="max_depth",
+                      metavar="N",
+                      help="do not compare containers nested deeper than " +
+                      "N levels")
+    parser.add_option("--timeout",
+                      action="store", type="float", dest="timeout",
+                      metavar="SECONDS",
+                      help="stop comparing after SECONDS")
+    parser.add_option("-q", "--quiet",
+                      action="store_true", dest="quiet",
+                      metavar="BOOL", default=False,
+                      help="output nothing, only set the exit status; " +
+                      "stops at the first difference")
+    parser.add_option("--trace",
+                      action="store_true", dest="trace",
+                      metavar="BOOL", default=False,
+                      help="print why each change was reported or " +
+                      "filtered out (by -x, -i, -a) to stderr as JSON lines")
+    parser.add_option("-b", "--batch",
+                      action="store_true", dest="batch",
+                      metavar="BOOL", default=False,
+                      help="compare all *.json files of two directory " +
+                      "trees (in --jobs processes)")
+    parser.add_option("-m", "--manifest",
+                      action="store", dest="manifest", metavar="FILE",
+                      help="compare pairs of files listed in FILE, one " +
+                      "'old new' pair per line (implies --batch)")
+    parser.add_option("-f", "--fan-out",
+                      action="store_true", dest="fan_out",
+                      metavar="BOOL", default=False,
+                      help="compare the first file (baseline) with each " +
+                      "of the other ones (in --jobs processes)")
+    parser.add_option("-d", "--diff-dir",
+                      action="store", dest="diff_dir", metavar="DIR",
+                      help="in batch mode, write also the diff of each " +
+                      "changed pair into DIR")
+    parser.add_option("--serve",
+                      action="store", dest="serve", metavar="ADDRESS",
+                      help="run as a server comparing documents with the " +
+                      "baselines it keeps in memory, over HTTP at " +
+                      "[HOST:]PORT (HOST is 127.0.0.1 by default) or " +
+                      "at Unix socket path")
+    parser.add_option("--serve-baseline",
+                      action="append", dest="serve_baseline",
+                      metavar="NAME=FILE", default=[],
+                      help="load FILE as the server's baseline NAME")
+    parser.add_option("--serve-memory",
+                      action="store", type="int", dest="serve_memory",
+                      metavar="MB", default=SERVER_MEMORY // (1024 * 1024),
+                      help="evict idle baselines when their JSON text " +
+                      "takes more (default %default MB)")
+    parser.add_option("--serve-requests",
+                      action="store", type="int", dest="serve_requests",
+                      metavar="N", default=SERVER_REQUESTS,
+                      help="refuse requests when the server is handling " +
+                      "N of them (default %default)")
     (options, args) = parser.parse_args(sys_args[1:])
+    for rule in options.array_key:
+        if "=" not in rule:
+            parser.error("--array-key requires PATH=FIELD, not %s" % rule)
+    if options.stream and (options.max_changes is not None or
+                           options.max_depth is not None or
+                           options.timeout is not None):
+        parser.error("--max-changes, --max-depth and --timeout cannot " +
+                     "be used with --stream.")
+    if options.patch and (options.stream or options.HTMLoutput):
+        parser.error("--patch cannot be used with --stream or --HTML.")
+    if options.lines and (options.stream or options.patch or
+                          options.max_changes is not None or
+                          options.max_depth is not None or
+                          options.timeout is not None):
+        parser.error("--lines cannot be used with --stream, --patch, " +
+                     "--max-changes, --max-depth or --timeout.")
+    if options.records and (options.stream or options.patch or
+                            options.max_changes is not None or
+                            options.max_depth is not None or
+                            options.timeout is not None):
+        parser.error("--records cannot be used with --stream, --patch, " +
+                     "--max-changes, --max-depth or --timeout.")
+
+    if options.serve:
+        return _main_serve(parser, options, args)
 
     if options.output:
         outf = open(options.output[0], "w")
     else:
         outf = sys.stdout
 
+    if options.manifest or options.batch or options.fan_out:
+        if options.stats:
+            parser.error("--stats cannot be used in batch mode.")
+        if options.trace:
+            parser.error("--trace cannot be used in batch mode.")
+        if options.quiet:
+            parser.error("--quiet cannot be used in batch mode.")
+        if options.patch:
+            parser.error("--patch cannot be used in batch mode.")
+        if options.lines:
+            parser.error("--lines cannot be used in batch mode.")
+        if options.records:
+            parser.error("--records cannot be used in batch mode.")
+        return _main_batch(parser, options, args, outf)
+
     if len(args) != 2:
         parser.error("Script requires two positional arguments, " +
                      "names for old and new JSON file.")
-    diff = Comparator(open(args[0]), open(args[1]), options)
-    diff_res = diff.compare_dicts()
+    stats = None
+    if options.stats:
+        stats = DiffStats()
+    if options.records:
+        return _main_records(options, args, outf, stats)
+    if options.quiet:
+        equal = files_equal(args[0], args[1], options, stats)
+        if stats is not None:
+            stats.write(sys.stderr)
+        if equal:
+            return 0
+        return 1
+    if options.lines:
+        changes = iter_file_changes(args[0], args[1], options, stats)
+        if stats is not None:
+            start = time.time()
+        count = _write_changes(changes, outf, options)
+        if stats is not None:
+            # changes are written while the documents are compared
+            stats.add_phase(u"compare", time.time() - start)
+            stats.write(sys.stderr)
+        if count > 0:
+            return 1
+        return 0
+    if options.patch:
+        diff_res = files_patch(args[0], args[1], options, stats)
+    else:
+        diff_res = compare_files(args[0], args[1], options, stats)
+    if stats is not None:
+        start = time.time()
+    _write_result(diff_res, outf, options)
+    if stats is not None:
+        stats.add_phase(u"format", time.time() - start)
+        stats.write(sys.stderr)
+
+    if len(diff_res) > 0:
+        return 1
+
+    return 0
+
+
+def _write_result(diff_res, outf, options):
+    """Write diff_res to outf as HTML or JSON, as requested by options."""
     if options.HTMLoutput:
         # we want to hardcode UTF-8 here, because that's what's
         # in <meta> element of the generated HTML
-        print >>outf, unicode(HTMLFormatter(diff_res)).encode("utf-8")
+        HTMLFormatter(diff_res).write(outf, "utf-8")
+        print >>outf
     else:
-        outs = json.dumps(diff_res, indent=4, ensure_ascii=False)
-        print >>outf, outs.encode("utf-8")
+        write_json(diff_res, outf, options.compact)
+        print >>outf
 
-    if len(diff_res) > 0:
+
+def _write_changes(changes, outf, options):
+    """Write changes to outf as they come, as JSON lines or as HTML rows
+    (as requested by options); return their number."""
+    if not options.HTMLoutput:
+        return write_changes(changes, outf)
+    count = [0]
+
+    def counted():
+        for change in changes:
+            count[0] += 1
+            yield change
+    HTMLFormatter(changes=counted()).write(outf, "utf-8")
+    print >>outf
+    return count[0]
+
+
+def _main_records(options, args, outf, stats):
+    """main() for -r, comparing NDJSON files of records."""
+    if stats is not None:
+        start = time.time()
+    changes = iter_record_file_changes(args[0], args[1], options.records,
+                                       options, stats)
+    try:
+        if options.quiet:
+            count = 0
+            for change in changes:
+                count = 1
+                break
+        elif options.lines:
+            count = _write_changes(changes, outf, options)
+        else:
+            diff_res = changes_to_diff(changes)
+            _write_result(diff_res, outf, options)
+            count = len(diff_res)
+    finally:
+        changes.close()
+    if stats is not None:
+        # records are read and sorted as part of the comparison
+        stats.add_phase(u"compare", time.time() - start)
+        stats.write(sys.stderr)
+    if count > 0:
+        return 1
+    return 0
+
+
+def _main_batch(parser, options, args, outf):
+    """
+    Batch part of main(): compare all pairs of files (or the candidates
+    with the baseline) and write the report, which looks like a diff of
+    two objects mapping pair (or candidate) names to documents.
+    """
+    if options.fan_out:
+        if len(args) < 2:
+            parser.error("Fan-out mode requires the baseline and at " +
+                         "least one candidate file.")
+        results = compare_fan_out(args[0], args[1:], options)
+    elif options.manifest:
+        if args:
+            parser.error("No positional arguments are used with --manifest.")
+        results = compare_batch(read_manifest(open(options.manifest)),
+                                options)
+    else:
+        if len(args) != 2 or not (os.path.isdir(args[0]) and
+                                  os.path.isdir(args[1])):
+            parser.error("Batch mode requires two positional arguments, " +
+                         "names for old and new directory.")
+        results = compare_batch(iter_tree_pairs(args[0], args[1]), options)
+
+    if options.HTMLoutput:
+        suffix = ".diff.html"
+    else:
+        suffix = ".diff.json"
+    result = {
+        u"_append": {},
+        u"_remove": {},
+        u"_update": {}
+    }
+    errors = 0
+    try:
+        for name, change_type, value in results:
+            if change_type == u"_error":
+                logging.error("%s: %s", name, value)
+                errors += 1
+                continue
+            if change_type is None or (change_type == u"_append" and
+                                       options.ignore_append):
+                continue
+            name = _text(name)
+            result[change_type][name] = value
+            if change_type == u"_update" and options.diff_dir:
+                parts = [part for part in name.split(u"/")
+                         if part not in (u"", u".", u"..")]
+                pair_name = os.path.join(options.diff_dir, *parts) + suffix
+                if not os.path.isdir(os.path.dirname(pair_name)):
+                    os.makedirs(os.path.dirname(pair_name))
+                pair_outf = open(pair_name, "w")
+                try:
+                    _write_result(value, pair_outf, options)
+                finally:
+                    pair_outf.close()
+    finally:
+        results.close()
+
+    diff_res = {}
+    for change_type in result:
+        if len(result[change_type]) > 0:
+            diff_res[change_type] = result[change_type]
+    _write_result(diff_res, outf, options)
+
+    if len(diff_res) > 0 or errors > 0:
         return 1
 
     return 0
 
+
+def _main_serve(parser, options, args):
+    """Server part of main(): load the baselines and serve until killed."""
+    if args:
+        parser.error("No positional arguments are used with --serve.")
+    if "/" in options.serve:
+        address = options.serve
+    else:
+        host, port = "127.0.0.1", options.serve
+        if ":" in port:
+            host, port = port.rsplit(":", 1)
+        try:
+            address = (host, int(port))
+        except ValueError:
+            parser.error("--serve requires [HOST:]PORT or a socket path, " +
+                         "not %s" % options.serve)
+    store = BaselineStore(options.serve_memory * 1024 * 1024, options)
+    for baseline in options.serve_baseline:
+        if "=" not in baseline:
+            parser.error("--serve-baseline requires NAME=FILE, not %s" %
+                         baseline)
+        name, path = baseline.split("=", 1)
+        infile = open(path)
+        try:
+            store.put(_text(name), decode_json(infile, options.decoder),
+                      os.path.getsize(path))
+        finally:
+            infile.close()
+
+    server = make_server(address, store, options, options.serve_requests)
+    logging.info("Serving at %s", options.serve)
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        if isinstance(address, basestring):
+            os.remove(address)
+    return 0
+
 if __name__ == "__main__":
     main_res = main(sys.argv)
     sys.exit(main_res)
@@ -23,6 +23,34 @@ class RunTests(Command):
         unittest.TextTestRunner(verbosity=2).run(test.test_json_diff.suite)
 
 
+class RunBenchmarks(Command):
+    """New setup.py command to run the benchmarks (see bench/run.py).
+    """
+    description = "run benchmarks, optionally against a stored baseline"
+
+    user_options = [
+        ("baseline=", "b", "fail on regressions against this baseline"),
+        ("save=", "s", "store the results as a baseline"),
+    ]
+
+    def initialize_options(self):
+        self.baseline = None
+        self.save = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        import bench.run
+        args = ["bench"]
+        if self.baseline:
+            args.extend(["--baseline", self.baseline])
+        if self.save:
+            args.extend(["--save", self.save])
+        if bench.run.main(args):
+            raise SystemExit(1)
+
+
 def read(fname):
     f = open(os.path.join(os.path.dirname(__file__), fname))
     out = "\n" + f.read().replace("\r\n", "\n")
@@ -45,7 +73,7 @@ setup(
     py_modules=['json_diff'],
     long_description=get_long_description(),
     keywords=['json', 'diff'],
-    cmdclass={'test': RunTests},
+    cmdclass={'test': RunTests, 'bench': RunBenchmarks},
     classifiers=[
         "Programming Language :: Python",
         "Development Status :: 4 - Beta",
@@ -6,6 +6,11 @@ import unittest
 import sys
 import tempfile
 import locale
+import os
+import shutil
+import gc
+import threading
+import httplib
 try:
     import json
 except ImportError:
@@ -22,16 +27,19 @@ from test_strings import ARRAY_DIFF, ARRAY_NEW, ARRAY_OLD, \
 
 
 class OptionsClass(object):
-    def __init__(self, inc=None, exc=None, ign=None):
+    def __init__(self, inc=None, exc=None, ign=None, **kwargs):
         self.exclude = exc
         self.include = inc
         self.ignore_append = ign
+        self.__dict__.update(kwargs)
 
 
 class OurTestCase(unittest.TestCase):
     def _run_test(self, oldf, newf, difff, msg="", opts=None):
         diffator = json_diff.Comparator(oldf, newf, opts)
-        diff = diffator.compare_dicts()
+        # indices of arrays become strings as in difff, so that both
+        # sort the same
+        diff = json.loads(json.dumps(diffator.compare_dicts()))
         expected = json.load(difff)
         self.assertEqual(json.dumps(diff, sort_keys=True),
                          json.dumps(expected, sort_keys=True),
@@ -127,6 +135,27 @@ class TestHappyPath(OurTestCase):
                                  "Simply nested objects (from file) " +
                                  "diff formatted as HTML.")
 
+    def test_nested_formatted_write(self):
+        diff = json_diff.Comparator(open("test/old.json"),
+                                    open("test/new.json")).compare_dicts()
+        formatter = json_diff.HTMLFormatter(diff)
+        outf = StringIO()
+        formatter.write(outf)
+        self.assertEqual(outf.getvalue().decode("utf-8"), unicode(formatter))
+
+    def test_write_json(self):
+        diff = json.loads(NESTED_DIFF)
+        outf = StringIO()
+        json_diff.write_json(diff, outf)
+        self.assertEqual(outf.getvalue(),
+                         json.dumps(diff, indent=4,
+                                    ensure_ascii=False).encode("utf-8"))
+        outf = StringIO()
+        json_diff.write_json(diff, outf, compact=True)
+        self.assertEqual(outf.getvalue(),
+                         json.dumps(diff, separators=(",", ":"),
+                                    ensure_ascii=False).encode("utf-8"))
+
     def test_nested_excluded(self):
         self._run_test_strings(NESTED_OLD, NESTED_NEW, NESTED_DIFF_EXCL,
                                "Nested objects diff with exclusion.",
@@ -146,9 +175,28 @@ class TestHappyPath(OurTestCase):
     def test_large_recursive_file(self):
         self._run_test(open("test/DMS_1121_1.json.1.out"),
                        open("test/DMS_1121_1.json.2.out"),
-                       open("test/diff.json"),
+                       open("test/DMS_1121_1.diff.json"),
                        "Simply nested objects (from file) diff.")
 
+    def test_deeply_nested(self):
+        depth = sys.getrecursionlimit() * 2
+        old = new = None
+        for level in range(depth):
+            old = {"a": [old], "b": level}
+            new = {"a": [new], "b": level}
+        bottom = new
+        while bottom["a"][0] is not None:
+            bottom = bottom["a"][0]
+        bottom["b"] = -1
+
+        diff = json_diff.Comparator().compare_dicts(old, new)
+        levels = 0
+        while "a" in diff["_update"]:
+            diff = diff["_update"]["a"]["_update"][0]
+            levels += 1
+        self.assertEqual(levels, depth - 1)
+        self.assertEqual(diff, {"_update": {"b": -1}})
+
 
 class TestBadPath(OurTestCase):
     def test_no_JSON(self):
@@ -175,10 +223,1322 @@ class TestPiglitData(OurTestCase):
                        "Large piglit reports diff (just resume field).",
                        OptionsClass(inc=["result"]))
 
-#    def test_piglit_results(self):
-#        self._run_test(open("test/old-testing-data.json"),
-#            open("test/new-testing-data.json"),
-#            open("test/diff-testing-data.json"), "Large piglit results diff.")
+    def test_piglit_results(self):
+        self._run_test(open("test/old-testing-data.json"),
+                       open("test/new-testing-data.json"),
+                       open("test/diff-testing-data.json"),
+                       "Large piglit results diff.")
+
+
+class TestStreaming(OurTestCase):
+    def _run_stream_test(self, olds, news, msg="", opts=None, chunk_size=7):
+        expected = json_diff.Comparator(StringIO(olds), StringIO(news),
+                                        opts).compare_dicts()
+        diffator = json_diff.StreamingComparator(StringIO(olds),
+                                                 StringIO(news), opts)
+        diffator.chunk_size = chunk_size
+        diff = diffator.compare_dicts()
+        self.assertEqual(json.dumps(diff, sort_keys=True),
+                         json.dumps(expected, sort_keys=True),
+                         msg + "\n\nexpected = %s\n\nobserved = %s" %
+                         (expected, diff))
+
+    def test_events(self):
+        events = list(json_diff.iter_json_events(
+            StringIO('{"a": [1, 2.5, "x\\"y"], "b": {}, "c": null}'), 3))
+        self.assertEqual(events, [
+            (json_diff.START_MAP, None), (json_diff.MAP_KEY, u"a"),
+            (json_diff.START_ARRAY, None), (json_diff.VALUE, 1),
+            (json_diff.VALUE, 2.5), (json_diff.VALUE, u'x"y'),
+            (json_diff.END_ARRAY, None), (json_diff.MAP_KEY, u"b"),
+            (json_diff.START_MAP, None), (json_diff.END_MAP, None),
+            (json_diff.MAP_KEY, u"c"), (json_diff.VALUE, None),
+            (json_diff.END_MAP, None)])
+
+    def test_simple(self):
+        self._run_stream_test(SIMPLE_OLD, SIMPLE_NEW, "Streamed scalars.")
+
+    def test_arrays(self):
+        self._run_stream_test(ARRAY_OLD, ARRAY_NEW, "Streamed arrays.")
+        self._run_stream_test(SIMPLE_ARRAY_NEW, SIMPLE_ARRAY_OLD,
+                              "Streamed shortened array.")
+
+    def test_nested(self):
+        self._run_stream_test(NESTED_OLD, NESTED_NEW, "Streamed nesting.")
+        self._run_stream_test(NESTED_OLD, NESTED_NEW, "Streamed exclusion.",
+                              OptionsClass(exc=["nome"]))
+
+    def test_reordered_keys(self):
+        self._run_stream_test(u'{"a": {"x": [1, {}]}, "b": 2, "c": {}}',
+                              u'{"c": {}, "b": 3, "a": {"x": [1, {"y": 1}]}}',
+                              "Keys in different order.")
+
+    def test_sparse_changes(self):
+        olds = u'{"r": [{"a": [1]}, {"a": [2]}, {"a": [3], "b": 1}], "s": {}}'
+        news = u'{"r": [{"a": [1]}, {"a": [4]}, {"a": [3], "b": 2}], "s": {}}'
+        self._run_stream_test(olds, news, "Few changes among many values.")
+        self.assertEqual(json_diff.Comparator(
+            StringIO(olds), StringIO(news)).compare_dicts(),
+            {u"_update": {u"r": {u"_update": {
+                1: {u"_update": {u"a": {u"_update": {0: 4}}}},
+                2: {u"_update": {u"b": 2}}}}}})
+
+    def test_type_changes(self):
+        self._run_stream_test(u'{"a": {"x": 1}, "b": [1], "c": 1, "d": []}',
+                              u'{"a": [1], "b": {"x": 1}, "c": 1.0, "d": 0}',
+                              "Changed types of values.")
+
+    def test_piglit_result_only(self):
+        diffator = json_diff.StreamingComparator(
+            open("test/old-testing-data.json"),
+            open("test/new-testing-data.json"), OptionsClass(inc=["result"]))
+        self.assertEqual(diffator.compare_dicts(),
+                         json.load(open(
+                             "test/diff-result-only-testing-data.json")))
+
+    def test_bad_JSON(self):
+        for bad in (NO_JSON_OLD, u'{"a": 1', u'{"a": 1} 2', u'{"a" 1}',
+                    u'{"a": 0x1}', u'{"a": [1,]}', u''):
+            diffator = json_diff.StreamingComparator(StringIO(bad),
+                                                     StringIO(u'{}'))
+            self.assertRaises(json_diff.BadJSONError,
+                              diffator.compare_dicts)
+
+
+class TestSubtreeHashes(OurTestCase):
+    def test_digest(self):
+        hashes = json_diff.SubtreeHashes()
+        self.assertEqual(hashes.digest({"a": [1, {"b": None}], "c": u"x"}),
+                         hashes.digest({"c": u"x", "a": [1, {"b": None}]}))
+        self.assertNotEqual(hashes.digest([1]), hashes.digest([1.0]))
+        self.assertNotEqual(hashes.digest([1]), hashes.digest([True]))
+        self.assertNotEqual(hashes.digest({"a": [1]}),
+                            hashes.digest({"a": [[1]]}))
+
+    def test_same_results(self):
+        old = json.load(open("test/old-testing-data.json"))
+        new = json.load(open("test/new-testing-data.json"))
+        opts = OptionsClass(inc=["result"])
+        diffator = json_diff.Comparator(opts=opts,
+                                        hashes=json_diff.SubtreeHashes())
+        self.assertEqual(diffator.compare_dicts(old, new),
+                         json_diff.Comparator(opts=opts).compare_dicts(old,
+                                                                       new))
+
+    def test_aligned_items(self):
+        old = {"a": [{"b": 1}, {"b": 2}]}
+        new = {"a": [{"b": 2}, {"b": 3}]}
+        hashes = json_diff.SubtreeHashes()
+        json_diff.Comparator(hashes=hashes).compare_dicts(old, new)
+        # only items of aligned arrays are hashed
+        self.assertEqual(len(hashes), 0)
+        json_diff.Comparator(opts=OptionsClass(align_arrays=True),
+                             hashes=hashes).compare_dicts(old, new)
+        self.assertEqual(len(hashes), 4)
+
+    def test_base(self):
+        shared = [1]
+        base = json_diff.SubtreeHashes()
+        expected = base.digest({"a": shared})
+        overlay = json_diff.SubtreeHashes(base)
+        self.assertEqual(overlay.digest({"a": shared}), expected)
+        # shared is looked up in base, base learns nothing new
+        self.assertEqual(len(overlay), 1)
+        self.assertEqual(len(base), 2)
+        self.assertEqual(overlay.known(shared), base.known(shared))
+        self.assertEqual(base.known([1]), None)
+
+
+class TestAlignedArrays(OurTestCase):
+    def _compare(self, old, new, **kwargs):
+        opts = OptionsClass(align_arrays=True, **kwargs)
+        return json_diff.Comparator(opts=opts).compare_dicts({"a": old},
+                                                             {"a": new})
+
+    def test_insert_front(self):
+        old = range(1000)
+        self.assertEqual(self._compare(old, [-1] + old),
+                         {"_update": {"a": {"_append": {0: -1}}}})
+        self.assertEqual(self._compare(old, old[1:]),
+                         {"_update": {"a": {"_remove": {0: 0}}}})
+
+    def test_move(self):
+        self.assertEqual(self._compare([{"x": 1}, 2, 3, 4],
+                                       [2, 3, 4, {"x": 1}]),
+                         {"_update": {"a": {"_move": {0: 3}}}})
+
+    def test_update_in_place(self):
+        self.assertEqual(self._compare([1, {"x": 1}, 3], [0, 1, {"x": 2}, 3]),
+                         {"_update": {"a": {"_append": {0: 0},
+                                            "_update": {2: {"_update":
+                                                            {"x": 2}}}}}})
+
+    def test_fallback(self):
+        self.assertEqual(self._compare([1, 2, 3], [0, 1, 2, 3],
+                                       align_max_edits=0),
+                         {"_update": {"a": {"_append": {3: 3},
+                                            "_update": {0: 0, 1: 1, 2: 2}}}})
+
+    def test_streaming(self):
+        old = u'{"a": [1, 2, [3], {"b": 4}], "c": 5}'
+        new = u'{"a": [[3], 1, 2, {"b": 5}, 6], "c": 5}'
+        opts = OptionsClass(align_arrays=True)
+        self.assertEqual(
+            json_diff.StreamingComparator(StringIO(old), StringIO(new),
+                                          opts).compare_dicts(),
+            json_diff.Comparator(StringIO(old), StringIO(new),
+                                 opts).compare_dicts())
+
+
+class TestKeyedArrays(OurTestCase):
+    OLD = {"a": [{"id": 1, "v": 1}, {"id": 2, "v": 2}, {"id": 3, "v": 3}],
+           "b": {"a": [{"id": 5}]}}
+    NEW = {"a": [{"id": 4, "v": 4}, {"id": 3, "v": 3}, {"id": 1, "v": 0}],
+           "b": {"a": [{"id": 6}]}}
+
+    def _compare(self, old, new, *rules):
+        opts = OptionsClass(array_key=list(rules))
+        return json_diff.Comparator(opts=opts).compare_dicts(old, new)
+
+    def test_match_by_key(self):
+        diff = self._compare(self.OLD, self.NEW, "a=id")
+        self.assertEqual(diff[u"_update"][u"a"],
+                         {"_append": {4: {"id": 4, "v": 4}},
+                          "_remove": {2: {"id": 2, "v": 2}},
+                          "_update": {1: {"_update": {"v": 0}}}})
+        # unanchored path matches at any depth
+        self.assertEqual(diff[u"_update"][u"b"],
+                         {"_update": {"a": {"_append": {6: {"id": 6}},
+                                            "_remove": {5: {"id": 5}}}}})
+
+    def test_anchored_path(self):
+        diff = self._compare(self.OLD, self.NEW, "/b/a=id", "/*/nothing=id")
+        self.assertEqual(diff[u"_update"][u"a"][u"_update"][0],
+                         {"_update": {"id": 4, "v": 4}})
+        self.assertEqual(diff[u"_update"][u"b"][u"_update"][u"a"],
+                         {"_append": {6: {"id": 6}},
+                          "_remove": {5: {"id": 5}}})
+
+    def test_missing_key(self):
+        self.assertEqual(self._compare({"a": [{"x": 1}]}, {"a": [{"x": 2}]},
+                                       "a=id"),
+                         {"_update": {"a": {"_update": {0: {"_update":
+                                                            {"x": 2}}}}}})
+
+    def test_streaming(self):
+        opts = OptionsClass(array_key=["a=id"])
+        old = StringIO(json.dumps(self.OLD))
+        new = StringIO(json.dumps(self.NEW))
+        self.assertEqual(
+            json_diff.StreamingComparator(old, new, opts).compare_dicts(),
+            self._compare(self.OLD, self.NEW, "a=id"))
+
+
+class TestPathFilters(OurTestCase):
+    OLD = {"a": {"b": 1, "c": 1}, "c": {"a": {"b": 1}}, "d": [{"b": 1}]}
+    NEW = {"a": {"b": 2, "c": 2}, "c": {"a": {"b": 2}}, "d": [{"b": 2}]}
+
+    def _compare(self, **kwargs):
+        return json_diff.Comparator(opts=OptionsClass(**kwargs)).\
+            compare_dicts(self.OLD, self.NEW)
+
+    def test_exclude_path(self):
+        self.assertEqual(self._compare(exc=["/a/b", "d/*"]),
+                         {"_update": {"a": {"_update": {"c": 2}},
+                                      "c": {"_update": {"a": {"_update":
+                                                              {"b": 2}}}}}})
+
+    def test_include_path(self):
+        self.assertEqual(self._compare(inc=["/d/*/b", "c/a/b"]),
+                         {"_update": {"c": {"_update": {"a": {"_update":
+                                                              {"b": 2}}}},
+                                      "d": {"_update": {0: {"_update":
+                                                            {"b": 2}}}}}})
+
+    def test_slash_in_keys(self):
+        old = {u"tests": {u"spec/glsl/foo": {u"result": u"pass"},
+                          u"spec/glsl/bar": {u"result": u"pass"}}}
+        new = {u"tests": {u"spec/glsl/foo": {u"result": u"fail"},
+                          u"spec/glsl/bar": {u"result": u"fail"}}}
+        bar = {u"_update": {u"tests": {u"_update": {
+            u"spec/glsl/bar": {u"_update": {u"result": u"fail"}}}}}}
+        for opts in (OptionsClass(exc=[u"spec/glsl/foo"]),
+                     OptionsClass(inc=[u"spec/glsl/bar"]),
+                     OptionsClass(inc=[u"/tests/spec~1glsl~1bar/result"])):
+            self.assertEqual(json_diff.Comparator(opts=opts).compare_dicts(
+                old, new), bar)
+
+    def test_include_subtree(self):
+        self.assertEqual(self._compare(inc=["/c"]),
+                         {"_update": {"c": {"_update": {"a": {"_update":
+                                                              {"b": 2}}}}}})
+
+    def test_excluded_not_compared(self):
+        compared = []
+        diffator = json_diff.Comparator(opts=OptionsClass(exc=["a"],
+                                                          inc=["/d"]))
+        original = diffator._expand_dicts
+
+        def counting(old, new, state, result):
+            compared.append(old)
+            return original(old, new, state, result)
+        diffator._expand_dicts = counting
+        diffator.compare_dicts(self.OLD, self.NEW)
+        self.assertEqual(compared, [self.OLD, self.OLD["d"][0]])
+
+
+class TestParallel(OurTestCase):
+    def _compare(self, opts):
+        old = json.load(open("test/old-testing-data.json"))
+        new = json.load(open("test/new-testing-data.json"))
+        serial = json_diff.Comparator(opts=opts).compare_dicts(old, new)
+        opts.jobs = 3
+        diffator = json_diff.Comparator(opts=opts)
+        diffator.parallel_min_nodes = 1
+        root, leaves = diffator._plan_parallel(old, new)
+        self.assertTrue(len(leaves) > 3)
+        self.assertEqual(diffator.compare_dicts(old, new), serial)
+
+    def test_same_results(self):
+        self._compare(OptionsClass())
+
+    def test_filters(self):
+        self._compare(OptionsClass(inc=["result"], exc=["/tests/*/info"]))
+
+    def test_small_serial(self):
+        diffator = json_diff.Comparator(opts=OptionsClass(jobs=3))
+        diffator._compare_parallel = None
+        self.assertEqual(diffator.compare_dicts({"a": [1, 2]},
+                                                {"a": [1, 3]}),
+                         {"_update": {"a": {"_update": {1: 3}}}})
+
+
+class TestStats(unittest.TestCase):
+    def test_disabled(self):
+        diffator = json_diff.Comparator(StringIO(NESTED_OLD),
+                                        StringIO(NESTED_NEW))
+        diffator.compare_dicts()
+        self.assertEqual(diffator.stats, None)
+
+    def test_counters(self):
+        diffator = json_diff.Comparator(StringIO(NESTED_OLD),
+                                        StringIO(NESTED_NEW),
+                                        OptionsClass(stats=True))
+        diff = diffator.compare_dicts()
+        stats = diffator.stats
+        self.assertEqual(stats.phases, [u"parse", u"compare"])
+        # top level object and "child"
+        self.assertEqual(stats.containers, 2)
+        self.assertEqual(stats.max_depth, 1)
+        self.assertEqual(stats.skipped, 0)
+        # the top diff with three kinds of changes, "child" with one
+        self.assertEqual(stats.result_dicts, 6)
+        self.assertEqual(stats.as_dict()[u"containers"], 2)
+        self.assertEqual(len(diff), 3)
+
+    def test_skipped(self):
+        stats = json_diff.DiffStats()
+        json_diff.Comparator(opts=OptionsClass(exc=["a"]), stats=stats).\
+            compare_dicts({"a": [1], "b": {"c": [1]}, "d": {"e": 1}},
+                          {"a": [2], "b": {"c": [1]}, "d": {"e": 2}})
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(stats.containers, 4)
+
+    def test_equal(self):
+        shared = {"x": [1]}
+        stats = json_diff.DiffStats()
+        tracer = json_diff.DiffTracer()
+        diff = json_diff.Comparator(stats=stats, tracer=tracer).\
+            compare_dicts({"a": shared, "b": {"c": 1}},
+                          {"a": shared, "b": {"c": 2}})
+        self.assertEqual(diff, {u"_update": {"b": {u"_update": {"c": 2}}}})
+        # the same object is not walked
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(stats.containers, 2)
+        self.assertEqual(tracer.records[0], (("a",), None, u"equal"))
+        # nor are subtrees with equal hashes known from aligning items
+        stats = json_diff.DiffStats()
+        diff = json_diff.Comparator(opts=OptionsClass(align_arrays=True),
+                                    stats=stats).compare_dicts(
+            {"a": [{"b": 3, "d": {"e": [1]}}]},
+            {"a": [{"b": 4, "d": {"e": [1]}}]})
+        self.assertEqual(diff, {u"_update": {"a": {u"_update": {
+            0: {u"_update": {"b": 4}}}}}})
+        self.assertEqual(stats.skipped, 1)
+
+    def test_frames(self):
+        stats = json_diff.DiffStats()
+        json_diff.Comparator(stats=stats).compare_dicts(
+            {"a": [{"x": 1}] * 10, "b": {"c": {"d": 1}}},
+            {"a": [{"x": 1}] * 10, "b": {"c": {"d": 2}}})
+        self.assertEqual(stats.containers, 14)
+        # the unchanged items of "a" reuse one spare result
+        self.assertEqual(stats.frames, 4)
+
+
+class TestTracing(unittest.TestCase):
+    OLD = {"a": {"x": 1, "y": 1}, "b": [1, 2], "c": 1}
+    NEW = {"a": {"x": 2, "y": 1, "z": 3}, "b": [1, 3], "c": 1}
+
+    def _trace(self, opts, comparator=json_diff.Comparator):
+        tracer = json_diff.DiffTracer()
+        diff = comparator(opts=opts, tracer=tracer).compare_dicts(self.OLD,
+                                                                  self.NEW)
+        return diff, sorted(tracer.records)
+
+    def test_disabled(self):
+        self.assertEqual(json_diff.Comparator().tracer, None)
+
+    def test_decisions(self):
+        diff, records = self._trace(OptionsClass(exc=["b"], ign=True))
+        self.assertEqual(records,
+                         [((u"a", u"x"), u"_update", u"reported"),
+                          ((u"a", u"z"), u"_append", u"ignored"),
+                          ((u"b",), None, u"excluded")])
+        self.assertEqual(diff, {u"_update": {u"a": {u"_update": {u"x": 2}}}})
+
+    def test_not_included(self):
+        diff, records = self._trace(OptionsClass(inc=["/b"]))
+        self.assertEqual(records,
+                         [((u"a",), None, u"not_included"),
+                          ((u"b", 1), u"_update", u"reported")])
+        self.assertEqual(diff, {u"_update": {u"b": {u"_update": {1: 3}}}})
+
+    def test_streaming(self):
+        tracer = json_diff.DiffTracer()
+        json_diff.StreamingComparator(
+            StringIO(json.dumps(self.OLD)), StringIO(json.dumps(self.NEW)),
+            OptionsClass(exc=["b"], ign=True), tracer=tracer).compare_dicts()
+        self.assertEqual(sorted(tracer.records),
+                         [((u"a", u"x"), u"_update", u"reported"),
+                          ((u"a", u"z"), u"_append", u"ignored"),
+                          ((u"b",), None, u"excluded")])
+
+    def test_json_lines(self):
+        outf = StringIO()
+        json_diff.Comparator(opts=OptionsClass(exc=["a"]),
+                             tracer=json_diff.DiffTracer(outf)).\
+            compare_dicts(self.OLD, self.NEW)
+        lines = sorted([json.loads(line) for line in
+                        outf.getvalue().splitlines()])
+        self.assertEqual(lines[0], {u"path": [u"a"], u"change": None,
+                                    u"decision": u"excluded"})
+        self.assertEqual(lines[1], {u"path": [u"b", 1],
+                                    u"change": u"_update",
+                                    u"decision": u"reported"})
+
+
+class TestQuiet(unittest.TestCase):
+    def test_are_equal(self):
+        diffator = json_diff.Comparator(StringIO(NESTED_OLD),
+                                        StringIO(NESTED_NEW))
+        self.assertFalse(diffator.are_equal())
+        self.assertTrue(diffator.are_equal(diffator.obj1,
+                                           json.loads(NESTED_OLD)))
+        self.assertEqual(json_diff.Comparator(opts=OptionsClass(exc=["b"])).
+                         are_equal({"a": 1, "b": 1}, {"a": 1, "b": 2}), True)
+
+    def test_stops_at_first_change(self):
+        old = dict([(u"k%d" % idx, {u"v": idx}) for idx in range(10)])
+        new = dict([(u"k%d" % idx, {u"v": -idx}) for idx in range(10)])
+        stats = json_diff.DiffStats()
+        self.assertFalse(json_diff.Comparator(stats=stats).are_equal(old,
+                                                                     new))
+        self.assertEqual(stats.containers, 2)
+
+    def test_streaming(self):
+        self.assertFalse(json_diff.StreamingComparator(
+            StringIO(NESTED_OLD), StringIO(NESTED_NEW)).are_equal())
+        self.assertTrue(json_diff.StreamingComparator(
+            StringIO(NESTED_OLD), StringIO(NESTED_OLD)).are_equal())
+
+    def test_files_equal(self):
+        self.assertTrue(json_diff.files_equal("test/old.json",
+                                              "test/old.json"))
+        self.assertFalse(json_diff.files_equal("test/old.json",
+                                               "test/new.json"))
+
+    def test_main(self):
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            same = json_diff.main(["./test_json_diff.py", "-q",
+                                   "test/old.json", "test/old.json"])
+            different = json_diff.main(["./test_json_diff.py", "-q",
+                                        "test/old.json", "test/new.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual((same, different), (0, 1))
+        self.assertEqual(save_stdout.getvalue(), "")
+
+
+class TestBudgets(unittest.TestCase):
+    OLD = {"a": {"b": {"c": {"d": 1}}, "x": 1},
+           "l": [{"q": 1}, {"q": 2}], "z": 1}
+    NEW = {"a": {"b": {"c": {"d": 2}}, "x": 2},
+           "l": [{"q": -1}, {"q": -2}], "z": 2}
+
+    def _compare(self, **kwargs):
+        return json_diff.Comparator(opts=OptionsClass(**kwargs)).\
+            compare_dicts(self.OLD, self.NEW)
+
+    def test_max_changes(self):
+        diff = self._compare(max_changes=1)
+        self.assertEqual(diff, {u"_update": {u"z": 2},
+                                u"_truncated": {u"limits": [u"max_changes"],
+                                                u"changes": 1,
+                                                u"skipped": 2}})
+
+    def test_max_depth(self):
+        diff = self._compare(max_depth=1)
+        self.assertEqual(diff[u"_update"][u"a"], {u"_update": {u"x": 2}})
+        # "b" and both items of "l"
+        self.assertEqual(diff[u"_truncated"][u"skipped"], 3)
+        self.assertEqual(diff[u"_truncated"][u"limits"], [u"max_depth"])
+
+    def test_deep_max_depth(self):
+        depth = sys.getrecursionlimit() * 2
+        old = new = None
+        for level in range(depth):
+            old = {"a": [old], "b": level}
+            new = {"a": [new], "b": level}
+        new["b"] = -1
+        diff = json_diff.compare_objects(old, new, max_depth=3)
+        self.assertEqual(diff[u"_update"][u"b"], -1)
+        self.assertEqual(diff[u"_truncated"], {u"limits": [u"max_depth"],
+                                               u"changes": 1,
+                                               u"skipped": 1})
+
+    def test_within_limits(self):
+        self.assertEqual(self._compare(max_changes=10, max_depth=3,
+                                       timeout=60),
+                         json_diff.Comparator().compare_dicts(self.OLD,
+                                                              self.NEW))
+
+    def test_timeout(self):
+        diff = self._compare(timeout=0)
+        self.assertEqual(diff[u"_truncated"][u"limits"], [u"timeout"])
+
+    def test_html(self):
+        page = unicode(json_diff.HTMLFormatter(self._compare(max_depth=0)))
+        self.assertTrue(u"truncated (max_depth)" in page)
+
+
+class TestDecoders(unittest.TestCase):
+    def test_default(self):
+        self.assertTrue(json_diff.default_decoder() in json_diff.DECODERS)
+
+    def test_all_decoders(self):
+        expected = json.load(open("test/old-testing-data.json"))
+        for name in json_diff.DECODERS:
+            infile = open("test/old-testing-data.json")
+            try:
+                self.assertEqual(json_diff.decode_json(infile, name),
+                                 expected, name)
+            finally:
+                infile.close()
+
+    def test_read_input(self):
+        infile = open("test/old.json", "rb")
+        try:
+            expected = infile.read()
+            infile.seek(3)
+            self.assertEqual(json_diff.read_input(infile), expected[3:])
+            self.assertEqual(infile.read(), "")
+        finally:
+            infile.close()
+        self.assertEqual(json_diff.read_input(StringIO(u"[1]")), u"[1]")
+
+    def test_bad_json(self):
+        self.assertRaises(ValueError, json_diff.decode_json,
+                          StringIO(NO_JSON_OLD))
+        self.assertTrue(gc.isenabled())
+
+    def test_comparator(self):
+        diffator = json_diff.Comparator(StringIO(NESTED_OLD),
+                                        StringIO(NESTED_NEW),
+                                        OptionsClass(decoder=u"json"))
+        self.assertEqual(diffator.decoder, u"json")
+        self.assertEqual(diffator.compare_dicts(),
+                         json_diff.Comparator(StringIO(NESTED_OLD),
+                                              StringIO(NESTED_NEW)).
+                         compare_dicts())
+
+
+class TestPatch(unittest.TestCase):
+    def _roundtrip(self, old, new, opts=None):
+        patch = json_diff.Comparator(opts=opts).compare_patch(old, new)
+        patched = json_diff.apply_patch(json.loads(json.dumps(old)),
+                                        json.loads(json.dumps(patch)))
+        self.assertEqual(patched, new)
+        return patch
+
+    def test_patch(self):
+        patch = self._roundtrip(json.loads(NESTED_OLD), json.loads(NESTED_NEW))
+        self.assertEqual(patch[0], {u"op": u"replace", u"path": u"/a",
+                                    u"value": 2})
+
+    def test_arrays(self):
+        patch = self._roundtrip({u"l": [1, 2, 3, 4]}, {u"l": [1, 5]})
+        self.assertEqual(patch,
+                         [{u"op": u"replace", u"path": u"/l/1",
+                           u"value": 5},
+                          {u"op": u"remove", u"path": u"/l/3"},
+                          {u"op": u"remove", u"path": u"/l/2"}])
+        self._roundtrip([[1], {u"a": [1, 2]}], [[1, 2], {u"a": [3]}])
+        # aligned and keyed arrays are patched by positions anyway
+        self._roundtrip({u"l": [{u"k": 1}, {u"k": 2}]},
+                        {u"l": [{u"k": 2}, {u"k": 3}]},
+                        OptionsClass(align_arrays=True, array_key=[u"l=k"]))
+
+    def test_null_and_types(self):
+        self._roundtrip({u"a": 1, u"b": [1], u"c": {}},
+                        {u"a": None, u"b": {}, u"c": u"x"})
+        self._roundtrip({u"a": 1}, [1])
+        self.assertEqual(json_diff.Comparator().compare_patch([], []), [])
+
+    def test_pointer_escapes(self):
+        patch = self._roundtrip({u"a/b": 1, u"c~d": {u"": 1}},
+                                {u"a/b": 2, u"c~d": {u"": 2}})
+        self.assertEqual([op[u"path"] for op in patch],
+                         [u"/a~1b", u"/c~0d/"])
+
+    def test_filters(self):
+        patch = json_diff.Comparator(opts=OptionsClass(exc=[u"b"])).\
+            compare_patch({u"a": 1, u"b": 1}, {u"a": 2, u"b": 2})
+        self.assertEqual(patch, [{u"op": u"replace", u"path": u"/a",
+                                  u"value": 2}])
+
+    def test_apply_operations(self):
+        doc = {u"a": [1, 2], u"b": {u"c": 1}}
+        res = json_diff.apply_patch(doc, [
+            {u"op": u"add", u"path": u"/a/-", u"value": 3},
+            {u"op": u"add", u"path": u"/a/0", u"value": 0},
+            {u"op": u"move", u"from": u"/b/c", u"path": u"/d"},
+            {u"op": u"copy", u"from": u"/a", u"path": u"/e"},
+            {u"op": u"test", u"path": u"/d", u"value": 1}])
+        self.assertTrue(res is doc)
+        self.assertEqual(doc, {u"a": [0, 1, 2, 3], u"b": {}, u"d": 1,
+                               u"e": [0, 1, 2, 3]})
+        self.assertFalse(doc[u"a"] is doc[u"e"])
+        self.assertEqual(json_diff.apply_patch(doc, [
+            {u"op": u"replace", u"path": u"", u"value": 1}]), 1)
+
+    def test_apply_errors(self):
+        for operation in ({u"op": u"remove", u"path": u"/x"},
+                          {u"op": u"replace", u"path": u"/a/2",
+                           u"value": 1},
+                          {u"op": u"add", u"path": u"/a/01", u"value": 1},
+                          {u"op": u"add", u"path": u"a", u"value": 1},
+                          {u"op": u"test", u"path": u"/a/0",
+                           u"value": True},
+                          {u"op": u"move", u"from": u"/a",
+                           u"path": u"/a/0"},
+                          {u"op": u"frobnicate", u"path": u""},
+                          {u"path": u"/a"}):
+            self.assertRaises(json_diff.PatchError, json_diff.apply_patch,
+                              {u"a": [1]}, [operation])
+
+    def test_main(self):
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            res = json_diff.main(["./test_json_diff.py", "-p",
+                                  "test/old.json", "test/new.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(res, 1)
+        patch = json.loads(save_stdout.getvalue())
+        self.assertEqual(json_diff.apply_patch(
+            json.load(open("test/old.json")), patch),
+            json.load(open("test/new.json")))
+
+
+class TestChanges(unittest.TestCase):
+    def test_changes(self):
+        changes = sorted(json_diff.Comparator().iter_changes(
+            {u"a": 1, u"b": [1, {u"c": 2}], u"d": 1},
+            {u"a": 2, u"b": [1, {u"c": 3}, 4], u"e": 1}))
+        self.assertEqual(changes, [
+            ((u"a",), u"_update", 1, 2),
+            ((u"b", 1, u"c"), u"_update", 2, 3),
+            ((u"b", 2), u"_append", None, 4),
+            ((u"d",), u"_remove", 1, None),
+            ((u"e",), u"_append", None, 1)])
+        self.assertEqual(list(json_diff.Comparator().iter_changes(1, [1])),
+                         [((), u"_update", 1, [1])])
+
+    def test_filters_and_keys(self):
+        opts = OptionsClass(exc=[u"x"], array_key=[u"l=id"])
+        changes = list(json_diff.Comparator(opts=opts).iter_changes(
+            {u"x": 1, u"l": [{u"id": 1, u"v": 1}, {u"id": 2, u"v": 2}]},
+            {u"x": 2, u"l": [{u"id": 2, u"v": 3}, {u"id": 1, u"v": 1}]}))
+        self.assertEqual(changes, [((u"l", 2, u"v"), u"_update", 2, 3)])
+        opts = OptionsClass(align_arrays=True)
+        changes = list(json_diff.Comparator(opts=opts).iter_changes(
+            [0, 1, [2]], [1, [3], 0]))
+        self.assertEqual(sorted(changes), [
+            ((0,), u"_move", 0, 2), ((1, 0), u"_update", 2, 3)])
+
+    def test_same_as_diff(self):
+        old = json.load(open("test/old-testing-data.json"))
+        new = json.load(open("test/new-testing-data.json"))
+        comparator = json_diff.Comparator()
+        self.assertEqual(
+            json_diff.changes_to_diff(comparator.iter_changes(old, new)),
+            comparator.compare_dicts(old, new))
+
+    def test_stop_early(self):
+        stats = json_diff.DiffStats()
+        changes = json_diff.Comparator(stats=stats).iter_changes(
+            {u"a": [{u"b": idx} for idx in range(1000)]},
+            {u"a": [{u"b": -idx} for idx in range(1000)]})
+        self.assertEqual(changes.next(), ((u"a", 1, u"b"), u"_update", 1, -1))
+        self.assertTrue(stats.containers < 10)
+
+    def test_streaming(self):
+        comparator = json_diff.StreamingComparator(StringIO(NESTED_OLD),
+                                                   StringIO(NESTED_NEW))
+        self.assertRaises(ValueError, comparator.iter_changes)
+        self.assertEqual(list(comparator.iter_changes({u"a": 1}, {})),
+                         [((u"a",), u"_remove", 1, None)])
+
+    def test_outputs(self):
+        changes = list(json_diff.Comparator(StringIO(NESTED_OLD),
+                                            StringIO(NESTED_NEW)).
+                       iter_changes())
+        outf = StringIO()
+        self.assertEqual(json_diff.write_changes(iter(changes), outf),
+                         len(changes))
+        self.assertEqual([json.loads(line) for line in
+                          outf.getvalue().splitlines()],
+                         [[list(path), change_type, old, new]
+                          for path, change_type, old, new in changes])
+        diff = json_diff.Comparator(StringIO(NESTED_OLD),
+                                    StringIO(NESTED_NEW)).compare_dicts()
+        page = unicode(json_diff.HTMLFormatter(diff)).splitlines()
+        rows = unicode(json_diff.HTMLFormatter(changes=iter(changes))).\
+            splitlines()
+        self.assertEqual(sorted(rows), sorted(page))
+
+    def test_main(self):
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            res = json_diff.main(["./test_json_diff.py", "-l",
+                                  "test/old.json", "test/new.json"])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(res, 1)
+        changes = [json.loads(line)
+                   for line in save_stdout.getvalue().splitlines()]
+        self.assertEqual(sorted(changes), sorted(
+            [[list(path), change_type, old, new]
+             for path, change_type, old, new in json_diff.Comparator(
+                 open("test/old.json"), open("test/new.json")).
+             iter_changes()]))
+
+
+class TestRecords(unittest.TestCase):
+    OLD_RECORDS = [{u"id": 3, u"v": 1, u"t": [1]},
+                   {u"id": 1, u"v": 1, u"t": [1]},
+                   {u"id": 2, u"v": 1, u"t": [1]}]
+    NEW_RECORDS = [{u"id": 4, u"v": 1, u"t": [1]},
+                   {u"id": 2, u"v": 2, u"t": [1, 2]},
+                   {u"id": 1, u"v": 1, u"t": [1]}]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="json_diff_")
+        self.old_name = self._write("old.ndjson", self.OLD_RECORDS)
+        self.new_name = self._write("new.ndjson", self.NEW_RECORDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, records):
+        path = os.path.join(self.tmpdir, name)
+        outf = open(path, "w")
+        for record in records:
+            outf.write(json.dumps(record) + "\n\n")
+        outf.close()
+        return path
+
+    def _expected(self, opts=None):
+        """Diff of the records as objects keyed by their ids."""
+        return json_diff.Comparator(opts=opts).compare_dicts(
+            dict([(record[u"id"], record) for record in self.OLD_RECORDS]),
+            dict([(record[u"id"], record) for record in self.NEW_RECORDS]))
+
+    def _changes(self, opts=None):
+        return json_diff.changes_to_diff(json_diff.iter_record_file_changes(
+            self.old_name, self.new_name, u"id", opts))
+
+    def test_records(self):
+        self.assertEqual(self._changes(), {
+            u"_append": {4: self.NEW_RECORDS[0]},
+            u"_remove": {3: self.OLD_RECORDS[0]},
+            u"_update": {2: {u"_update": {u"v": 2,
+                                          u"t": {u"_append": {1: 2}}}}}})
+        self.assertEqual(self._changes(), self._expected())
+        opts = OptionsClass(exc=[u"t"], sort_dir=self.tmpdir)
+        self.assertEqual(self._changes(opts), self._expected(opts))
+        opts = OptionsClass(inc=[u"*/v"], ign=True)
+        self.assertEqual(self._changes(opts), self._expected(opts))
+
+    def test_sort(self):
+        records = [(key % 5, unicode(idx)) for idx, key in
+                   enumerate(range(50, 0, -1))]
+        expected = sorted(records, key=lambda record: record[0])
+        for chunk_size in (100, 7, 1):
+            self.assertEqual(list(json_diff.sort_records(
+                iter(records), chunk_size, self.tmpdir)), expected)
+        # Pythons without heapq.merge
+        save_merge = json_diff.merge
+        json_diff.merge = None
+        try:
+            self.assertEqual(list(json_diff.sort_records(
+                iter(records), 7, self.tmpdir)), expected)
+        finally:
+            json_diff.merge = save_merge
+        self.assertEqual(os.listdir(self.tmpdir),
+                         ["new.ndjson", "old.ndjson"])
+        self.assertEqual(list(json_diff._merge_sorted([1, 4], [], [2, 3, 5])),
+                         range(1, 6))
+
+    def test_sort_levels(self):
+        records = [(key % 17, unicode(idx)) for idx, key in
+                   enumerate(range(64, 0, -1))]
+        expected = sorted(records, key=lambda record: record[0])
+        written = []
+        save_write_run = json_diff._write_run
+
+        def write_run(items, directory=None):
+            items = list(items)
+            written.append(len(items))
+            return save_write_run(items, directory)
+        json_diff._write_run = write_run
+        try:
+            self.assertEqual(list(json_diff.sort_records(
+                iter(records), 1, self.tmpdir, 4)), expected)
+        finally:
+            json_diff._write_run = save_write_run
+        # 64 runs of one record merged in 3 levels of 4 runs, every
+        # record is written once per level, not once per merge
+        self.assertEqual(sum(written), 64 * 4)
+        results = json_diff.sort_records(iter(records), 3, self.tmpdir, 2)
+        self.assertEqual(results.next(), expected[0])
+        results.close()
+        self.assertEqual(os.listdir(self.tmpdir),
+                         ["new.ndjson", "old.ndjson"])
+
+    def test_sorted(self):
+        comparator = json_diff.Comparator()
+        opts = OptionsClass(sorted=True)
+        self.assertRaises(json_diff.BadJSONError, self._changes, opts)
+        self.assertRaises(json_diff.BadJSONError, list,
+                          comparator.iter_record_changes(
+                              [(1, u"{}"), (1, u"{}")], []))
+        self.assertEqual(list(comparator.iter_record_changes(
+            [(1, u'{"a": 1}'), (2, u'{"a": 1}')],
+            [(2, u'{"a": 2}'), (3, u'{"a": 3}')])),
+            [((1,), u"_remove", {u"a": 1}, None),
+             ((2, u"a"), u"_update", 1, 2),
+             ((3,), u"_append", None, {u"a": 3})])
+
+    def test_bad_records(self):
+        for bad in ('{"id": 1}\n{"id": 2', '{"x": 1}', '[1]',
+                    '{"id": [1]}'):
+            self.assertRaises(json_diff.BadJSONError, list,
+                              json_diff.iter_records(StringIO(bad), u"id"))
+
+    def test_main(self):
+        for args, expected in ((["-r", "id"], self._expected()),
+                               (["-r", "id", "-l"], self._expected()),
+                               (["-r", "id", "-q"], None)):
+            save_stdout = StringIO()
+            sys.stdout = save_stdout
+            try:
+                res = json_diff.main(["./test_json_diff.py"] + args +
+                                     [self.old_name, self.new_name])
+            finally:
+                sys.stdout = sys.__stdout__
+            self.assertEqual(res, 1)
+            if "-l" in args:
+                diff = json_diff.changes_to_diff(
+                    [(tuple(path), change_type, old, new)
+                     for path, change_type, old, new in
+                     [json.loads(line) for line in
+                      save_stdout.getvalue().splitlines()]])
+            elif "-q" in args:
+                self.assertEqual(save_stdout.getvalue(), "")
+                continue
+            else:
+                diff = json.loads(save_stdout.getvalue())
+            self.assertEqual(json.dumps(diff, sort_keys=True),
+                             json.dumps(expected, sort_keys=True))
+
+
+class TestObjectAPI(unittest.TestCase):
+    def _expected(self, opts=None):
+        return json_diff.Comparator(StringIO(NESTED_OLD),
+                                    StringIO(NESTED_NEW),
+                                    opts).compare_dicts()
+
+    def test_objects(self):
+        old = json.loads(NESTED_OLD)
+        new = json.loads(NESTED_NEW)
+        self.assertEqual(json_diff.compare_objects(old, new),
+                         self._expected())
+        self.assertEqual(json_diff.compare_objects(old, new,
+                                                   exclude=[u"child"],
+                                                   ignore_append=True),
+                         self._expected(OptionsClass(exc=[u"child"],
+                                                     ign=True)))
+        self.assertEqual(json_diff.compare_objects(
+            old, new, OptionsClass(exc=[u"child"]), ignore_append=True),
+            self._expected(OptionsClass(exc=[u"child"], ign=True)))
+
+    def test_buffers(self):
+        old = NESTED_OLD.encode("utf-8")
+        new = NESTED_NEW.encode("utf-8")
+        expected = self._expected(OptionsClass(inc=[u"child"]))
+        for old_buffer, new_buffer in ((old, new),
+                                       (bytearray(old), memoryview(new)),
+                                       (NESTED_OLD, buffer(new))):
+            self.assertEqual(json_diff.compare_buffers(old_buffer,
+                                                       new_buffer,
+                                                       include=[u"child"]),
+                             expected)
+        self.assertRaises(json_diff.BadJSONError, json_diff.compare_buffers,
+                          NO_JSON_OLD, NO_JSON_NEW)
+
+    def test_options(self):
+        opts = json_diff.DiffOptions(exclude=[u"a"], align_arrays=True)
+        self.assertEqual(opts.include, [])
+        self.assertEqual(opts.ignore_append, False)
+        self.assertEqual(json_diff.Comparator(opts=opts).align_arrays, True)
+
+
+class TestNumbers(unittest.TestCase):
+    def setUp(self):
+        self.numpy = json_diff.numpy
+
+    def tearDown(self):
+        json_diff.numpy = self.numpy
+
+    def _both(self, old, new, opts=None):
+        """Diffs of old and new without and with numpy (if installed)."""
+        json_diff.numpy = None
+        plain = json_diff.Comparator(opts=opts).compare_dicts(old, new)
+        json_diff.numpy = self.numpy
+        return plain, json_diff.Comparator(opts=opts).compare_dicts(old, new)
+
+    def test_tolerance(self):
+        opts = OptionsClass(abs_tolerance=0.01)
+        self.assertEqual(json_diff.Comparator(opts=opts).compare_dicts(
+            {u"a": 1.0, u"b": 1, u"c": 1.0, u"d": [2.0]},
+            {u"a": 1.001, u"b": 1.0, u"c": 1.1, u"d": [2.005]}),
+            {u"_update": {u"b": 1.0, u"c": 1.1}})
+        opts = OptionsClass(rel_tolerance=0.01)
+        self.assertEqual(json_diff.Comparator(opts=opts).compare_dicts(
+            {u"a": 1000, u"b": 1}, {u"a": 1005, u"b": 2}),
+            {u"_update": {u"b": 2}})
+
+    def test_vectors(self):
+        size = json_diff.VECTOR_MIN_ITEMS * 2
+        old = {u"f": [idx / 3.0 for idx in range(size)],
+               u"i": range(size),
+               u"m": [1] * (size - 1) + [1.0]}
+        new = {u"f": [idx / 3.0 for idx in range(size)],
+               u"i": range(size - 2),
+               u"m": [1] * size}
+        new[u"f"][5] += 1e-9
+        new[u"f"][7] = float("nan")
+        new[u"i"][3] = -3
+        plain, vectorized = self._both(old, new)
+        self.assertEqual(plain, vectorized)
+        self.assertEqual(sorted(plain[u"_update"][u"f"][u"_update"]), [5, 7])
+        plain, vectorized = self._both(old, new,
+                                       OptionsClass(abs_tolerance=1e-6,
+                                                    exc=[u"i/3"]))
+        self.assertEqual(plain, vectorized)
+        self.assertEqual(sorted(plain[u"_update"][u"f"][u"_update"]), [7])
+        self.assertEqual(plain[u"_update"][u"i"].keys(), [u"_remove"])
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="json_diff_")
+        for tree, files in (("old", {"same.json": SIMPLE_OLD,
+                                     "sub/changed.json": NESTED_OLD,
+                                     "gone.json": "{}"}),
+                            ("new", {"same.json": SIMPLE_OLD,
+                                     "sub/changed.json": NESTED_NEW,
+                                     "added.json": "[1]"})):
+            for name, content in files.items():
+                path = os.path.join(self.tmpdir, tree, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                codecs.open(path, "w", "utf-8").write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, *parts):
+        return os.path.join(self.tmpdir, *parts)
+
+    def test_tree_pairs(self):
+        self.assertEqual(
+            list(json_diff.iter_tree_pairs(self._path("old"),
+                                           self._path("new"))),
+            [("added.json", None, self._path("new", "added.json")),
+             ("gone.json", self._path("old", "gone.json"), None),
+             ("same.json", self._path("old", "same.json"),
+              self._path("new", "same.json")),
+             ("sub/changed.json", self._path("old", "sub/changed.json"),
+              self._path("new", "sub/changed.json"))])
+
+    def test_compare_batch(self):
+        pairs = list(json_diff.iter_tree_pairs(self._path("old"),
+                                               self._path("new")))
+        nested_diff = json_diff.Comparator(StringIO(NESTED_OLD),
+                                           StringIO(NESTED_NEW)).\
+            compare_dicts()
+        expected = [("added.json", u"_append", [1]),
+                    ("gone.json", u"_remove", {}),
+                    ("same.json", None, None),
+                    ("sub/changed.json", u"_update", nested_diff)]
+        self.assertEqual(list(json_diff.compare_batch(pairs)), expected)
+        self.assertEqual(list(json_diff.compare_batch(
+            pairs, OptionsClass(jobs=2))), expected)
+        # stopped early, the pool is stopped by close()
+        results = json_diff.compare_batch(pairs, OptionsClass(jobs=2))
+        self.assertEqual(results.next(), expected[0])
+        results.close()
+
+    def test_tree_pairs_trailing_sep(self):
+        self.assertEqual(
+            [name for name, old_path, new_path in json_diff.iter_tree_pairs(
+                self._path("old") + os.sep, self._path("new"))],
+            ["added.json", "gone.json", "same.json", "sub/changed.json"])
+
+    def test_closing(self):
+        cleanups = []
+        results = json_diff._Closing([1, 2], lambda: cleanups.append(1))
+        self.assertEqual(list(results), [1, 2])
+        results.close()
+        self.assertEqual(cleanups, [1])
+
+    def test_manifest(self):
+        manifest = StringIO("# old new\n\n%s %s\n" %
+                            (self._path("old", "same.json"),
+                             self._path("new", "missing.json")))
+        self.assertEqual(list(json_diff.read_manifest(manifest)),
+                         [(self._path("new", "missing.json"),
+                           self._path("old", "same.json"), None)])
+        self.assertRaises(ValueError, list,
+                          json_diff.read_manifest(StringIO("a b c\n")))
+
+    def test_main(self):
+        res = json_diff.main(["./test_json_diff.py", "-b", "-a",
+                              "-o", self._path("report.json"),
+                              "-d", self._path("diffs"),
+                              self._path("old"), self._path("new")])
+        self.assertEqual(res, 1)
+        report = json.load(open(self._path("report.json")))
+        self.assertEqual(sorted(report.keys()), [u"_remove", u"_update"])
+        self.assertEqual(report[u"_update"].keys(), [u"sub/changed.json"])
+        self.assertEqual(json.load(open(self._path("diffs", "sub",
+                                                   "changed.json.diff.json"))),
+                         report[u"_update"][u"sub/changed.json"])
+
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="json_diff_")
+        for name, content in (("base.json", NESTED_OLD),
+                              ("same.json", NESTED_OLD),
+                              ("changed.json", NESTED_NEW),
+                              ("bad.json", NO_JSON_NEW)):
+            codecs.open(self._path(name), "w", "utf-8").write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_compare_many(self):
+        old = json.loads(NESTED_OLD)
+        candidates = [json.loads(NESTED_NEW), json.loads(NESTED_OLD),
+                      {u"a": 1}]
+        opts = OptionsClass(align_arrays=True)
+        diffator = json_diff.Comparator(opts=opts)
+        diffator.obj1 = old
+        diffs = list(diffator.compare_many(candidates))
+        self.assertEqual(diffs, [json_diff.Comparator(opts=opts).compare_dicts(
+            old, candidate) for candidate in candidates])
+        # only the hashes of the baseline and its "ignore" and "child"
+        self.assertEqual(len(diffator.hashes), 3)
+        # the shared index is restored between the comparisons
+        diffs = diffator.compare_many(candidates)
+        diffs.next()
+        self.assertEqual(len(diffator.hashes), 3)
+
+    def _fan_out(self, jobs, **kwargs):
+        names = [self._path(name) for name in ("same.json", "changed.json",
+                                               "bad.json", "missing.json")]
+        return list(json_diff.compare_fan_out(self._path("base.json"), names,
+                                              OptionsClass(jobs=jobs,
+                                                           **kwargs)))
+
+    def test_fan_out(self):
+        results = self._fan_out(1)
+        self.assertEqual([change_type for name, change_type, value
+                          in results], [None, u"_update", u"_error",
+                                        u"_error"])
+        self.assertEqual(results[1][2],
+                         json_diff.Comparator().compare_dicts(
+                             json.loads(NESTED_OLD), json.loads(NESTED_NEW)))
+        self.assertEqual(self._fan_out(2), results)
+        self.assertEqual(self._fan_out(1, align_arrays=True), results)
+        self.assertEqual(self._fan_out(2, align_arrays=True), results)
+        # stopped early, the pool is stopped by close()
+        results = json_diff.compare_fan_out(self._path("base.json"),
+                                            [self._path("same.json")] * 9,
+                                            OptionsClass(jobs=2))
+        self.assertEqual(results.next()[1], None)
+        results.close()
+
+    def test_main(self):
+        save_stdout = StringIO()
+        sys.stdout = save_stdout
+        try:
+            res = json_diff.main(["./test_json_diff.py", "-f",
+                                  self._path("base.json"),
+                                  self._path("same.json"),
+                                  self._path("changed.json")])
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertEqual(res, 1)
+        report = json.loads(save_stdout.getvalue())
+        self.assertEqual(report.keys(), [u"_update"])
+        self.assertEqual(report[u"_update"].keys(),
+                         [self._path("changed.json")])
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.store = json_diff.BaselineStore()
+        self.server = json_diff.make_server(("127.0.0.1", 0), self.store,
+                                            OptionsClass(exc=[u"b"]))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _request(self, method, path, body=None):
+        conn = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            conn.request(method, path, body)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def test_diff(self):
+        self.assertEqual(self._request("PUT", "/baselines/nested",
+                                       NESTED_OLD.encode("utf-8"))[0], 201)
+        status, body = self._request("GET", "/baselines")
+        self.assertEqual(json.loads(body).keys(), [u"nested"])
+        status, body = self._request("POST", "/diff/nested",
+                                     NESTED_NEW.encode("utf-8"))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), json.loads(json.dumps(
+            json_diff.Comparator(StringIO(NESTED_OLD), StringIO(NESTED_NEW),
+                                 OptionsClass(exc=[u"b"])).compare_dicts())))
+        status, body = self._request("POST", "/diff/nested?format=html",
+                                     NESTED_NEW.encode("utf-8"))
+        self.assertTrue(body.startswith("<!DOCTYPE html>"))
+        self.assertEqual(self._request("DELETE", "/baselines/nested")[0],
+                         204)
+        self.assertEqual(self._request("POST", "/diff/nested", "{}")[0],
+                         404)
+
+    def test_errors(self):
+        self.assertEqual(self._request("PUT", "/baselines/bad",
+                                       NO_JSON_OLD)[0], 400)
+        self.assertEqual(self._request("GET", "/nothing")[0], 404)
+        for idx in range(json_diff.SERVER_REQUESTS):
+            self.server.slots.acquire()
+        try:
+            self.assertEqual(self._request("PUT", "/baselines/a", "{}")[0],
+                             503)
+        finally:
+            for idx in range(json_diff.SERVER_REQUESTS):
+                self.server.slots.release()
+
+    def test_concurrent_parallel(self):
+        server = json_diff.make_server(("127.0.0.1", 0), opts=OptionsClass(
+            jobs=2))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        save_min_nodes = json_diff.Comparator.parallel_min_nodes
+        json_diff.Comparator.parallel_min_nodes = 1
+        results = {}
+
+        def post(idx):
+            old = {u"t": [{u"v": value} for value in range(50)]}
+            new = {u"t": [{u"v": value * idx} for value in range(50)]}
+            conn = httplib.HTTPConnection(*server.server_address)
+            try:
+                conn.request("PUT", "/baselines/b%d" % idx, json.dumps(old))
+                conn.getresponse().read()
+                conn.request("POST", "/diff/b%d" % idx, json.dumps(new))
+                results[idx] = (json.loads(conn.getresponse().read()),
+                                json.loads(json.dumps(
+                                    json_diff.Comparator().compare_dicts(
+                                        old, new))))
+            finally:
+                conn.close()
+        try:
+            threads = [threading.Thread(target=post, args=(idx,))
+                       for idx in range(2, 2 + json_diff.SERVER_REQUESTS)]
+            for request in threads:
+                request.start()
+            for request in threads:
+                request.join()
+        finally:
+            json_diff.Comparator.parallel_min_nodes = save_min_nodes
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(results), json_diff.SERVER_REQUESTS)
+        for diff, expected in results.values():
+            self.assertEqual(diff, expected)
+
+    def test_indexed(self):
+        opts = OptionsClass(align_arrays=True)
+        server = json_diff.make_server(("127.0.0.1", 0), opts=opts)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        old = {u"t": [{u"v": 1}, {u"v": 2}, {u"v": 3}]}
+        new = {u"t": [{u"v": 0}, {u"v": 1}, {u"v": 3}]}
+        conn = httplib.HTTPConnection(*server.server_address)
+        try:
+            conn.request("PUT", "/baselines/t", json.dumps(old))
+            conn.getresponse().read()
+            entry = server.store.acquire(u"t")
+            server.store.release(entry)
+            # the baseline, its array and items are hashed once
+            self.assertEqual(len(entry[4]), 5)
+            for idx in range(2):
+                conn.request("POST", "/diff/t", json.dumps(new))
+                self.assertEqual(
+                    json.loads(conn.getresponse().read()),
+                    json.loads(json.dumps(json_diff.Comparator(
+                        opts=opts).compare_dicts(old, new))))
+            # hashes of the posted documents are not added to the index
+            self.assertEqual(len(entry[4]), 5)
+        finally:
+            conn.close()
+            server.shutdown()
+            server.server_close()
+        # without -A there is nothing to index
+        store = json_diff.BaselineStore()
+        store.put(u"a", {u"t": [{}]}, 9)
+        self.assertEqual(store.acquire(u"a")[4], None)
+
+    def test_eviction(self):
+        store = json_diff.BaselineStore(10)
+        store.put(u"a", {}, 4)
+        store.put(u"b", {}, 4)
+        entry = store.acquire(u"a")
+        # "b" was used least recently, but "a" is being compared
+        store.put(u"c", {}, 4)
+        self.assertEqual(sorted(store.names()), [u"a", u"c"])
+        store.release(entry)
+        store.put(u"d", {}, 4)
+        self.assertEqual(sorted(store.names()), [u"c", u"d"])
+        self.assertEqual(store.size, 8)
+
+
+class TestDiffCache(unittest.TestCase):
+    OLD = "test/old.json"
+    NEW = "test/new.json"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="json_diff_")
+        self.cache = json_diff.DiffCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hit(self):
+        diff = self.cache.compare_files(self.OLD, self.NEW)
+        self.assertEqual(diff, json_diff.Comparator(
+            open(self.OLD), open(self.NEW)).compare_dicts())
+
+        def failing(*args):
+            self.fail("cached diff compared again")
+        self.assertEqual(self.cache.compare_files(self.OLD, self.NEW,
+                                                  comparator=failing),
+                         diff)
+
+    def test_key(self):
+        key = self.cache.key(self.OLD, self.NEW, OptionsClass(exc=["a"]))
+        self.assertEqual(key, self.cache.key(self.OLD, self.NEW,
+                                             OptionsClass(exc=[u"a"],
+                                                          stream=True)))
+        self.assertNotEqual(key, self.cache.key(self.NEW, self.OLD,
+                                                OptionsClass(exc=["a"])))
+        self.assertNotEqual(key, self.cache.key(self.OLD, self.NEW,
+                                                OptionsClass(inc=["a"])))
+        decoder = json_diff.default_decoder()
+        self.assertEqual(key, self.cache.key(self.OLD, self.NEW,
+                                             OptionsClass(exc=["a"],
+                                                          decoder=decoder)))
+        self.assertNotEqual(key, self.cache.key(self.OLD, self.NEW,
+                                                OptionsClass(exc=["a"],
+                                                             decoder="ujson")))
+
+    def test_deep_result(self):
+        result = {}
+        for level in range(1500):
+            result = {u"_update": {u"a": result}}
+        self.cache.put("a", result)
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_stale_tmp(self):
+        for name in ("old.tmp", "new.tmp"):
+            open(os.path.join(self.cache.directory, name), "w").close()
+        os.utime(os.path.join(self.cache.directory, "old.tmp"), (1000, 1000))
+        self.cache.evict()
+        self.assertEqual(os.listdir(self.cache.directory), ["new.tmp"])
+
+    def test_broken_entry(self):
+        self.cache.put("a", {"_update": {"a": 1}})
+        outf = open(self.cache._path("a"), "r+b")
+        outf.truncate(5)
+        outf.close()
+        self.assertEqual(self.cache.get("a"), None)
+
+    def test_eviction(self):
+        for key in ("a", "b", "c"):
+            self.cache.put(key, {"_update": {key: 1}})
+        os.utime(self.cache._path("a"), (1000, 1000))
+        os.utime(self.cache._path("b"), (3000, 3000))
+        os.utime(self.cache._path("c"), (2000, 2000))
+        self.cache.max_size = os.path.getsize(self.cache._path("a")) * 2
+        self.assertEqual(self.cache.get("a"), {"_update": {"a": 1}})
+        self.cache.evict()
+        self.assertEqual(self.cache.get("c"), None)
+        self.assertEqual(self.cache.get("b"), {"_update": {"b": 1}})
 
 
 class TestMainArgsMgmt(unittest.TestCase):
@@ -257,6 +1617,26 @@ suite.addTest(add_tests_from_class(TestBasicJSON))
 suite.addTest(add_tests_from_class(TestHappyPath))
 suite.addTest(add_tests_from_class(TestBadPath))
 suite.addTest(add_tests_from_class(TestPiglitData))
+suite.addTest(add_tests_from_class(TestStreaming))
+suite.addTest(add_tests_from_class(TestSubtreeHashes))
+suite.addTest(add_tests_from_class(TestAlignedArrays))
+suite.addTest(add_tests_from_class(TestKeyedArrays))
+suite.addTest(add_tests_from_class(TestPathFilters))
+suite.addTest(add_tests_from_class(TestParallel))
+suite.addTest(add_tests_from_class(TestStats))
+suite.addTest(add_tests_from_class(TestTracing))
+suite.addTest(add_tests_from_class(TestQuiet))
+suite.addTest(add_tests_from_class(TestBudgets))
+suite.addTest(add_tests_from_class(TestDecoders))
+suite.addTest(add_tests_from_class(TestPatch))
+suite.addTest(add_tests_from_class(TestChanges))
+suite.addTest(add_tests_from_class(TestRecords))
+suite.addTest(add_tests_from_class(TestObjectAPI))
+suite.addTest(add_tests_from_class(TestNumbers))
+suite.addTest(add_tests_from_class(TestBatch))
+suite.addTest(add_tests_from_class(TestFanOut))
+suite.addTest(add_tests_from_class(TestServer))
+suite.addTest(add_tests_from_class(TestDiffCache))
 suite.addTest(add_tests_from_class(TestMainArgsMgmt))
 
 if __name__ == "__main__":